@@ -0,0 +1,122 @@
+"""Per-process registry of the ABIs in `abi/`, with their event topics and function selectors.
+    每个进程一份的 `abi/` 目录 ABI 注册表，包括事件 topic 和函数选择器。
+
+The scanners opened and `json.load`ed `abi/ERC_721.json` and `abi/ERC_1155.json` in every
+block task and built a new `w3.eth.contract` for every transaction. The registry parses
+each ABI once per process, typically from a `Pool` initializer, precomputes the topics
+and selectors, and hands out contract objects cached by (ABI, address).
+扫描程序以前每个区块任务都打开并 `json.load` 一次 `abi/ERC_721.json` 和 `abi/ERC_1155.json`，
+每笔交易都新建一个 `w3.eth.contract`。注册表在每个进程中只解析一次 ABI（通常在 `Pool` 的 initializer 中），
+预先计算 topic 和选择器，并按 (ABI, 地址) 缓存合约对象。
+
+Usage::
+
+    Pool(12, initializer=init_registry)
+    ...
+    registry = get_registry()
+    registry.contract(w3, ERC721_ABI, address).functions.name().call()
+    registry.topic(ERC721_ABI, "Transfer")
+"""
+
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector
+from web3._utils.abi import abi_to_signature
+
+
+logger = logging.getLogger(__name__)
+
+ABI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "abi")
+
+ERC721_ABI = "ERC_721"
+ERC1155_ABI = "ERC_1155"
+
+
+class ABIRegistry:
+    """ABIs by name (file name without `.json`), their topics and selectors, and cached contract objects.
+        按名称（不带 `.json` 的文件名）保存的 ABI、topic、选择器以及缓存的合约对象。
+    """
+
+    def __init__(self, abi_dir: str = ABI_DIR, names: Iterable[str] = (ERC721_ABI, ERC1155_ABI),
+                 maxsize: int = 10000):
+        """
+        :param abi_dir: Directory of the ABI JSON files
+        :param names: ABIs to load up front, others are loaded the first time they are asked for
+        :param maxsize: How many contract objects we keep, the least recently used are dropped first
+        """
+        self.abi_dir = abi_dir
+        self.maxsize = maxsize
+        self.abis: Dict[str, list] = {}
+        # ABI name -> event name -> topic, and ABI name -> function name or signature -> selector
+        self.topics: Dict[str, Dict[str, str]] = {}
+        self.selectors: Dict[str, Dict[str, str]] = {}
+        self.contracts = OrderedDict()
+        for name in names:
+            self.abi(name)
+
+    def abi(self, name: str) -> list:
+        """Parsed ABI, read from `abi_dir` the first time."""
+        abi = self.abis.get(name)
+        if abi is None:
+            with open(os.path.join(self.abi_dir, name + ".json"), "r", encoding="utf-8") as f:
+                abi = json.load(f)
+            self.abis[name] = abi
+            self.topics[name] = {item["name"]: "0x" + event_abi_to_log_topic(item).hex()
+                                 for item in abi if item.get("type") == "event"}
+            selectors = {}
+            for item in abi:
+                if item.get("type") == "function":
+                    selector = "0x" + function_abi_to_4byte_selector(item).hex()
+                    # Overloads (e.g. safeTransferFrom) are told apart by their signature, the name maps to the first
+                    selectors[abi_to_signature(item)] = selector
+                    selectors.setdefault(item["name"], selector)
+            self.selectors[name] = selectors
+            logger.debug("Loaded ABI %s: %d events, %d functions", name, len(self.topics[name]), len(selectors))
+        return abi
+
+    def topic(self, name: str, event: str) -> str:
+        """topic0 of an event, e.g. `topic(ERC721_ABI, "Transfer")`."""
+        self.abi(name)
+        return self.topics[name][event]
+
+    def selector(self, name: str, function: str) -> str:
+        """4 byte selector of a function by name or signature, e.g. `selector(ERC721_ABI, "tokenURI")`."""
+        self.abi(name)
+        return self.selectors[name][function]
+
+    def contract(self, w3, name: str, address: Optional[str] = None):
+        """Contract object of an ABI, bound to `address` if given, built once per (Web3, ABI, address)."""
+        address = w3.toChecksumAddress(address) if address else None
+        key = (w3, name, address)
+        contract = self.contracts.get(key)
+        if contract is None:
+            contract = w3.eth.contract(address=address, abi=self.abi(name))
+            self.contracts[key] = contract
+            while len(self.contracts) > self.maxsize:
+                self.contracts.popitem(last=False)
+        else:
+            self.contracts.move_to_end(key)
+        return contract
+
+    def event(self, w3, name: str, event: str):
+        """Event class of an ABI for decoding logs of any address, e.g. `event(w3, ERC721_ABI, "Transfer")`."""
+        return getattr(self.contract(w3, name).events, event)
+
+
+_registry: Optional[ABIRegistry] = None
+
+
+def init_registry(abi_dir: str = ABI_DIR) -> ABIRegistry:
+    """Load the registry of this process, use as (or call from) a `Pool` initializer."""
+    global _registry
+    _registry = ABIRegistry(abi_dir)
+    return _registry
+
+
+def get_registry() -> ABIRegistry:
+    """Registry of this process, loaded on first use if no initializer did it."""
+    return _registry if _registry is not None else init_registry()
@@ -0,0 +1,208 @@
+"""Batched block header prefetch with a bounded LRU cache.
+    批量预取区块头，并用有界的 LRU 缓存保存。
+
+The scanners mostly need a block's timestamp (and later its hash and logsBloom).
+Instead of one `eth_getBlockByNumber` per miss, callers hand over all block numbers
+they are about to need and the misses are fetched in one JSON-RPC batch.
+扫描程序主要需要区块的时间戳（以及区块哈希和 logsBloom）。调用方先提交即将用到的全部区块号，
+缓存中没有的区块通过一次 JSON-RPC 批量请求获取，而不是每次未命中都单独请求。
+
+The logsBloom of a header tells for sure that a block has no log of a topic or address.
+`BlockHeaderCache.screen` uses it to drop such blocks before any receipt or
+`eth_getLogs` call is made for them.
+区块头的 logsBloom 可以确定一个区块中没有某个 topic 或地址的日志。`BlockHeaderCache.screen`
+据此在请求收据或 `eth_getLogs` 之前去掉这些区块。
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Union
+
+from eth_utils import keccak
+
+from rpcbatch import BatchRPC
+
+
+logger = logging.getLogger(__name__)
+
+# Header fields we keep, the transaction list would make cached blocks large
+HEADER_FIELDS = ("number", "hash", "parentHash", "timestamp", "logsBloom")
+
+
+def _compact_header(block) -> dict:
+    """Keep only the header fields we use, with numbers as int and hashes as hex strings."""
+    header = {}
+    for field in HEADER_FIELDS:
+        value = block[field]
+        if field in ("number", "timestamp") and isinstance(value, str):
+            value = int(value, 16)
+        elif hasattr(value, "hex") and not isinstance(value, str):
+            value = value.hex()
+        header[field] = value
+    return header
+
+
+def _bloom_mask(value: bytes) -> int:
+    """The three bits a value sets in a 2048 bit logs bloom, as an int mask (yellow paper, M3:2048)."""
+    digest = keccak(value)
+    mask = 0
+    for i in (0, 2, 4):
+        mask |= 1 << (((digest[i] << 8) | digest[i + 1]) & 2047)
+    return mask
+
+
+def _bloom_int(bloom: Union[str, bytes]) -> int:
+    return int(bloom, 16) if isinstance(bloom, str) else int.from_bytes(bloom, "big")
+
+
+def logs_bloom(logs: Iterable[dict]) -> str:
+    """logsBloom of a list of logs, as a node puts it in the block header."""
+    bloom = 0
+    for log in logs:
+        bloom |= _bloom_mask(bytes.fromhex(log["address"][2:]))
+        for topic in log["topics"]:
+            bloom |= _bloom_mask(bytes.fromhex(topic[2:]))
+    return "0x" + format(bloom, "0512x")
+
+
+class LogsBloomFilter:
+    """Tests whether a block may contain a log with any of `topics`, from any of `addresses`.
+        判断区块中是否可能有来自 `addresses` 之一、带有 `topics` 之一的日志。
+
+    False means the block certainly has no such log. True may be a false positive,
+    and the topic and the address may come from different logs of the block.
+    """
+
+    def __init__(self, topics: Iterable[str] = (), addresses: Iterable[str] = ()):
+        """
+        :param topics: Event topics (hex), any of them is enough, empty for any topic
+        :param addresses: Contract addresses (hex), any of them is enough, empty for any contract
+        """
+        self.topic_masks = [_bloom_mask(bytes.fromhex(topic[2:])) for topic in topics]
+        self.address_masks = [_bloom_mask(bytes.fromhex(address[2:])) for address in addresses]
+
+    @staticmethod
+    def _any(bloom: int, masks: List[int]) -> bool:
+        return not masks or any(bloom & mask == mask for mask in masks)
+
+    def might_contain(self, bloom: Union[str, bytes]) -> bool:
+        bloom = _bloom_int(bloom)
+        return self._any(bloom, self.topic_masks) and self._any(bloom, self.address_masks)
+
+
+class BlockHeaderCache:
+    """LRU cache of block headers that fetches misses in batches.
+        按批获取未命中区块的区块头 LRU 缓存。
+
+    Unmined blocks are never cached, so a later lookup asks the node again.
+    Without `rpc` and `web3` the cache never fetches: headers only come in through `put`,
+    e.g. from an async client, and a lookup of a missing header raises.
+    """
+
+    def __init__(self, rpc: Optional[BatchRPC] = None, web3=None, maxsize: int = 10000):
+        """
+        :param rpc: Batch client used to fetch many headers in one request
+        :param web3: Fallback when no batch client is available, fetches headers one by one
+        :param maxsize: How many headers we keep, the least recently used are evicted first
+        """
+        self.rpc = rpc
+        self.web3 = web3
+        self.maxsize = maxsize
+        self.headers = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.headers)
+
+    def _store(self, block_number: int, header: dict):
+        self.headers[block_number] = header
+        self.headers.move_to_end(block_number)
+        while len(self.headers) > self.maxsize:
+            self.headers.popitem(last=False)
+
+    def _fetch(self, block_numbers) -> Dict[int, Optional[dict]]:
+        if self.rpc is not None:
+            blocks = self.rpc.batch([("eth_getBlockByNumber", [hex(n), False]) for n in block_numbers])
+            return dict(zip(block_numbers, blocks))
+        if self.web3 is None:
+            raise LookupError(f"Block headers {block_numbers[0]} - {block_numbers[-1]} are not cached, "
+                              f"and this cache has no client to fetch them, fill it with put()")
+
+        from web3.exceptions import BlockNotFound
+        blocks = {}
+        for n in block_numbers:
+            try:
+                blocks[n] = self.web3.eth.get_block(n)
+            except BlockNotFound:
+                blocks[n] = None
+        return blocks
+
+    def missing(self, block_numbers: Iterable[int]) -> list:
+        """Sorted block numbers that are not cached yet."""
+        return sorted({n for n in block_numbers if n not in self.headers})
+
+    def put(self, blocks: Dict[int, Optional[dict]]):
+        """Cache blocks fetched elsewhere, e.g. over an async client. None (unmined) drops the cached header."""
+        for n, block in blocks.items():
+            if block is not None:
+                self._store(n, _compact_header(block))
+            else:
+                self.headers.pop(n, None)
+
+    def forget_since(self, block_number: int):
+        """Drop cached headers from a block on, e.g. after a chain reorganisation."""
+        for n in [n for n in self.headers if n >= block_number]:
+            del self.headers[n]
+
+    def refresh(self, block_numbers: Iterable[int]) -> Dict[int, Optional[dict]]:
+        """Fetch headers again even if cached, e.g. to compare hashes after a possible reorg.
+
+        :return: Map of block number -> header, None for blocks the node does not have (any more)
+        """
+        block_numbers = sorted(set(block_numbers))
+        if block_numbers:
+            self.put(self._fetch(block_numbers))
+        return {n: self.headers.get(n) for n in block_numbers}
+
+    def prefetch(self, block_numbers: Iterable[int]):
+        """Make sure the given blocks are cached, fetching all misses in one batch."""
+        missing = self.missing(block_numbers)
+        if not missing:
+            return
+        logger.debug("Prefetching %d block headers %d - %d", len(missing), missing[0], missing[-1])
+        self.put(self._fetch(missing))
+
+    def get(self, block_number: int) -> Optional[dict]:
+        """Header of a block, None if the block is not mined yet."""
+        header = self.headers.get(block_number)
+        if header is None:
+            self.prefetch([block_number])
+            header = self.headers.get(block_number)
+        else:
+            self.headers.move_to_end(block_number)
+        return header
+
+    def get_timestamp(self, block_number: int) -> Optional[int]:
+        """Unix timestamp of a block, None if the block is not mined yet."""
+        header = self.get(block_number)
+        return header["timestamp"] if header is not None else None
+
+    def screen(self, block_numbers: Iterable[int], bloom_filter: LogsBloomFilter,
+               batch_size: int = 1000) -> List[int]:
+        """Blocks whose logsBloom may match `bloom_filter`, in the given order, headers fetched in batches.
+
+        Blocks that are not mined yet are dropped as well.
+
+        :param batch_size: Headers fetched per batch, also bounds the memory used for a long range
+        """
+        block_numbers = list(block_numbers)
+        candidates = []
+        for offset in range(0, len(block_numbers), batch_size):
+            part = block_numbers[offset:offset + batch_size]
+            self.prefetch(part)
+            for n in part:
+                header = self.headers.get(n)
+                if header is not None and bloom_filter.might_contain(header["logsBloom"]):
+                    candidates.append(n)
+        if block_numbers:
+            logger.debug("logsBloom kept %d of %d blocks", len(candidates), len(block_numbers))
+        return candidates
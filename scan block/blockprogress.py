@@ -0,0 +1,123 @@
+"""Persistent record of which blocks a long backfill has already scanned.
+    长时间回溯扫描的进度记录：哪些区块已经扫描完成。
+
+Completed blocks are kept as an interval set in SQLite: adjacent and overlapping ranges
+are merged as they complete, so a backfill over millions of blocks stays a handful of
+rows even when work units finish out of order. After a crash or restart, `gaps` returns
+only the ranges still to scan. Blocks that failed are recorded separately with their
+error, so they can be retried on their own instead of hiding inside a finished range.
+已完成的区块以区间集合的形式保存在 SQLite 中，相邻或重叠的区间在完成时合并，即使任务单元乱序完成，
+几百万个区块也只占几行。崩溃或重启后 `gaps` 只返回还没有扫描的区间。
+扫描失败的区块连同错误信息单独记录，可以单独重试，而不会混在已完成的区间里被忽略。
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from contractcache import _ProcessLocalSQLite
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlocksFailed(Exception):
+    """Raised by a work unit when some of its blocks failed, so `workqueue.WorkScheduler` retries it.
+
+    :ivar failed: Block number -> error message, for `BlockRangeProgress.mark_done` once retries run out
+    """
+
+    def __init__(self, failed: Dict[int, str]):
+        super().__init__(failed)
+        self.failed = failed
+
+    def __str__(self) -> str:
+        return "%d blocks failed, first %d: %s" % (len(self.failed), min(self.failed), self.failed[min(self.failed)])
+
+
+class BlockRangeProgress(_ProcessLocalSQLite):
+    """Interval set of completed blocks plus the blocks that failed, stored in SQLite.
+        已完成区块的区间集合以及失败的区块，存储在 SQLite 中。
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS done_range (
+            start_block INTEGER PRIMARY KEY,
+            end_block INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS failed_block (
+            block_number INTEGER PRIMARY KEY,
+            attempts INTEGER NOT NULL,
+            error TEXT NOT NULL,
+            failed_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, fname: str = "date/block_progress.sqlite", timeout: float = 30.0):
+        super().__init__(fname, timeout)
+
+    def reset(self):
+        """Forget all progress, call when starting a backfill from scratch."""
+        with self.conn:
+            self.conn.execute("DELETE FROM done_range")
+            self.conn.execute("DELETE FROM failed_block")
+
+    def mark_done(self, start_block: int, end_block: int, failed: Optional[Dict[int, str]] = None):
+        """Record that blocks `start_block` to `end_block` (inclusive) have been attempted.
+
+        The range is merged with the completed ranges it overlaps or touches.
+        Blocks in `failed` are recorded with their error, the other blocks of the range
+        are cleared from the failed blocks, so retrying a failed block alone clears it.
+
+        :param failed: Block number -> error message of the blocks in the range that failed
+        """
+        failed = failed or {}
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            merge_start, merge_end = self.conn.execute(
+                "SELECT MIN(start_block), MAX(end_block) FROM done_range WHERE start_block <= ? AND end_block >= ?",
+                (end_block + 1, start_block - 1)).fetchone()
+            new_start = start_block if merge_start is None else min(start_block, merge_start)
+            new_end = end_block if merge_end is None else max(end_block, merge_end)
+            self.conn.execute("DELETE FROM done_range WHERE start_block BETWEEN ? AND ?", (new_start, new_end))
+            self.conn.execute("INSERT INTO done_range (start_block, end_block) VALUES (?, ?)", (new_start, new_end))
+
+            self.conn.execute("DELETE FROM failed_block WHERE block_number BETWEEN ? AND ? AND block_number NOT IN (%s)"
+                              % ",".join("?" * len(failed)), (start_block, end_block, *failed))
+            now = time.time()
+            self.conn.executemany(
+                "INSERT INTO failed_block (block_number, attempts, error, failed_at) VALUES (?, 1, ?, ?) "
+                "ON CONFLICT (block_number) DO UPDATE SET attempts = attempts + 1, error = excluded.error, "
+                "failed_at = excluded.failed_at",
+                [(block_number, error, now) for block_number, error in failed.items()])
+        if failed:
+            logger.warning("%d blocks failed in %d - %d: %s", len(failed), start_block, end_block, sorted(failed))
+
+    def gaps(self, start_block: int, end_block: int) -> List[Tuple[int, int]]:
+        """Ranges in `start_block` to `end_block` (inclusive) not completed yet, oldest first."""
+        rows = self.conn.execute(
+            "SELECT start_block, end_block FROM done_range WHERE end_block >= ? AND start_block <= ? "
+            "ORDER BY start_block", (start_block, end_block)).fetchall()
+        gaps = []
+        next_block = start_block
+        for done_start, done_end in rows:
+            if done_start > next_block:
+                gaps.append((next_block, done_start - 1))
+            next_block = max(next_block, done_end + 1)
+        if next_block <= end_block:
+            gaps.append((next_block, end_block))
+        return gaps
+
+    def done_count(self, start_block: int, end_block: int) -> int:
+        """How many blocks in `start_block` to `end_block` (inclusive) are completed."""
+        return (end_block - start_block + 1) - sum(end - start + 1 for start, end in self.gaps(start_block, end_block))
+
+    def failed_blocks(self, max_attempts: Optional[int] = None) -> Dict[int, str]:
+        """Failed blocks and their last error, oldest first.
+
+        :param max_attempts: Only blocks that failed fewer times than this
+        """
+        rows = self.conn.execute(
+            "SELECT block_number, error FROM failed_block WHERE attempts < ? ORDER BY block_number",
+            (max_attempts if max_attempts is not None else 2 ** 62,)).fetchall()
+        return dict(rows)
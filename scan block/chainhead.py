@@ -0,0 +1,122 @@
+"""Wait for new chain heads, by polling or over a `newHeads` websocket subscription.
+    等待新的区块头：轮询节点，或者通过 websocket 订阅 `newHeads`。
+
+Used by `EventScanner.follow` to scan each new range as soon as it is confirmed,
+instead of restarting a one-shot scan on a cron.
+`EventScanner.follow` 用它在新的区块范围被确认后立即扫描，而不必用定时任务反复重启一次性扫描。
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class HeadTimeout(Exception):
+    """No head at the wanted height arrived in time."""
+
+
+class PollingHeadSource:
+    """Poll `eth_blockNumber` until the chain reaches a block.
+        轮询 `eth_blockNumber`，直到链达到指定高度。
+    """
+
+    def __init__(self, web3, poll_interval: float = 12.0):
+        """
+        :param poll_interval: Seconds between two `eth_blockNumber` calls, about one block on mainnet
+        """
+        self.web3 = web3
+        self.poll_interval = poll_interval
+
+    def wait_for_block(self, block_number: int, timeout: Optional[float] = None) -> int:
+        """Block until the head is at least `block_number`.
+
+        :return: The current head block number
+        :raise HeadTimeout: If `timeout` seconds passed first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = self.web3.eth.block_number
+            if head >= block_number:
+                return head
+            if deadline is not None and time.time() + self.poll_interval > deadline:
+                raise HeadTimeout(f"Head {head} did not reach block {block_number} in {timeout} seconds")
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        pass
+
+
+class NewHeadsHeadSource:
+    """Follow `eth_subscribe("newHeads")` over a websocket in a background thread.
+        在后台线程中通过 websocket 订阅 `newHeads`。
+
+    The subscription reconnects by itself when the connection drops.
+    Needs the `websockets` package, which web3.py already depends on.
+    """
+
+    def __init__(self, ws_uri: str, reconnect_seconds: float = 3.0):
+        """
+        :param ws_uri: Websocket URL of the node, e.g. wss://eth-mainnet.g.alchemy.com/v2/<key>
+        :param reconnect_seconds: Delay before reconnecting after the subscription failed
+        """
+        self.ws_uri = ws_uri
+        self.reconnect_seconds = reconnect_seconds
+        self.head = None
+        self._changed = threading.Condition()
+        self._closed = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_until_complete, args=(self._subscribe(),), daemon=True)
+        self._thread.start()
+
+    def _set_head(self, head: int):
+        with self._changed:
+            if self.head is None or head > self.head:
+                self.head = head
+            self._changed.notify_all()
+
+    async def _subscribe(self):
+        import websockets
+
+        ids = itertools.count(1)
+        while not self._closed:
+            try:
+                async with websockets.connect(self.ws_uri, max_size=None) as ws:
+                    # The head at subscription time, newHeads only reports blocks mined afterwards
+                    block_number_id = next(ids)
+                    await ws.send(json.dumps({"jsonrpc": "2.0", "id": block_number_id, "method": "eth_blockNumber",
+                                              "params": []}))
+                    await ws.send(json.dumps({"jsonrpc": "2.0", "id": next(ids), "method": "eth_subscribe",
+                                              "params": ["newHeads"]}))
+                    async for message in ws:
+                        if self._closed:
+                            return
+                        message = json.loads(message)
+                        if message.get("id") == block_number_id and "result" in message:
+                            self._set_head(int(message["result"], 16))
+                        elif message.get("method") == "eth_subscription":
+                            self._set_head(int(message["params"]["result"]["number"], 16))
+                        elif "error" in message:
+                            raise RuntimeError(message["error"])
+            except Exception as e:
+                logger.warning("newHeads subscription to %s failed with %s, reconnecting in %s seconds",
+                               self.ws_uri, e, self.reconnect_seconds)
+                await asyncio.sleep(self.reconnect_seconds)
+
+    def wait_for_block(self, block_number: int, timeout: Optional[float] = None) -> int:
+        """Block until a head at least `block_number` arrived, see `PollingHeadSource.wait_for_block`."""
+        with self._changed:
+            arrived = self._changed.wait_for(lambda: self.head is not None and self.head >= block_number, timeout)
+            if not arrived:
+                raise HeadTimeout(f"Head {self.head} did not reach block {block_number} in {timeout} seconds")
+            return self.head
+
+    def close(self):
+        """Stop following heads, the thread exits with the next message or reconnect."""
+        self._closed = True
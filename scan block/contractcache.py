@@ -0,0 +1,358 @@
+"""Persistent contract classification cache and cross-process scanned-contract registry.
+    持久化的合约分类缓存，以及多进程共享的已扫描合约登记表。
+
+Maps an address to what it is (EOA, plain contract, ERC-721, ERC-1155) so that
+`get_code` and `supportsInterface` are only called the first time we see an address.
+The cache is a SQLite file in WAL mode, so all Pool worker processes can read it
+concurrently and it survives restarts.
+把地址映射为其类型（普通地址、普通合约、ERC-721、ERC-1155），只有第一次遇到某个地址时才调用
+`get_code` 和 `supportsInterface`。缓存是 WAL 模式的 SQLite 文件，所有进程都可以同时读取，重启后仍然有效。
+
+`discover_nft_contracts` finds the NFT contracts of a block range from their transfer logs.
+`discover_nft_contracts` 从转移日志中找出一个区块范围内的 NFT 合约。
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional
+
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+
+
+logger = logging.getLogger(__name__)
+
+# Address classifications
+EOA = "EOA"
+CONTRACT = "CONTRACT"
+ERC721 = "ERC721"
+ERC1155 = "ERC1155"
+# Classification failed for a transient reason, never written to disk
+UNKNOWN = "UNKNOWN"
+
+ERC721InterfaceId = '0x80ac58cd'
+ERC1155InterfaceId = '0xd9b67a26'
+
+# Event topics of NFT transfers. ERC-20 Transfer has the same topic but only 3 topics, the amount is in data.
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+TRANSFER_SINGLE_TOPIC = '0xc3d58168c5ae7397731d063d5bbf3d657854427343f4c083240f7aacaa2d0f62'
+TRANSFER_BATCH_TOPIC = '0x4a39dc06d4c0dbc64b70af90fd698a233a518aa5d07e595d983b8c0526c8f7fb'
+
+# Only supportsInterface is needed to probe a contract
+ERC165_ABI = [{
+    "inputs": [{"internalType": "bytes4", "name": "interfaceId", "type": "bytes4"}],
+    "name": "supportsInterface",
+    "outputs": [{"internalType": "bool", "name": "", "type": "bool"}],
+    "stateMutability": "view",
+    "type": "function",
+}]
+
+
+class _ProcessLocalSQLite:
+    """Lazily open one SQLite connection per process.
+
+    sqlite3 connections must not be shared across fork(), so an instance created
+    before `Pool` forks reconnects the first time it is used in each worker.
+
+    The connection is in autocommit mode, every statement commits on its own. Writes of
+    a batch go in one explicit transaction, `with self.conn: self.conn.execute("BEGIN IMMEDIATE")`,
+    which also takes the write lock up front, so a concurrent writer waits for it instead of failing
+    with "database is locked" when upgrading a read lock.
+    """
+
+    schema = ""
+
+    def __init__(self, fname: str, timeout: float = 30.0):
+        """
+        :param fname: SQLite file shared by all scanner processes
+        :param timeout: How long a writer waits for the database lock held by another process
+        """
+        self.fname = fname
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.fname, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.schema)
+            self._conn = conn
+            self._pid = os.getpid()
+            self.connected()
+        return self._conn
+
+    def connected(self):
+        """Called after a new connection was opened in this process."""
+
+
+class ContractClassCache(_ProcessLocalSQLite):
+    """Address -> classification, stored in SQLite and fronted by an in-process dict.
+        地址 -> 分类，存储在 SQLite 中，进程内用字典做一级缓存。
+
+    Contract classifications never change. An EOA can still get code later (a CREATE2
+    deployment to a precomputed address), so EOA entries expire after `eoa_ttl`.
+    合约的分类不会变化；普通地址之后仍可能被部署合约（CREATE2 预先计算的地址），因此 EOA 记录在 `eoa_ttl` 后过期。
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS contract_class (
+            address TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            checked_at REAL NOT NULL DEFAULT 0
+        );
+    """
+
+    def __init__(self, fname: str = "date/contract_class.sqlite", timeout: float = 30.0,
+                 eoa_ttl: float = 24 * 3600):
+        """
+        :param eoa_ttl: Seconds an address without code is trusted to stay without code
+        """
+        super().__init__(fname, timeout)
+        self.eoa_ttl = eoa_ttl
+        # Address -> (kind, expires_at)
+        self.memory = {}
+
+    def connected(self):
+        self.memory = {}
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(contract_class)")]
+        if "checked_at" not in columns:
+            # Files written before EOA entries expired, their EOAs count as checked long ago
+            self._conn.execute("ALTER TABLE contract_class ADD COLUMN checked_at REAL NOT NULL DEFAULT 0")
+
+    def _expires_at(self, kind: str, checked_at: float) -> float:
+        return checked_at + self.eoa_ttl if kind == EOA else float("inf")
+
+    def get(self, address: str) -> Optional[str]:
+        """Classification of one address, None if we have not seen it yet."""
+        return self.get_many([address]).get(address)
+
+    def get_many(self, addresses: Iterable[str]) -> Dict[str, str]:
+        """Classifications of the addresses we have already seen, keyed as given."""
+        now = time.time()
+        found = {}
+        missing = []
+        for address in addresses:
+            entry = self.memory.get(address.lower())
+            if entry is None or entry[1] <= now:
+                missing.append(address)
+            else:
+                found[address] = entry[0]
+
+        # SQLite limits the number of bound parameters per statement
+        for offset in range(0, len(missing), 500):
+            part = {}
+            for address in missing[offset:offset + 500]:
+                part.setdefault(address.lower(), []).append(address)
+            rows = self.conn.execute(
+                "SELECT address, kind, checked_at FROM contract_class WHERE address IN (%s)"
+                % ",".join("?" * len(part)), list(part)).fetchall()
+            for key, kind, checked_at in rows:
+                expires_at = self._expires_at(kind, checked_at)
+                if expires_at <= now:
+                    continue
+                self.memory[key] = (kind, expires_at)
+                for address in part[key]:
+                    found[address] = kind
+        return found
+
+    def put(self, address: str, kind: str):
+        self.put_many({address: kind})
+
+    def put_many(self, kinds: Dict[str, str]):
+        """Store classifications. UNKNOWN results are skipped so they are retried next time."""
+        now = time.time()
+        rows = [(address.lower(), kind, now) for address, kind in kinds.items() if kind != UNKNOWN]
+        if not rows:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO contract_class (address, kind, checked_at) VALUES (?, ?, ?)", rows)
+        self.memory.update((address, (kind, self._expires_at(kind, now))) for address, kind, now in rows)
+
+
+class ScannedContractRegistry(_ProcessLocalSQLite):
+    """Contracts whose full Transfer history has been claimed for backfill in this run.
+        本次运行中已经被某个进程认领、回溯全部 Transfer 历史的合约。
+
+    `claim` is a single `INSERT OR IGNORE` on the primary key, so when several
+    worker processes meet the same new contract exactly one of them wins.
+    A claim only counts as done once `complete` is called; claims left by a crashed
+    or interrupted run are given back with `release_incomplete` when it resumes.
+    `claim` 是主键上的一条 `INSERT OR IGNORE`，多个进程同时遇到同一个新合约时只有一个进程能认领成功。
+    调用 `complete` 之后认领才算完成；崩溃或中断的运行留下的未完成认领在继续运行时由 `release_incomplete` 归还。
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS scanned_contract (
+            address TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0
+        );
+    """
+
+    def __init__(self, fname: str = "date/scanned_contracts.sqlite", timeout: float = 30.0):
+        super().__init__(fname, timeout)
+
+    def connected(self):
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(scanned_contract)")]
+        if "completed" not in columns:
+            # Files written before claims were completed, their claims count as done
+            self._conn.execute("ALTER TABLE scanned_contract ADD COLUMN completed INTEGER NOT NULL DEFAULT 1")
+
+    def claim(self, address: str) -> bool:
+        """Atomically claim a contract. True if this process must backfill it, False if already claimed."""
+        cursor = self.conn.execute("INSERT OR IGNORE INTO scanned_contract (address, pid, completed) VALUES (?, ?, 0)",
+                                   (address.lower(), os.getpid()))
+        return cursor.rowcount == 1
+
+    def complete(self, address: str):
+        """Mark a claimed contract as backfilled, once all of its rows were handed to the writer."""
+        self.conn.execute("UPDATE scanned_contract SET completed = 1 WHERE address = ? AND pid = ?",
+                          (address.lower(), os.getpid()))
+
+    def release(self, address: str):
+        """Give a claim back, e.g. the history fetch failed, so another worker can retry it."""
+        self.conn.execute("DELETE FROM scanned_contract WHERE address = ? AND pid = ?", (address.lower(), os.getpid()))
+
+    def release_incomplete(self) -> int:
+        """Give back the claims never completed, call once when a run resumes before starting workers.
+
+        :return: Number of claims given back
+        """
+        count = self.conn.execute("DELETE FROM scanned_contract WHERE completed = 0").rowcount
+        if count:
+            logger.info("Released %d contract claims a previous run did not complete", count)
+        return count
+
+    def reset(self):
+        """Forget all claims, call once at the start of a run."""
+        self.conn.execute("DELETE FROM scanned_contract")
+
+    def __contains__(self, address: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM scanned_contract WHERE address = ?", (address.lower(),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM scanned_contract").fetchone()[0]
+
+
+def probe_interfaces(w3, address: str) -> str:
+    """Classify a contract with ERC-165 supportsInterface calls."""
+    contract = w3.eth.contract(address=w3.toChecksumAddress(address), abi=ERC165_ABI)
+    try:
+        if contract.functions.supportsInterface(ERC721InterfaceId).call():
+            return ERC721
+        if contract.functions.supportsInterface(ERC1155InterfaceId).call():
+            return ERC1155
+        return CONTRACT
+    except (ContractLogicError, BadFunctionCallOutput):
+        # Reverts or returns nothing: the contract does not implement ERC-165
+        return CONTRACT
+    except Exception as e:
+        logger.warning("supportsInterface probe failed for %s: %s", address, e)
+        return UNKNOWN
+
+
+def classify_contracts(w3, addresses: Iterable[str], cache: ContractClassCache, rpc=None) -> Dict[str, str]:
+    """Classify addresses, going to the chain only for addresses missing from the cache.
+        对地址分类，只有缓存中没有的地址才会请求节点。
+
+    :param rpc: Optional `rpcbatch.BatchRPC`, fetches the bytecode of all unseen addresses in one batch
+    :return: Map of address (as given) -> classification
+    """
+    addresses = list(dict.fromkeys(addresses))
+    kinds = cache.get_many(addresses)
+    missing = [address for address in addresses if address not in kinds]
+    if not missing:
+        return kinds
+
+    if rpc is not None:
+        codes = rpc.get_codes(missing)
+    else:
+        codes = {address: w3.eth.get_code(w3.toChecksumAddress(address)).hex() for address in missing}
+
+    new_kinds = {}
+    for address in missing:
+        if codes[address] in (None, "0x"):
+            new_kinds[address] = EOA
+        else:
+            new_kinds[address] = probe_interfaces(w3, address)
+    cache.put_many(new_kinds)
+    kinds.update(new_kinds)
+    return kinds
+
+
+def classify_contract(w3, address: str, cache: ContractClassCache, rpc=None) -> str:
+    """Classify a single address, see `classify_contracts`."""
+    return classify_contracts(w3, [address], cache, rpc)[address]
+
+
+def _hex(value) -> str:
+    """Topics are hex strings in raw JSON-RPC logs and HexBytes in Web3 logs."""
+    return value if isinstance(value, str) else value.hex()
+
+
+def nft_kind_from_log(log) -> Optional[str]:
+    """ERC721 or ERC1155 if the log is an NFT transfer by its topics, otherwise None."""
+    topics = log["topics"]
+    if not topics:
+        return None
+    topic = _hex(topics[0]).lower()
+    if topic == TRANSFER_TOPIC and len(topics) == 4:
+        return ERC721
+    if topic in (TRANSFER_SINGLE_TOPIC, TRANSFER_BATCH_TOPIC):
+        return ERC1155
+    return None
+
+
+def get_nft_transfer_logs(w3, start_block: int, end_block: int, rpc=None) -> List[dict]:
+    """All ERC-721 Transfer and ERC-1155 TransferSingle / TransferBatch logs in a block range, one `eth_getLogs`.
+
+    ERC-20 Transfer logs match the same topic and are filtered out here by their number of topics.
+    """
+    params = {"fromBlock": hex(start_block), "toBlock": hex(end_block),
+              "topics": [[TRANSFER_TOPIC, TRANSFER_SINGLE_TOPIC, TRANSFER_BATCH_TOPIC]]}
+    logs = rpc.call("eth_getLogs", [params]) if rpc is not None else w3.eth.get_logs(params)
+    return [log for log in logs if nft_kind_from_log(log)]
+
+
+def discover_nft_contracts(w3, start_block: int, end_block: int, cache: ContractClassCache,
+                           rpc=None) -> Dict[str, str]:
+    """Find the NFT contracts that emitted transfers in a block range, from the logs instead of tx receipts.
+        从日志而不是交易收据中找出区块范围内发生过转移的 NFT 合约。
+
+    One `eth_getLogs` finds every emitting contract, including NFTs moved through marketplace
+    routers, which the `to` address of the transaction never shows. Addresses already in the
+    cache are not probed again. New ones are confirmed with `supportsInterface`, and a contract
+    without ERC-165 is classified by the shape of its logs (e.g. pre-ERC-165 ERC-721 tokens).
+    一次 `eth_getLogs` 找到所有发出事件的合约，包括通过交易市场路由合约转移的 NFT。
+    缓存中已有的地址不再探测，新地址用 `supportsInterface` 确认。
+
+    :param rpc: Optional `rpcbatch.BatchRPC`, fetches the logs as raw JSON without Web3 formatting
+    :return: Map of checksum address -> ERC721 or ERC1155, in order of first appearance.
+        Addresses whose probe failed for a transient reason are left out, they are probed again next time.
+    """
+    log_kinds = {}
+    for log in get_nft_transfer_logs(w3, start_block, end_block, rpc):
+        log_kinds.setdefault(w3.toChecksumAddress(log["address"]), nft_kind_from_log(log))
+
+    addresses = list(log_kinds)
+    kinds = cache.get_many(addresses)
+    new_kinds = {}
+    for address in addresses:
+        # An address that emitted a log has code, one cached as EOA got deployed to since (CREATE2)
+        if address in kinds and kinds[address] != EOA:
+            kind = kinds[address]
+        else:
+            kind = probe_interfaces(w3, address)
+        if kind == CONTRACT:
+            # No ERC-165, trust the event it emitted
+            kind = log_kinds[address]
+        if kind != kinds.get(address):
+            new_kinds[address] = kind
+    cache.put_many(new_kinds)
+    kinds.update(new_kinds)
+    return {address: kinds[address] for address in addresses if kinds[address] in (ERC721, ERC1155)}
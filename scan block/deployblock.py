@@ -0,0 +1,108 @@
+"""Find the block a contract was deployed in, by binary search over `eth_getCode`.
+    通过对 `eth_getCode` 二分查找，确定合约部署所在的区块。
+
+A contract cannot have emitted a log before it had code, so its deployment block is
+where a history backfill starts. A contract has code from its deployment block on, so
+the first block with code is found in about 25 `eth_getCode` calls at historical
+blocks, which needs an archive node. All addresses are searched together, each step one
+JSON-RPC batch with one call per address still unresolved. Results never change and are
+kept in SQLite.
+合约在有代码之前不可能产生日志，所以部署区块就是回溯历史的起点。合约从部署区块开始一直有代码，
+因此在历史区块上调用大约 25 次 `eth_getCode` 即可找到第一个有代码的区块（需要归档节点）。
+所有地址同时查找，每一步把所有还没确定的地址放在一个 JSON-RPC 批量请求中。结果不会变化，保存在 SQLite 中。
+
+Self-destructed contracts, or contracts redeployed with CREATE2 after a self-destruct,
+break the assumption that code stays once deployed. For those the block found is a
+block with code, not necessarily the first one.
+自毁的合约，或自毁后用 CREATE2 重新部署的合约，不满足部署后一直有代码的前提，找到的区块有代码但不一定是第一个。
+"""
+
+import logging
+from typing import Dict, Iterable, Optional
+
+from contractcache import _ProcessLocalSQLite
+from rpcbatch import BatchRPC
+
+
+logger = logging.getLogger(__name__)
+
+
+def find_deployment_blocks(rpc: BatchRPC, addresses: Iterable[str], head: int) -> Dict[str, Optional[int]]:
+    """Deployment block of each address, None for addresses without code at `head`.
+
+    :param rpc: Batch client on an archive node
+    :param head: Block the search starts from, e.g. the latest block
+    :return: Map of address -> first block with code, keyed as given
+    """
+    addresses = list(dict.fromkeys(addresses))
+    codes = rpc.batch([("eth_getCode", [address, hex(head)]) for address in addresses])
+    # Lowest block known to have code and highest block known not to, per address
+    bounds = {address: (-1, head) for address, code in zip(addresses, codes) if code not in (None, "0x")}
+    steps = 0
+    while True:
+        searching = {address: (low + high) // 2 for address, (low, high) in bounds.items() if high - low > 1}
+        if not searching:
+            break
+        steps += 1
+        codes = rpc.batch([("eth_getCode", [address, hex(block)]) for address, block in searching.items()])
+        for (address, block), code in zip(searching.items(), codes):
+            low, high = bounds[address]
+            bounds[address] = (low, block) if code not in (None, "0x") else (block, high)
+    logger.debug("Found the deployment blocks of %d addresses in %d steps", len(bounds), steps)
+    return {address: bounds[address][1] if address in bounds else None for address in addresses}
+
+
+class DeploymentBlockCache(_ProcessLocalSQLite):
+    """Address -> deployment block, stored in SQLite and fronted by an in-process dict.
+        地址 -> 部署区块，存储在 SQLite 中，进程内用字典做一级缓存。
+
+    Addresses without code are not cached, the contract may still be deployed later.
+    """
+
+    schema = "CREATE TABLE IF NOT EXISTS deployment_block (address TEXT PRIMARY KEY, block_number INTEGER NOT NULL);"
+
+    def __init__(self, rpc: BatchRPC, fname: str = "date/deployment_block.sqlite", timeout: float = 30.0):
+        """
+        :param rpc: Batch client on an archive node, the misses are searched with
+        """
+        super().__init__(fname, timeout)
+        self.rpc = rpc
+        self.memory = {}
+
+    @classmethod
+    def from_web3(cls, w3, **kwargs) -> "DeploymentBlockCache":
+        """Cache that searches on the same endpoint (or endpoint pool) as the Web3 provider."""
+        return cls(BatchRPC.from_web3(w3), **kwargs)
+
+    def connected(self):
+        self.memory = {}
+
+    def get_many(self, addresses: Iterable[str], head: Optional[int] = None) -> Dict[str, Optional[int]]:
+        """Deployment blocks of many addresses keyed as given, None for addresses without code.
+
+        :param head: Latest block to search from, asked from the node if not given
+        """
+        addresses = list(dict.fromkeys(addresses))
+        missing = [address.lower() for address in addresses if address.lower() not in self.memory]
+        for offset in range(0, len(missing), 500):
+            part = missing[offset:offset + 500]
+            rows = self.conn.execute(
+                "SELECT address, block_number FROM deployment_block WHERE address IN (%s)" % ",".join("?" * len(part)),
+                part).fetchall()
+            self.memory.update(rows)
+
+        missing = [address for address in missing if address not in self.memory]
+        if missing:
+            if head is None:
+                head = int(self.rpc.call("eth_blockNumber", []), 16)
+            found = {address: block for address, block in find_deployment_blocks(self.rpc, missing, head).items()
+                     if block is not None}
+            self.memory.update(found)
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO deployment_block (address, block_number) VALUES (?, ?)",
+                                      found.items())
+        return {address: self.memory.get(address.lower()) for address in addresses}
+
+    def get(self, address: str, head: Optional[int] = None) -> Optional[int]:
+        """Deployment block of one address, None if it has no code."""
+        return self.get_many([address], head)[address]
@@ -1,5 +1,4 @@
 from web3 import Web3
-from ens import ENS
 # from ens.auto import ns
 
 if __name__ == "__main__":
@@ -11,4 +10,8 @@ if __name__ == "__main__":
     print(eth_address)
 
     ens_name = w3.ens.name('0x5B2063246F2191f18F2675ceDB8b28102e957458')
-    print(ens_name)
\ No newline at end of file
+    print(ens_name)
+    # 批量反向解析：地址去重后分步批量请求，结果缓存到过期
+    from enscache import ENSReverseCache
+    ens_names = ENSReverseCache.from_web3(w3)
+    print(ens_names.names(['0x5B2063246F2191f18F2675ceDB8b28102e957458', eth_address]))
@@ -0,0 +1,195 @@
+"""Bulk ENS reverse resolution with a TTL cache.
+    批量 ENS 反向解析，带过期时间的缓存。
+
+`w3.ens.name(address)` makes three sequential `eth_call`s per address: the resolver of
+`<address>.addr.reverse` in the registry, `name()` on that resolver, then the forward
+lookup of the name to check that it points back to the address. The scanners asked it
+for the from and to of every row, although marketplaces and active wallets repeat all
+the time. `ENSReverseCache` dedups the addresses of a whole chunk and resolves the misses
+step by step, each step one JSON-RPC batch for all addresses. Names and the absence of a
+name are both cached, in memory and in SQLite, until their TTL runs out.
+`w3.ens.name(address)` 每个地址要顺序发出三次 `eth_call`：在注册表中查 `<address>.addr.reverse`
+的解析器、调用该解析器的 `name()`、再正向解析这个名字确认它指回该地址。扫描程序对每一行的 from 和 to
+都调用一次，而交易市场和活跃钱包地址反复出现。`ENSReverseCache` 对整个区块范围的地址去重，
+未命中的地址分步解析，每一步所有地址只需一次 JSON-RPC 批量请求。有名字和没有名字的结果都会缓存在
+内存和 SQLite 中，直到过期。
+"""
+
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from ens.constants import ENS_MAINNET_ADDR
+from ens.utils import address_to_reverse_domain, normal_name_to_hash, normalize_name
+
+from contractcache import _ProcessLocalSQLite
+from nftmetadata import _decode_string
+from rpcbatch import BatchRPC, BatchRPCError
+
+
+logger = logging.getLogger(__name__)
+
+RESOLVER_SELECTOR = "0x0178b8bf"    # ENS registry resolver(bytes32)
+NAME_SELECTOR = "0x691f3431"        # resolver name(bytes32)
+ADDR_SELECTOR = "0x3b3bff0f"        # resolver addr(bytes32)
+
+_ZERO_ADDRESS = "0x" + "0" * 40
+
+
+def _node(name: str) -> str:
+    """Namehash of a normalised name as unprefixed hex, the argument of the calls above."""
+    return bytes(normal_name_to_hash(name)).hex()
+
+
+class ENSReverseCache(_ProcessLocalSQLite):
+    """Address -> verified primary ENS name, resolved in batches and cached with a TTL.
+        地址 -> 经过正向验证的 ENS 主名称，按批解析，缓存带过期时间。
+
+    Usage::
+
+        ens_names = ENSReverseCache.from_web3(w3)
+        ens_names.prefetch(from_addresses + to_addresses)
+        ens_names.name(address)
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS ens_name (
+            address TEXT PRIMARY KEY,
+            name TEXT,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, rpc: BatchRPC, fname: str = "date/ens_cache.sqlite", ttl: float = 7 * 24 * 3600,
+                 negative_ttl: float = 24 * 3600, registry: str = ENS_MAINNET_ADDR, timeout: float = 30.0):
+        """
+        :param rpc: Batch client the `eth_call`s are sent with
+        :param fname: SQLite file shared by all scanner processes
+        :param ttl: Seconds a resolved name is trusted
+        :param negative_ttl: Seconds an address without a name is trusted, shorter since names get set
+            more often than they change
+        :param registry: ENS registry address
+        """
+        super().__init__(fname, timeout)
+        self.rpc = rpc
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.registry = registry
+        self.memory = {}
+
+    @classmethod
+    def from_web3(cls, w3, **kwargs) -> "ENSReverseCache":
+        """Resolver on the same endpoint (or endpoint pool) as the Web3 provider."""
+        return cls(BatchRPC.from_web3(w3), **kwargs)
+
+    def connected(self):
+        self.memory = {}
+
+    def _cached(self, address: str, now: float) -> bool:
+        entry = self.memory.get(address)
+        return entry is not None and entry[1] > now
+
+    def _load(self, addresses: List[str], now: float) -> List[str]:
+        """Move the unexpired entries found on disk to memory, return the addresses still missing."""
+        for offset in range(0, len(addresses), 500):
+            part = addresses[offset:offset + 500]
+            for address, name, expires_at in self.conn.execute(
+                    "SELECT address, name, expires_at FROM ens_name WHERE expires_at > ? AND address IN (%s)"
+                    % ",".join("?" * len(part)), (now, *part)):
+                self.memory[address] = (name, expires_at)
+        return [address for address in addresses if not self._cached(address, now)]
+
+    def _call_all(self, to_and_data: Dict[str, tuple]) -> Dict[str, Optional[str]]:
+        """One batch of `eth_call`s, key -> result, reverts as "0x", transient errors left out."""
+        keys = list(to_and_data)
+        if not keys:
+            return {}
+        results = self.rpc.batch([("eth_call", [{"to": to, "data": data}, "latest"])
+                                  for to, data in to_and_data.values()], raise_on_error=False)
+        answers = {}
+        for key, result in zip(keys, results):
+            if isinstance(result, BatchRPCError):
+                if result.code != 3 and "revert" not in str(result.error).lower():
+                    logger.info("ENS lookup for %s failed: %s", key, result.error)
+                    continue
+                result = "0x"
+            answers[key] = result
+        return answers
+
+    def _resolvers(self, nodes: Dict[str, str]) -> Dict[str, Optional[str]]:
+        """Key -> resolver address of its node in the registry, None if it has none."""
+        results = self._call_all({key: (self.registry, RESOLVER_SELECTOR + node)
+                                  for key, node in nodes.items()})
+        resolvers = {}
+        for key, result in results.items():
+            resolver = "0x" + result[-40:] if len(result) >= 42 else _ZERO_ADDRESS
+            resolvers[key] = None if resolver == _ZERO_ADDRESS else resolver
+        return resolvers
+
+    def _resolve(self, addresses: List[str]) -> Dict[str, Optional[str]]:
+        """Address -> verified name or None, for the addresses every step answered."""
+        # Reverse record: registry.resolver(reverse node), then resolver.name(reverse node)
+        reverse_nodes = {address: _node(address_to_reverse_domain(address)) for address in addresses}
+        resolvers = self._resolvers(reverse_nodes)
+        names = {address: None for address, resolver in resolvers.items() if resolver is None}
+        results = self._call_all({address: (resolver, NAME_SELECTOR + reverse_nodes[address])
+                                  for address, resolver in resolvers.items() if resolver is not None})
+
+        claimed = {}
+        for address, result in results.items():
+            try:
+                claimed[address] = normalize_name(_decode_string(result) or "")
+            except Exception:
+                claimed[address] = ""
+            if not claimed[address]:
+                names[address] = None
+                del claimed[address]
+
+        # Forward check: anyone can claim any name in their reverse record
+        forward_nodes = {address: _node(name) for address, name in claimed.items()}
+        resolvers = self._resolvers(forward_nodes)
+        for address, resolver in resolvers.items():
+            if resolver is None:
+                names[address] = None
+        results = self._call_all({address: (resolver, ADDR_SELECTOR + forward_nodes[address])
+                                  for address, resolver in resolvers.items() if resolver is not None})
+        for address, result in results.items():
+            points_to = "0x" + result[-40:] if len(result) >= 42 else None
+            names[address] = claimed[address] if points_to == address else None
+        return names
+
+    def prefetch(self, addresses: Iterable[Optional[str]]):
+        """Make sure the names of these addresses are cached, a few batches for all misses together."""
+        now = time.time()
+        missing = [address for address in dict.fromkeys(a.lower() for a in addresses if a)
+                   if not self._cached(address, now)]
+        if missing:
+            missing = self._load(missing, now)
+        if not missing:
+            return
+
+        logger.debug("Resolving ENS names of %d addresses", len(missing))
+        names = self._resolve(missing)
+        rows = []
+        for address, name in names.items():
+            expires_at = now + (self.ttl if name is not None else self.negative_ttl)
+            self.memory[address] = (name, expires_at)
+            rows.append((address, name, expires_at))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO ens_name (address, name, expires_at) VALUES (?, ?, ?)", rows)
+
+    def name(self, address: Optional[str]) -> Optional[str]:
+        """Same as `w3.ens.name(address)`: the primary name, only if it resolves back to the address."""
+        if not address:
+            return None
+        address = address.lower()
+        if not self._cached(address, time.time()):
+            self.prefetch([address])
+        entry = self.memory.get(address)
+        return entry[0] if entry is not None else None
+
+    def names(self, addresses: Iterable[Optional[str]]) -> Dict[str, Optional[str]]:
+        """Names of many addresses, keyed by the addresses as given."""
+        addresses = list(addresses)
+        self.prefetch(addresses)
+        return {address: self.name(address) for address in addresses}
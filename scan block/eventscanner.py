@@ -9,25 +9,36 @@ where events are added wherever the scanner left off.
 其中事件在扫描程序离开的位置添加。
 """
 
+import asyncio
+import calendar
 import datetime
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from abc import ABC, abstractmethod
-from typing import Tuple, Optional, Callable, List, Iterable
+from typing import Tuple, Optional, Callable, List, Iterable, Iterator, AsyncIterator, Dict, NamedTuple
 
 from web3 import Web3
 from web3.contract import Contract
 from web3.datastructures import AttributeDict
-from web3.exceptions import BlockNotFound
+from web3.exceptions import LogTopicError, MismatchedABI
+import requests
 from eth_abi.codec import ABICodec
 
 # Currently this method is not exposed over official web3 API,
 # but we need it to construct eth_getLogs parameters
 from web3._utils.filters import construct_event_filter_params
 from web3._utils.events import get_event_data
+from web3._utils.method_formatters import log_entry_formatter, transaction_result_formatter
 
 import json
-import pandas as pd
+
+from blockcache import BlockHeaderCache
+from chainhead import PollingHeadSource
+from fastdecode import decode_logs_columnar
+from rpcbatch import AsyncRPC, BatchRPC, to_block_param
+from txcache import TransactionCache
 
 
 logger = logging.getLogger(__name__)
@@ -80,6 +91,29 @@ class EventScannerState(ABC):
         Purges any potential minor reorg data.
         """
 
+    def store_block_hashes(self, block_hashes: Dict[int, str]):
+        """Remember the hashes of scanned blocks, so the next run can check them against the chain.
+
+        Optional. States that do not store hashes are rescanned a fixed number of blocks on resume.
+        """
+
+    def get_block_hashes(self, before_block: int, limit: int) -> Optional[Dict[int, str]]:
+        """The newest `limit` stored block hashes below `before_block`.
+
+        :return: Map of block number -> hash, None if this state does not store hashes
+        """
+        return None
+
+
+class ScannedChunk(NamedTuple):
+    """One committed block range, as yielded by `EventScanner.scan_iter`."""
+    start_block: int
+    end_block: int
+    # When the end block was mined, None if it is not mined yet
+    end_block_timestamp: Optional[datetime.datetime]
+    # What `EventScannerState.process_event` returned for each event of the range
+    events: list
+
 
 # EventScanner 扫描区块链中的事件
 class EventScanner:
@@ -99,8 +133,13 @@ class EventScanner:
     因为它无法正确限制和减少“eth_getLogs”块数范围。
     """
 
+    # How many blocks from the last scanned block we rescan on start, in the case there were forks
+    NUM_BLOCKS_RESCAN_FOR_FORKS = 10
+
     def __init__(self, web3: Web3, contract: Contract, state: EventScannerState, events: List, filters: {},
-                 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0):
+                 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0,
+                 block_cache: Optional[BlockHeaderCache] = None, target_logs_per_request: int = 2000,
+                 tx_cache: Optional[TransactionCache] = None):
         """
         :param contract: Contract
         :param events: List of web3 Event we scan
@@ -108,6 +147,11 @@ class EventScanner:
         :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
         :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
         :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param block_cache: Block header cache shared across chunks. By default headers are batch fetched
+            from the same HTTP endpoint as `web3`, or one by one for other providers.
+        :param target_logs_per_request: How many logs we aim to get back from one `eth_getLogs` call
+        :param tx_cache: Transactions of every chunk's events are fetched into this cache in one batch
+            before `process_event`, so the state can look them up there instead of calling `get_transaction`
         """
 
         self.logger = logger
@@ -130,35 +174,90 @@ class EventScanner:
         # Factor how was we increase chunk size if no results found
         self.chunk_size_increase = 2.0
 
+        # Sizes the next chunk from the log density of the previous one
+        self.chunk_size_controller = ChunkSizeController(
+            min_chunk_size=self.min_scan_chunk_size,
+            max_chunk_size=self.max_scan_chunk_size,
+            target_logs_per_request=target_logs_per_request,
+            increase=self.chunk_size_increase,
+            decrease=self.chunk_size_decrease)
+
+        # Block timestamps survive across chunks in a bounded LRU,
+        # all blocks of a chunk are fetched in one JSON-RPC batch
+        if block_cache is None:
+            if getattr(web3.provider, "endpoint_uri", None):
+                block_cache = BlockHeaderCache(rpc=BatchRPC.from_web3(web3))
+            else:
+                block_cache = BlockHeaderCache(web3=web3)
+        self.block_cache = block_cache
+        self.tx_cache = tx_cache
+
     @property
     def address(self):
         return self.token_address
 
     def get_block_timestamp(self, block_num) -> datetime.datetime:
         """Get Ethereum block timestamp"""
-        try:
-            block_info = self.web3.eth.getBlock(block_num)
-        except BlockNotFound:
+        last_time = self.block_cache.get_timestamp(block_num)
+        if last_time is None:
             # Block was not mined yet,
             # minor chain reorganisation?
             return None
-        last_time = block_info["timestamp"]
         return datetime.datetime.utcfromtimestamp(last_time)
 
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
+            获取应该从哪个区块开始扫描新的代币事件。
 
         If there are no prior scans, start from block 1.
-        Otherwise, start from the last end block minus ten blocks.
-        We rescan the last ten scanned blocks in the case there were forks to avoid
-        misaccounting due to minor single block works (happens once in a hour in Ethereum).
-        These heurestics could be made more robust, but this is for the sake of simple reference implementation.
+        If the state stores block hashes, they are checked against the chain and we start
+        from the fork point after a reorg, or right after the last scanned block if the chain did not change.
+        Otherwise, start from the last end block minus ten blocks, in the case there were forks
+        (happens once in a hour in Ethereum).
+        如果状态保存了区块哈希，就与链上的区块哈希比较：发生重组时从分叉点开始，链没有变化时从上次扫描的下一个区块开始。
+
+        Data from the returned block on must be deleted with `delete_potentially_forked_block_data` before scanning.
         """
 
         end_block = self.get_last_scanned_block()
-        if end_block:
+        if not end_block:
+            return 1
+
+        fork_block = self.find_fork_point()
+        if fork_block is _NO_BLOCK_HASHES:
             return max(1, end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
-        return 1
+        if fork_block is None:
+            return end_block + 1
+        logger.warning("Chain reorganisation detected, rescanning from block %d", fork_block)
+        return fork_block
+
+    def find_fork_point(self, batch_size: int = 100):
+        """Compare stored block hashes with the canonical chain, newest first, in batched header lookups.
+            从最新的区块开始，批量获取区块头，把保存的区块哈希与当前链比较。
+
+        A matching hash also proves all blocks before it, so when the chain did not change
+        this costs one header lookup. Batches then grow up to `batch_size` to find deep forks quickly.
+
+        :param batch_size: How many stored hashes we check per batch request at most
+        :return: First block whose data may have been reorganised, None if the chain did not change
+            since our last scan, `_NO_BLOCK_HASHES` if the state does not store hashes
+        """
+        first_mismatch = None
+        before_block = self.get_last_scanned_block() + 1
+        limit = 1
+        while True:
+            stored = self.state.get_block_hashes(before_block, limit)
+            limit = min(batch_size, limit * 4)
+            if stored is None:
+                return _NO_BLOCK_HASHES
+            if not stored:
+                # Nothing we have stored is still on the chain
+                return first_mismatch
+            canonical = self.block_cache.refresh(stored)
+            matched, first_mismatch = _match_block_hashes(stored, canonical, first_mismatch)
+            if matched is not None:
+                return matched + 1 if first_mismatch is not None else None
+            before_block = min(stored)
 
     def get_suggested_scan_end_block(self):
         """Get the last mined block on Ethereum chain we are following."""
@@ -173,6 +272,46 @@ class EventScanner:
     def delete_potentially_forked_block_data(self, after_block: int):
         """Purge old data in the case of blockchain reorganisation."""
         self.state.delete_data(after_block)
+        self.block_cache.forget_since(after_block)
+
+    def follow(self, start_block: int = 1, confirmations: int = 12, head_source=None,
+               poll_interval: float = 12.0, idle_timeout: Optional[float] = None,
+               progress_callback: Optional[Callable] = None) -> Iterator[ScannedChunk]:
+        """Follow the chain forever, scanning each new range once it has `confirmations` blocks on top.
+            持续跟随区块链，每个新的区块范围在其后有 `confirmations` 个区块确认后立即扫描。
+
+        Every cycle first checks the stored block hashes (see `get_suggested_scan_start_block`),
+        rolls back to the fork point after a reorg, then waits for the head and scans the new
+        confirmed blocks with `scan_iter`. Blocks are yielded the same way as `scan_iter` yields them.
+        每一轮先校验保存的区块哈希，发生重组时回滚到分叉点，然后等待新的区块头并用 `scan_iter` 扫描新确认的区块。
+
+        Usage::
+
+            for chunk in scanner.follow(start_block=15100000, confirmations=12):
+                store(chunk.events)
+
+        :param start_block: Where to start when the state has not scanned anything yet
+        :param confirmations: How many blocks must be mined on top of a block before we scan it
+        :param head_source: `chainhead.PollingHeadSource` or `chainhead.NewHeadsHeadSource`,
+            defaults to polling `eth_blockNumber` every `poll_interval` seconds
+        :param idle_timeout: Raise `chainhead.HeadTimeout` when no new block arrives for this many seconds,
+            wait forever by default
+        :param progress_callback: Same as in `scan`
+        """
+        head_source = head_source or PollingHeadSource(self.web3, poll_interval)
+        while True:
+            if self.get_last_scanned_block():
+                next_block = self.get_suggested_scan_start_block()
+                if next_block <= self.get_last_scanned_block():
+                    self.delete_potentially_forked_block_data(next_block)
+            else:
+                next_block = 1
+            next_block = max(next_block, start_block)
+
+            head = head_source.wait_for_block(next_block + confirmations, idle_timeout)
+            end_block = head - confirmations
+            logger.debug("New head %d, scanning blocks %d - %d", head, next_block, end_block)
+            yield from self.scan_iter(next_block, end_block, progress_callback=progress_callback)
 
     def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
         """Read and process events between to block numbers.
@@ -184,18 +323,33 @@ class EventScanner:
         :return: tuple(actual end block number, when this block was mined, processed events)
          :return: tuple(实际结束区块号，该区块何时被挖掘，已处理事件)
         """
+        anchor = self._anchor_hash(start_block, end_block)
+        end_block, all_events = self.fetch_chunk_events(start_block, end_block)
+        end_block_timestamp, all_processed = self.process_chunk_events(all_events, end_block, start_block, anchor)
+        return end_block, end_block_timestamp, all_processed
 
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
+    def _anchor_hash(self, start_block, end_block) -> Optional[Dict[int, str]]:
+        """Hash of the chunk's end block fetched before its logs, when the state stores block hashes.
 
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution might include smarter models around block
-        def get_block_when(block_num):
-            if block_num not in block_timestamps:
-                block_timestamps[block_num] = get_block_timestamp(block_num)
-            return block_timestamps[block_num]
+        A block hash commits to all blocks before it, so if the same hash is fetched again after
+        the logs, no block of the chunk was reorganised while the logs were fetched. Without it,
+        a reorg that only adds events to blocks that had none would go unnoticed, since there is
+        no event block hash to compare.
+        """
+        if self.state.get_block_hashes(start_block, 1) is None:
+            return None
+        header = self.block_cache.refresh([end_block]).get(end_block)
+        return {end_block: header["hash"]} if header is not None else {}
 
-        all_processed = []
+    def fetch_chunk_events(self, start_block, end_block) -> Tuple[int, list]:
+        """Fetch the raw events of all event types between two block numbers, without processing them.
+            获取两个区块号之间所有事件类型的原始事件，但不处理。
+
+        Only does `eth_getLogs` calls, so it can run in worker threads.
+
+        :return: tuple(actual end block number, decoded events)
+        """
+        all_events = []
 
         for event_type in self.events:
 
@@ -215,28 +369,65 @@ class EventScanner:
                 end_block=end_block,
                 retries=self.max_request_retries,
                 delay=self.request_retry_seconds)
+            all_events += events
+
+        # A later event type may have throttled down the range,
+        # events past it are picked up again by the next chunk
+        all_events = [evt for evt in all_events if evt["blockNumber"] <= end_block]
+        return end_block, all_events
+
+    def process_chunk_events(self, all_events, end_block, start_block: Optional[int] = None,
+                             anchor: Optional[Dict[int, str]] = None) -> Tuple[datetime.datetime, list]:
+        """Hand the fetched events of one chunk to the state, in order.
+            把一个区块范围内获取到的事件按顺序交给状态处理。
+
+        :param start_block: First block of the chunk, lets us check the chunk against the previous one
+            when the state stores block hashes
+        :param anchor: Block hashes fetched before the logs, see `_anchor_hash`
+        :return: tuple(when the end block was mined, processed events)
+        """
+        get_block_when = self.get_block_timestamp
+        all_processed = []
+
+        # Fetch the headers of all blocks with events in this chunk in one batch,
+        # instead of one eth_getBlockByNumber per block
+        block_numbers = [evt["blockNumber"] for evt in all_events] + [end_block]
+        previous_hashes = self.state.get_block_hashes(start_block, 1) if start_block is not None else None
+        if previous_hashes is None:
+            self.block_cache.prefetch(block_numbers)
+        else:
+            # Headers fetched after the logs, together with the last block we stored before this chunk,
+            # tell whether the chain reorganised while we were scanning
+            previous_hashes = {**previous_hashes, **(anchor or {})}
+            self.block_cache.refresh(block_numbers + list(previous_hashes))
 
-            for evt in events:
-                idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
+        # Each transaction once per chunk, however many events it emitted
+        if self.tx_cache is not None and all_events:
+            self.tx_cache.prefetch(evt["transactionHash"] for evt in all_events)
 
-                # We cannot avoid minor chain reorganisations, but
-                # at least we must avoid blocks that are not mined yet
-                assert idx is not None, "Somehow tried to scan a pending block"
+        for evt in all_events:
+            idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
 
-                block_number = evt["blockNumber"]
+            # We cannot avoid minor chain reorganisations, but
+            # at least we must avoid blocks that are not mined yet
+            assert idx is not None, "Somehow tried to scan a pending block"
 
-                # Get UTC time when this event happened (block mined timestamp)
-                # from our in-memory cache
-                block_when = get_block_when(block_number)
+            block_number = evt["blockNumber"]
 
-                logger.debug("Processing event %s, block:%d count:%d", evt["event"], evt["blockNumber"])
-                processed = self.state.process_event(block_when, evt)
-                all_processed.append(processed)
+            # Get UTC time when this event happened (block mined timestamp)
+            # from our in-memory cache
+            block_when = get_block_when(block_number)
+
+            logger.debug("Processing event %s, block:%d count:%d", evt["event"], evt["blockNumber"])
+            processed = self.state.process_event(block_when, evt)
+            all_processed.append(processed)
+
+        _store_block_hashes(self.state, self.block_cache, all_events, end_block, previous_hashes or {})
 
         end_block_timestamp = get_block_when(end_block)
-        return end_block, end_block_timestamp, all_processed
+        return end_block_timestamp, all_processed
 
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
+    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int, blocks_scanned: Optional[int] = None):
         """Try to figure out optimal chunk size
 
         Our scanner might need to scan the whole blockchain for all events
@@ -250,22 +441,18 @@ class EventScanner:
         Currently Ethereum JSON-API does not have an API to tell when a first event occurred in a blockchain
         and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
 
-        These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
-        When any transfers are encountered, we are back to scanning only a few blocks at a time.
-        It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
-        """
-
-        if event_found_count > 0:
-            # When we encounter first events, reset the chunk size window
-            current_chuck_size = self.min_scan_chunk_size
-        else:
-            current_chuck_size *= self.chunk_size_increase
+        These heurestics exponentially increase the scan chunk size while we are not seeing events.
+        Once events show up, the chunk size is set from the observed log density so that one
+        `eth_getLogs` returns about `target_logs_per_request` logs, see `ChunkSizeController`.
+        一旦出现事件，根据观测到的日志密度设置区块范围，使每次 `eth_getLogs` 大约返回 `target_logs_per_request` 条日志。
 
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+        :param blocks_scanned: How many blocks the last chunk actually covered, defaults to `current_chuck_size`
+        """
+        if blocks_scanned is None:
+            blocks_scanned = current_chuck_size
+        return self.chunk_size_controller.next_chunk_size(current_chuck_size, blocks_scanned, event_found_count)
 
-    def scan(self, start_block, end_block, start_chunk_size=20, progress_callback=Optional[Callable]) -> Tuple[
+    def scan(self, start_block, end_block, start_chunk_size=20, progress_callback: Optional[Callable] = None) -> Tuple[
         list, int]:
         """Perform a token balances scan.
             执行代币余额扫描。
@@ -273,6 +460,9 @@ class EventScanner:
         Assumes all balances in the database are valid before start_block (no forks sneaked in).
         假设数据库中的所有余额在 start_block 之前都是有效的（没有分叉潜入）。
 
+        Keeps every processed event in memory, use `scan_iter` for long scans.
+        所有处理过的事件都保存在内存中，长时间扫描请使用 `scan_iter`。
+
         :param start_block: The first block included in the scan
         :param start_block: 扫描中包含的第一个块
 
@@ -289,6 +479,29 @@ class EventScanner:
         :return: [所有处理的事件，使用的块数]
         """
 
+        # All processed entries we got on this scan cycle
+        all_processed = []
+        total_chunks_scanned = 0
+        for chunk in self.scan_iter(start_block, end_block, start_chunk_size, progress_callback):
+            all_processed += chunk.events
+            total_chunks_scanned += 1
+        return all_processed, total_chunks_scanned
+
+    def scan_iter(self, start_block, end_block, start_chunk_size=20,
+                  progress_callback: Optional[Callable] = None) -> Iterator[ScannedChunk]:
+        """Same as `scan`, but yield the processed events chunk by chunk instead of collecting them.
+            与 `scan` 相同，但按块逐个产出处理过的事件，而不是全部收集起来。
+
+        The next chunk is only fetched once the caller asks for it, so a slow consumer
+        (e.g. writing to storage) holds back the scan and memory stays bounded by one chunk.
+        A chunk is yielded before `EventScannerState.end_chunk`, so if the caller fails while
+        storing it, `last_scanned_block` does not move past it and it is scanned again on restart.
+        只有调用方请求下一块时才会获取，慢速的消费者会拖慢扫描，内存占用始终只有一块。
+        每一块在 `end_chunk` 之前产出，调用方保存失败时该块会在重启后重新扫描。
+
+        :return: Iterator of `ScannedChunk`
+        """
+
         assert start_block <= end_block
 
         current_block = start_block
@@ -296,17 +509,13 @@ class EventScanner:
         # Scan in chunks, commit between
         chunk_size = start_chunk_size
         last_scan_duration = last_logs_found = 0
-        total_chunks_scanned = 0
-
-        # All processed entries we got on this scan cycle
-        all_processed = []
 
         while current_block <= end_block:
 
             self.state.start_chunk(current_block, chunk_size)
 
             # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-            estimated_end_block = current_block + chunk_size
+            estimated_end_block = min(current_block + chunk_size, end_block)
             logger.debug(
                 "Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
                 current_block, estimated_end_block, chunk_size, last_scan_duration, last_logs_found)
@@ -318,22 +527,456 @@ class EventScanner:
             current_end = actual_end_block
 
             last_scan_duration = time.time() - start
-            all_processed += new_entries
+            last_logs_found = len(new_entries)
 
             # Print progress bar
             if progress_callback:
                 progress_callback(start_block, end_block, current_block, end_block_timestamp, chunk_size, len(new_entries))
 
+            yield ScannedChunk(current_block, current_end, end_block_timestamp, new_entries)
+
             # Try to guess how many blocks to fetch over `eth_getLogs` API next time
-            chunk_size = self.estimate_next_chunk_size(chunk_size, len(new_entries))
+            chunk_size = self.estimate_next_chunk_size(chunk_size, len(new_entries), current_end - current_block + 1)
 
             # Set where the next chunk starts
             current_block = current_end + 1
-            total_chunks_scanned += 1
             self.state.end_chunk(current_end)
 
+    def _fetch_range(self, start_block, end_block) -> list:
+        """Fetch all events of a block range, in as many `eth_getLogs` calls as the node needs."""
+        events = []
+        current_block = start_block
+        while current_block <= end_block:
+            actual_end_block, chunk_events = self.fetch_chunk_events(current_block, end_block)
+            events += chunk_events
+            current_block = actual_end_block + 1
+        return events
+
+    def scan_parallel(self, start_block, end_block, range_size=None, max_workers=4,
+                      progress_callback: Optional[Callable] = None) -> Tuple[list, int]:
+        """Scan with several `eth_getLogs` requests in flight, committing in block order.
+            同时发出多个 `eth_getLogs` 请求进行扫描，但按区块顺序提交。
+
+        `[start_block, end_block]` is split into ranges of `range_size` blocks that worker threads
+        fetch concurrently. At most `2 * max_workers` ranges are fetched ahead of the commit point.
+        Ranges are handed to `EventScannerState` strictly in order, one `start_chunk` / `end_chunk`
+        per range, so `last_scanned_block` is always a safe resume point.
+        把 `[start_block, end_block]` 切分成 `range_size` 个区块的范围，由工作线程并发获取，
+        但严格按区块顺序交给 `EventScannerState`，所以 `last_scanned_block` 始终是安全的恢复点。
+
+        :param range_size: Blocks per range, defaults to `max_chunk_scan_size`.
+            A range the node refuses to serve at once is split by the retry logic inside the worker.
+        :param max_workers: How many `eth_getLogs` requests we have in flight
+        :param progress_callback: Same as in `scan`
+        :return: [All processed events, number of ranges committed]
+        """
+        all_processed = []
+        total_chunks_scanned = 0
+        for chunk in self.scan_parallel_iter(start_block, end_block, range_size, max_workers, progress_callback):
+            all_processed += chunk.events
+            total_chunks_scanned += 1
+        return all_processed, total_chunks_scanned
+
+    def scan_parallel_iter(self, start_block, end_block, range_size=None, max_workers=4,
+                           progress_callback: Optional[Callable] = None) -> Iterator[ScannedChunk]:
+        """Same as `scan_parallel`, but yield each range as it is committed, see `scan_iter`.
+
+        New ranges are only submitted while the caller keeps consuming,
+        so at most `2 * max_workers` fetched ranges wait in memory.
+        """
+
+        assert start_block <= end_block
+        range_size = range_size or self.max_scan_chunk_size
+
+        ranges = [(first, min(end_block, first + range_size - 1))
+                  for first in range(start_block, end_block + 1, range_size)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            next_range = 0
+
+            try:
+                while pending or next_range < len(ranges):
+                    # Keep a bounded number of ranges in flight ahead of the commit point
+                    while next_range < len(ranges) and len(pending) < 2 * max_workers:
+                        first, last = ranges[next_range]
+                        pending.append((first, last, executor.submit(self._fetch_range, first, last)))
+                        next_range += 1
+
+                    # Commit the oldest range, waiting for it if needed
+                    first, last, future = pending.pop(0)
+                    events = future.result()
+
+                    self.state.start_chunk(first, last - first + 1)
+                    end_block_timestamp, new_entries = self.process_chunk_events(events, last, first)
+
+                    if progress_callback:
+                        progress_callback(start_block, end_block, first, end_block_timestamp, last - first + 1, len(new_entries))
+
+                    yield ScannedChunk(first, last, end_block_timestamp, new_entries)
+                    self.state.end_chunk(last)
+            finally:
+                # The caller stopped early or a range failed, do not fetch the ranges queued ahead
+                for _, _, future in pending:
+                    future.cancel()
+
+
+class AsyncEventScanner:
+    """Asyncio variant of `EventScanner` that keeps many JSON-RPC requests in flight on one event loop.
+        `EventScanner` 的 asyncio 版本，在一个事件循环上同时发出多个 JSON-RPC 请求。
+
+    `eth_getLogs` for many block ranges, the block headers of their events and optionally
+    the transactions behind them are requested concurrently over one `AsyncRPC` session,
+    at most `max_concurrency` at a time. Results are still handed to `EventScannerState`
+    strictly in block order, one `start_chunk` / `end_chunk` per range, so the state contract,
+    `last_scanned_block` and the rescan of the last blocks for forks are the same as with `EventScanner`.
+    多个区块范围的 `eth_getLogs`、事件所在区块的区块头以及（可选的）交易通过同一个 `AsyncRPC` 会话并发请求，
+    但结果仍然严格按区块顺序交给 `EventScannerState`，状态接口和分叉重扫逻辑与 `EventScanner` 相同。
+
+    `web3` is only used for the ABI codec and to build the filter parameters, no request goes through it.
+
+    Usage::
+
+        async with AsyncRPC(url, max_concurrency=16) as rpc:
+            scanner = AsyncEventScanner(web3, rpc, contract, state, [contract.events.Transfer], {})
+            start_block = await scanner.get_suggested_scan_start_block()
+            scanner.delete_potentially_forked_block_data(start_block)
+            await scanner.scan(start_block, await scanner.get_suggested_scan_end_block())
+    """
+
+    NUM_BLOCKS_RESCAN_FOR_FORKS = EventScanner.NUM_BLOCKS_RESCAN_FOR_FORKS
+
+    def __init__(self, web3: Web3, rpc: AsyncRPC, contract: Contract, state: EventScannerState, events: List,
+                 filters: {}, max_chunk_scan_size: int = 10000, max_request_retries: int = 30,
+                 request_retry_seconds: float = 3.0, max_concurrency: int = 8,
+                 block_cache: Optional[BlockHeaderCache] = None, fetch_transactions: bool = False):
+        """
+        :param rpc: Open `AsyncRPC` session, its own `max_concurrency` caps the HTTP requests in flight
+        :param max_chunk_scan_size: Blocks per `eth_getLogs` range, split by the retry logic when the node refuses
+        :param max_concurrency: How many block ranges we fetch ahead of the commit point
+        :param block_cache: Block header cache, the async scanner fills it over `rpc` and never asks it to fetch,
+            so a cache with a sync client does not block the event loop either
+        :param fetch_transactions: Also fetch the transaction of every event and pass it to the state
+            as `event["transaction"]`, so `process_event` does not need its own `get_transaction` call
+        """
+        self.web3 = web3
+        self.rpc = rpc
+        self.contract = contract
+        self.state = state
+        self.events = events
+        self.filters = filters
+        self.max_scan_chunk_size = max_chunk_scan_size
+        self.max_request_retries = max_request_retries
+        self.request_retry_seconds = request_retry_seconds
+        self.max_concurrency = max_concurrency
+        self.fetch_transactions = fetch_transactions
+        self.block_cache = block_cache or BlockHeaderCache()
+
+    def get_block_timestamp(self, block_num) -> Optional[datetime.datetime]:
+        """Get Ethereum block timestamp from the header cache, see `_fetch_headers`"""
+        header = self.block_cache.headers.get(block_num)
+        if header is None:
+            return None
+        return datetime.datetime.utcfromtimestamp(header["timestamp"])
+
+    async def _fetch_headers(self, block_numbers: List[int], refetch: List[int] = ()):
+        """Fetch the headers missing from the cache concurrently over `rpc`, and `refetch` even if cached."""
+        missing = sorted(set(self.block_cache.missing(block_numbers)) | set(refetch))
+        if missing:
+            blocks = await self.rpc.gather([("eth_getBlockByNumber", [hex(n), False]) for n in missing])
+            self.block_cache.put(dict(zip(missing, blocks)))
+
+    async def get_suggested_scan_start_block(self):
+        """Where to start, see `EventScanner.get_suggested_scan_start_block`."""
+        end_block = self.get_last_scanned_block()
+        if not end_block:
+            return 1
+
+        fork_block = await self.find_fork_point()
+        if fork_block is _NO_BLOCK_HASHES:
+            return max(1, end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
+        if fork_block is None:
+            return end_block + 1
+        logger.warning("Chain reorganisation detected, rescanning from block %d", fork_block)
+        return fork_block
+
+    async def find_fork_point(self, batch_size: int = 100):
+        """See `EventScanner.find_fork_point`, headers of a batch are requested concurrently."""
+        first_mismatch = None
+        before_block = self.get_last_scanned_block() + 1
+        limit = 1
+        while True:
+            stored = self.state.get_block_hashes(before_block, limit)
+            limit = min(batch_size, limit * 4)
+            if stored is None:
+                return _NO_BLOCK_HASHES
+            if not stored:
+                return first_mismatch
+            block_numbers = sorted(stored)
+            blocks = await self.rpc.gather([("eth_getBlockByNumber", [hex(n), False]) for n in block_numbers])
+            self.block_cache.put(dict(zip(block_numbers, blocks)))
+            canonical = {n: self.block_cache.headers.get(n) for n in block_numbers}
+            matched, first_mismatch = _match_block_hashes(stored, canonical, first_mismatch)
+            if matched is not None:
+                return matched + 1 if first_mismatch is not None else None
+            before_block = block_numbers[0]
+
+    async def get_suggested_scan_end_block(self):
+        """Get the last mined block on Ethereum chain we are following."""
+        return int(await self.rpc.call("eth_blockNumber", []), 16) - 1
+
+    def get_last_scanned_block(self) -> int:
+        return self.state.get_last_scanned_block()
+
+    def delete_potentially_forked_block_data(self, after_block: int):
+        """Purge old data in the case of blockchain reorganisation."""
+        self.state.delete_data(after_block)
+        self.block_cache.forget_since(after_block)
+
+    async def _get_logs(self, event_type, start_block, end_block) -> list:
+        abi, params = _construct_event_filter_params(self.web3, event_type, self.filters, start_block, end_block)
+        params = dict(params, fromBlock=hex(params["fromBlock"]), toBlock=hex(params["toBlock"]))
+        logs = await self.rpc.call("eth_getLogs", [params])
+        return _decode_logs(self.web3.codec, abi, [log_entry_formatter(log) for log in logs])
+
+    async def fetch_chunk_events(self, start_block, end_block) -> Tuple[int, list]:
+        """Fetch the raw events of all event types between two block numbers, event types concurrently.
+
+        :return: tuple(actual end block number, decoded events)
+        """
+        results = await asyncio.gather(*(
+            _async_retry_call(
+                lambda _start_block, _end_block, event_type=event_type: self._get_logs(event_type, _start_block, _end_block),
+                start_block=start_block,
+                end_block=end_block,
+                retries=self.max_request_retries,
+                delay=self.request_retry_seconds)
+            for event_type in self.events))
+
+        # An event type may have throttled down the range,
+        # events past it are picked up again by the next chunk
+        end_block = min(chunk_end for chunk_end, _ in results)
+        all_events = [evt for _, events in results for evt in events if evt["blockNumber"] <= end_block]
+        all_events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+        return end_block, all_events
+
+    async def _fetch_range(self, start_block, end_block) -> list:
+        """Fetch all events of a block range with everything `process_chunk_events` needs."""
+        events = []
+        current_block = start_block
+        while current_block <= end_block:
+            actual_end_block, chunk_events = await self.fetch_chunk_events(current_block, end_block)
+            events += chunk_events
+            current_block = actual_end_block + 1
+
+        # Headers of all blocks with events, concurrently instead of one by one.
+        # The block before the range is fetched again to check it against the hash stored for it.
+        await self._fetch_headers([evt["blockNumber"] for evt in events] + [end_block],
+                                  refetch=[start_block - 1] if start_block > 1 else [])
+
+        if self.fetch_transactions and events:
+            tx_hashes = list(dict.fromkeys(evt["transactionHash"].hex() for evt in events))
+            txs = await self.rpc.gather([("eth_getTransactionByHash", [tx_hash]) for tx_hash in tx_hashes])
+            txs = {tx_hash: AttributeDict(transaction_result_formatter(tx)) for tx_hash, tx in zip(tx_hashes, txs)}
+            events = [AttributeDict(dict(evt, transaction=txs[evt["transactionHash"].hex()])) for evt in events]
+        return events
+
+    def process_chunk_events(self, all_events, end_block, start_block: Optional[int] = None) -> Tuple[datetime.datetime, list]:
+        """Hand the fetched events of one range to the state, in order.
+
+        :return: tuple(when the end block was mined, processed events)
+        """
+        previous_hashes = {}
+        if start_block is not None:
+            # Only the block right before the range was fetched after this range's logs
+            previous_hashes = {n: block_hash for n, block_hash in (self.state.get_block_hashes(start_block, 1) or {}).items()
+                               if n == start_block - 1}
+        all_processed = []
+        for evt in all_events:
+            assert evt["logIndex"] is not None, "Somehow tried to scan a pending block"
+            block_when = self.get_block_timestamp(evt["blockNumber"])
+            logger.debug("Processing event %s, block:%d", evt["event"], evt["blockNumber"])
+            all_processed.append(self.state.process_event(block_when, evt))
+        _store_block_hashes(self.state, self.block_cache, all_events, end_block, previous_hashes)
+        return self.get_block_timestamp(end_block), all_processed
+
+    async def scan(self, start_block, end_block, range_size=None,
+                   progress_callback: Optional[Callable] = None) -> Tuple[list, int]:
+        """Scan with up to `max_concurrency` block ranges in flight, committing in block order.
+            最多同时获取 `max_concurrency` 个区块范围，按区块顺序提交。
+
+        :param range_size: Blocks per range, defaults to `max_chunk_scan_size`
+        :param progress_callback: Same as in `EventScanner.scan`
+        :return: [All processed events, number of ranges committed]
+        """
+        all_processed = []
+        total_chunks_scanned = 0
+        async for chunk in self.scan_iter(start_block, end_block, range_size, progress_callback):
+            all_processed += chunk.events
+            total_chunks_scanned += 1
         return all_processed, total_chunks_scanned
 
+    async def scan_iter(self, start_block, end_block, range_size=None,
+                        progress_callback: Optional[Callable] = None) -> AsyncIterator[ScannedChunk]:
+        """Same as `scan`, but yield each range as it is committed, see `EventScanner.scan_iter`.
+
+        Usage::
+
+            async for chunk in scanner.scan_iter(start_block, end_block):
+                await store(chunk.events)
+        """
+
+        assert start_block <= end_block
+        range_size = range_size or self.max_scan_chunk_size
+
+        ranges = [(first, min(end_block, first + range_size - 1))
+                  for first in range(start_block, end_block + 1, range_size)]
+
+        pending = []
+        next_range = 0
+
+        try:
+            while pending or next_range < len(ranges):
+                # Keep a bounded number of ranges in flight ahead of the commit point
+                while next_range < len(ranges) and len(pending) < self.max_concurrency:
+                    first, last = ranges[next_range]
+                    pending.append((first, last, asyncio.ensure_future(self._fetch_range(first, last))))
+                    next_range += 1
+
+                # Commit the oldest range, waiting for it if needed
+                first, last, task = pending.pop(0)
+                events = await task
+                # Headers the ranges fetched ahead may have evicted from the LRU since
+                await self._fetch_headers([evt["blockNumber"] for evt in events] + [last])
+
+                self.state.start_chunk(first, last - first + 1)
+                end_block_timestamp, new_entries = self.process_chunk_events(events, last, first)
+
+                if progress_callback:
+                    progress_callback(start_block, end_block, first, end_block_timestamp, last - first + 1, len(new_entries))
+
+                yield ScannedChunk(first, last, end_block_timestamp, new_entries)
+                self.state.end_chunk(last)
+        finally:
+            # A failed range or an early stop ends the scan, do not leave the ranges fetched ahead running
+            for _, _, task in pending:
+                task.cancel()
+
+
+# `find_fork_point` result when the state does not store block hashes
+_NO_BLOCK_HASHES = object()
+
+
+def _store_block_hashes(state: EventScannerState, block_cache: BlockHeaderCache, events: list, end_block: int,
+                        previous_hashes: Dict[int, str]):
+    """Hand the hashes of the blocks with events and of the chunk end block to the state.
+
+    `find_fork_point` trusts everything below a matching hash, so the chunk must agree with itself
+    and with the hashes stored before it: the headers fetched after the logs must match the logs'
+    block hashes and the hash stored for the last block before the chunk.
+
+    :param previous_hashes: Hashes stored for blocks before this chunk, whose headers were fetched again
+    """
+    def _matches(block_number, block_hash):
+        header = block_cache.headers.get(block_number)
+        return header is not None and header["hash"].lower() == block_hash.lower()
+
+    block_hashes = {evt["blockNumber"]: evt["blockHash"].hex() for evt in events}
+    consistent = all(_matches(n, block_hash) for n, block_hash in block_hashes.items()) and \
+        all(_matches(n, block_hash) for n, block_hash in previous_hashes.items())
+    if not consistent:
+        # The chain reorganised while we fetched this chunk. Its event block hashes may be canonical
+        # while earlier data is not, so none of them may end the search for the fork point.
+        # Store an end block hash that never matches, so the next check rolls the chunk back.
+        block_hashes = {}
+
+    header = block_cache.headers.get(end_block)
+    if header is not None:
+        block_hashes[end_block] = header["hash"] if consistent else "0x"
+    state.store_block_hashes(block_hashes)
+
+
+def _match_block_hashes(stored: Dict[int, str], canonical: Dict[int, Optional[dict]],
+                        first_mismatch: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+    """Walk one batch of stored hashes from the newest block down.
+
+    :param first_mismatch: Oldest mismatching block found in newer batches
+    :return: tuple(newest block whose hash still matches or None, oldest mismatching block so far)
+    """
+    for block_number in sorted(stored, reverse=True):
+        header = canonical.get(block_number)
+        if header is not None and header["hash"].lower() == stored[block_number].lower():
+            return block_number, first_mismatch
+        first_mismatch = block_number
+    return None, first_mismatch
+
+
+class ChunkSizeController:
+    """Pick the next `eth_getLogs` block range from the log density of the last one.
+        根据上一次请求的日志密度选择下一次 `eth_getLogs` 的区块范围。
+
+    Empty ranges grow the chunk exponentially. When logs are found, the chunk is sized
+    so that it should return about `target_logs_per_request` logs, changing by at most
+    `increase` / `decrease` per step so one dense block does not collapse the range.
+    """
+
+    def __init__(self, min_chunk_size: int = 10, max_chunk_size: int = 10000, target_logs_per_request: int = 2000,
+                 increase: float = 2.0, decrease: float = 0.5):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_logs_per_request = target_logs_per_request
+        self.increase = increase
+        self.decrease = decrease
+
+    def next_chunk_size(self, current_chunk_size: int, blocks_scanned: int, logs_found: int) -> int:
+        if logs_found == 0:
+            chunk_size = current_chunk_size * self.increase
+        else:
+            logs_per_block = logs_found / max(1, blocks_scanned)
+            chunk_size = self.target_logs_per_request / logs_per_block
+            chunk_size = min(chunk_size, current_chunk_size * self.increase)
+            chunk_size = max(chunk_size, current_chunk_size * self.decrease)
+
+        chunk_size = max(self.min_chunk_size, chunk_size)
+        chunk_size = min(self.max_chunk_size, chunk_size)
+        return int(chunk_size)
+
+
+# Providers that reject a too large `eth_getLogs` tell which range would work, e.g. Alchemy:
+# "... Based on your parameters and the response size limit, this block range should work: [0xeea5c0, 0xeeb042]"
+# and Infura: "query returned more than 10000 results. Try with this block range [0x..., 0x...]."
+_BLOCK_RANGE_HINT = re.compile(r"\[\s*(0x[0-9a-fA-F]+)\s*,\s*(0x[0-9a-fA-F]+)\s*\]")
+
+# Messages of errors that mean the response would be too large, retry at once with a smaller range
+_RESPONSE_SIZE_ERRORS = ("response size", "more than", "too many", "limit exceeded", "range is too large",
+                         "block range", "-32005")
+
+# Messages of errors that are worth waiting for: timeouts, overloaded or restarting nodes
+_TRANSIENT_ERRORS = ("timeout", "timed out", "context canceled", "context cancelled", "429", "rate limit",
+                     "capacity", "502", "503", "504", "header not found", "connection")
+
+
+def parse_block_range_hint(error: Exception) -> Optional[Tuple[int, int]]:
+    """Block range suggested by the provider in an `eth_getLogs` error, None if there is no hint."""
+    match = _BLOCK_RANGE_HINT.search(str(error))
+    if match is None:
+        return None
+    return int(match.group(1), 16), int(match.group(2), 16)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether waiting before the retry can help, e.g. timeouts, rate limits and 5xx."""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    # aiohttp.ClientResponseError carries the HTTP status directly
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    message = str(error).lower()
+    return any(pattern in message for pattern in _TRANSIENT_ERRORS)
+
 
 def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
     """A custom retry loop to throttle down block range.
@@ -341,8 +984,15 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
     If our JSON-RPC server cannot serve all incoming `eth_getLogs` in a single request,
     we retry and throttle down block range for every retry.
 
-    For example, Go Ethereum does not indicate what is an acceptable response size.
-    It just fails on the server-side with a "context was cancelled" warning.
+    * When the provider error suggests a block range (Alchemy, Infura), we retry at once with that range.
+
+    * When the response was just too large, we halve the range and retry at once.
+
+    * Only transient errors (timeouts, rate limits, 5xx) sleep `delay` before the retry.
+      For example, Go Ethereum does not indicate what is an acceptable response size.
+      It just fails on the server-side with a "context was cancelled" warning, seen as a read timeout.
+
+    * Any other error (invalid params, unknown address, revert) is raised at once.
 
     :param func: A callable that triggers Ethereum JSON-RPC, as func(start_block, end_block)
     :param start_block: The initial start block of the block range
@@ -354,26 +1004,61 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
         try:
             return end_block, func(start_block, end_block)
         except Exception as e:
-            # Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
-            # from Go Ethereum. This translates to the error "context was cancelled" on the server side:
-            # https://github.com/ethereum/go-ethereum/issues/20426
-            if i < retries - 1:
-                # Give some more verbose info than the default middleware
-                logger.warning(
-                    "Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
-                    start_block,
-                    end_block,
-                    end_block-start_block,
-                    e,
-                    delay)
-                # Decrease the `eth_getBlocks` range
-                end_block = start_block + ((end_block - start_block) // 2)
+            if i >= retries - 1:
+                logger.warning("Out of retries")
+                raise
+            end_block, wait = _throttle_block_range(e, start_block, end_block, delay)
+            if wait:
                 # Let the JSON-RPC to recover e.g. from restart
                 time.sleep(delay)
-                continue
-            else:
+
+
+async def _async_retry_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
+    """Same as `_retry_web3_call` for a coroutine function, sleeping without blocking the event loop."""
+    for i in range(retries):
+        try:
+            return end_block, await func(start_block, end_block)
+        except Exception as e:
+            if i >= retries - 1:
                 logger.warning("Out of retries")
                 raise
+            end_block, wait = _throttle_block_range(e, start_block, end_block, delay)
+            if wait:
+                await asyncio.sleep(delay)
+
+
+def _throttle_block_range(error: Exception, start_block: int, end_block: int, delay: float) -> Tuple[int, bool]:
+    """Pick the block range of the next retry after a failed `eth_getLogs`.
+
+    :return: tuple(new end block, whether to sleep before the retry)
+    :raise: The error itself if it is neither a size error nor transient, e.g. invalid params,
+        a retry would fail the same way
+    """
+    hint = parse_block_range_hint(error)
+    if hint is not None and hint[0] == start_block and start_block <= hint[1] < end_block:
+        logger.info("Block range %d - %d too large, provider suggests %d - %d", start_block, end_block, *hint)
+        return hint[1], False
+
+    # Decrease the `eth_getLogs` range
+    new_end_block = start_block + ((end_block - start_block) // 2)
+
+    if is_transient_error(error):
+        # Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
+        # from Go Ethereum. This translates to the error "context was cancelled" on the server side:
+        # https://github.com/ethereum/go-ethereum/issues/20426
+        logger.warning(
+            "Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
+            start_block,
+            end_block,
+            end_block-start_block,
+            error,
+            delay)
+        return new_end_block, True
+
+    if not any(pattern in str(error).lower() for pattern in _RESPONSE_SIZE_ERRORS):
+        logger.warning("Events for block range %d - %d failed with %s, not retrying", start_block, end_block, error)
+        raise error
+    return new_end_block, False
 
 
 def _fetch_events_for_all_contracts(
@@ -394,6 +1079,23 @@ def _fetch_events_for_all_contracts(
     它可以安全地针对不提供 `eth_newFilter` API 的节点调用，例如 Infura。
     """
 
+    abi, event_filter_params = _construct_event_filter_params(web3, event, argument_filters, from_block, to_block)
+
+    logger.debug("Querying eth_getLogs with the following parameters: %s", event_filter_params)
+
+    # Call JSON-RPC API on your Ethereum node.
+    # get_logs() returns raw AttributedDict entries
+    logs = web3.eth.get_logs(event_filter_params)
+
+    return _decode_logs(web3.codec, abi, logs)
+
+
+def _construct_event_filter_params(web3, event, argument_filters: dict, from_block: int, to_block: int) -> Tuple[dict, dict]:
+    """Build `eth_getLogs` parameters for an event.
+
+    :return: tuple(event ABI, filter parameters)
+    """
+
     if from_block is None:
         raise TypeError("Missing mandatory keyword argument to getLogs: fromBlock")
 
@@ -422,12 +1124,11 @@ def _fetch_events_for_all_contracts(
         fromBlock=from_block,
         toBlock=to_block
     )
+    return abi, event_filter_params
 
-    logger.debug("Querying eth_getLogs with the following parameters: %s", event_filter_params)
 
-    # Call JSON-RPC API on your Ethereum node.
-    # get_logs() returns raw AttributedDict entries
-    logs = web3.eth.get_logs(event_filter_params)
+def _decode_logs(codec: ABICodec, abi: dict, logs: Iterable) -> list:
+    """Decode `eth_getLogs` results of one event type, skipping logs that do not match its ABI."""
 
     # Convert raw binary data to Python proxy objects as described by ABI
     all_events = []
@@ -435,99 +1136,190 @@ def _fetch_events_for_all_contracts(
         # Convert raw JSON-RPC log result to human readable event by using ABI data
         # More information how processLog works here
         # https://github.com/ethereum/web3.py/blob/fbaf1ad11b0c7fac09ba34baff2c256cffe0a148/web3/_utils/events.py#L200
-        evt = get_event_data(codec, abi, log)
+        try:
+            evt = get_event_data(codec, abi, log)
+        except (MismatchedABI, LogTopicError):
+            # Without an address filter the topic also matches other standards,
+            # e.g. ERC-20 Transfer has the same signature as ERC-721 Transfer but only 3 topics
+            logger.debug("Skipping log that does not match the event ABI: %s", log)
+            continue
         # Note: This was originally yield,
         # but deferring the timeout exception caused the throttle logic not to work
         all_events.append(evt)
     return all_events
 
 
+def scan_contract_events(
+        web3,
+        event,
+        addresses: Optional[List[str]],
+        start_block: int,
+        end_block: int,
+        chunk_size: int = 10000,
+        max_request_retries: int = 30,
+        request_retry_seconds: float = 3.0,
+        target_logs_per_request: int = 2000) -> Iterator[Tuple[int, int, Dict[str, list]]]:
+    """Scan many contracts in a single pass over the chain.
+    在区块链上只扫描一遍，同时获取多个合约的事件。
+
+    Every block range costs one `eth_getLogs` with all contract addresses in the filter,
+    so scanning N contracts costs about the same as scanning one. With `addresses=None`
+    the filter only has the event topic and matches the event of every contract on chain.
+    每个区块范围只需要一次带全部合约地址的 `eth_getLogs` 调用，扫描 N 个合约的成本与扫描一个合约相当。
+    `addresses=None` 时只按事件 topic 过滤，匹配链上所有合约的该事件。
+
+    Unlike walking back until the first empty window, the whole range is always scanned,
+    so quiet periods of a collection do not end its history early.
+
+    :param event: web3 contract event class, e.g. `contract.events.Transfer`
+    :param addresses: Contract addresses to scan, or None for all contracts
+    :param chunk_size: Largest block range per `eth_getLogs`, shrunk when ranges return many logs
+    :return: Iterator of (chunk start block, chunk end block, {contract address: [decoded events]})
+    """
+    argument_filters = {"address": addresses} if addresses else {}
+    controller = ChunkSizeController(max_chunk_size=chunk_size, target_logs_per_request=target_logs_per_request)
+    current_block = start_block
+    while current_block <= end_block:
+
+        def _fetch_events(_start_block, _end_block):
+            return _fetch_events_for_all_contracts(web3,
+                                                   event,
+                                                   argument_filters,
+                                                   from_block=_start_block,
+                                                   to_block=_end_block)
+
+        chunk_end, events = _retry_web3_call(
+            _fetch_events,
+            start_block=current_block,
+            end_block=min(end_block, current_block + chunk_size - 1),
+            retries=max_request_retries,
+            delay=request_retry_seconds)
+
+        # Route each decoded event to the contract that emitted it
+        events_by_contract = {}
+        for evt in events:
+            events_by_contract.setdefault(evt["address"], []).append(evt)
+
+        yield current_block, chunk_end, events_by_contract
+        chunk_size = controller.next_chunk_size(chunk_size, chunk_end - current_block + 1, len(events))
+        current_block = chunk_end + 1
+
+
+def scan_transfer_columns(
+        web3,
+        event,
+        addresses: Optional[List[str]],
+        start_block: int,
+        end_block: int,
+        chunk_size: int = 10000,
+        max_request_retries: int = 30,
+        request_retry_seconds: float = 3.0,
+        target_logs_per_request: int = 2000,
+        rpc: Optional[BatchRPC] = None) -> Iterator[Tuple[int, int, dict, list]]:
+    """Same single pass as `scan_contract_events`, with ERC-721 Transfers decoded into columns.
+    与 `scan_contract_events` 相同的单遍扫描，ERC-721 Transfer 直接解码为列。
+
+    Logs are fetched as raw JSON and Transfers are sliced into NumPy columns by
+    `fastdecode.decode_logs_columnar`, without `get_event_data` or an AttributeDict per log.
+    Logs that are not ERC-721 Transfers go through the generic decoder.
+
+    :param rpc: `BatchRPC` for the raw `eth_getLogs`, defaults to one on the Web3 provider's endpoint
+    :return: Iterator of (chunk start block, chunk end block, Transfer columns, other decoded events),
+        see `fastdecode.TRANSFER_COLUMNS` for the columns
+    """
+    rpc = rpc or BatchRPC.from_web3(web3)
+    argument_filters = {"address": addresses} if addresses else {}
+    controller = ChunkSizeController(max_chunk_size=chunk_size, target_logs_per_request=target_logs_per_request)
+    current_block = start_block
+    while current_block <= end_block:
+
+        def _fetch_logs(_start_block, _end_block):
+            abi, params = _construct_event_filter_params(web3, event, argument_filters, _start_block, _end_block)
+            params = dict(params, fromBlock=to_block_param(_start_block), toBlock=to_block_param(_end_block))
+            logs = rpc.call("eth_getLogs", [params])
+            return decode_logs_columnar(
+                logs, fallback=lambda others: _decode_logs(web3.codec, abi, [log_entry_formatter(log) for log in others]))
+
+        chunk_end, (columns, others) = _retry_web3_call(
+            _fetch_logs,
+            start_block=current_block,
+            end_block=min(end_block, current_block + chunk_size - 1),
+            retries=max_request_retries,
+            delay=request_retry_seconds)
+
+        yield current_block, chunk_end, columns, others
+        found = len(columns["block_number"]) + len(others)
+        chunk_size = controller.next_chunk_size(chunk_size, chunk_end - current_block + 1, found)
+        current_block = chunk_end + 1
+
+
 if __name__ == "__main__":
     # Simple demo that scans all the token transfers of RCC token (11k).
-    # The demo supports persistant state by using a JSON file.
+    # The demo supports persistant state by using a SQLite file.
     # You will need an Ethereum node for this.
     # Running this script will consume around 20k JSON-RPC calls.
     # With locally running Geth, the script takes 10 minutes.
     # The resulting JSON state file is 2.9 MB.
     # 扫描 RCC 代币 (11k) 的所有代币转移的简单演示。
-    # 该演示通过使用 JSON 文件支持持久状态。
+    # 该演示通过使用 SQLite 文件支持持久状态。
     # 为此，您将需要一个以太坊节点。
     # 运行此脚本将消耗大约 20k JSON-RPC 调用。
     # 在本地运行 Geth，脚本需要 10 分钟。
     # 生成的 JSON 状态文件为 2.9 MB。
     import sys
     import json
-    from web3.providers.rpc import HTTPProvider
+    from eventsink import EventSink, transfer_schema
+    from rpcpool import get_web3
+    from scannerstate import SQLiteEventScannerState
 
     # We use tqdm library to render a nice progress bar in the console
     # https://pypi.org/project/tqdm/
     from tqdm import tqdm
 
-    class JSONifiedState(EventScannerState):
+    class TransferState(SQLiteEventScannerState):
         """Store the state of scanned blocks and all events.
         存储扫描块的状态和所有事件。
 
-        All state is an in-memory dict.
-        Simple load/store massive JSON on start up.
-        所有状态都是内存中的字典。
-        在启动时简单地加载/存储大量 JSON。
+        Scan state and events are kept in SQLite, see `SQLiteEventScannerState`.
+        Transfer rows also go to the Parquet / CSV output.
+        扫描状态和事件保存在 SQLite 中，Transfer 记录同时写入 Parquet / CSV 输出。
         """
 
-        def __init__(self):
-            self.state = None
-            self.fname = "test-state.json"
-            # How many second ago we saved the JSON file
-            self.last_save = 0
-
-        def reset(self):
-            """Create initial state of nothing scanned."""
-            self.state = {
-                "last_scanned_block": 0,
-                "blocks": {},
-            }
-
-        def restore(self):
-            """Restore the last scan state from a file."""
-            try:
-                self.state = json.load(open(self.fname, "rt"))
-                print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
-            except (IOError, json.decoder.JSONDecodeError):
-                print("State starting from scratch")
-                self.reset()
+        def __init__(self, tx_cache: TransactionCache):
+            super().__init__("test-state.sqlite")
+            # Transactions of each Transfer, filled by the scanner for every chunk in one batch
+            # instead of one get_transaction per event
+            self.tx_cache = tx_cache
+            # Transfer rows are buffered and written in batches, flushed together with the scan state
+            # 记录先缓存在内存中，和扫描状态一起按批写出
+            transfer_columns = ['Datetime', 'ContractAddress', 'TokenId',
+                                'From Address', 'To Address', 'Value', 'BlockHash',
+                                'Blocknumber', 'LogIndex', 'TransactionHash', 'Gas', 'Gasprice', 'Event']
+            # Appends across runs like the scan state resumes: the rows of the blocks rescanned on every
+            # resume are deleted with the scan state (see `delete_data`) and written again, a row seen
+            # again in the same block is skipped by (transaction hash, log index)
+            # 和扫描状态一样跨运行追加：继续扫描时重新扫描的区块的记录随扫描状态一起删除后重新写出，
+            # 同一区块中再次出现的记录按 (交易哈希, 日志序号) 跳过
+            self.sink = EventSink('../date/df_Transaction_event_history', transfer_schema(transfer_columns),
+                                  formats=('parquet', 'csv'), overwrite=False,
+                                  dedup_key=('TransactionHash', 'LogIndex'))
 
         def save(self):
-            """Save everything we have scanned so far in a file."""
-            with open(self.fname, "wt") as f:
-                json.dump(self.state, f)
-            self.last_save = time.time()
-
-        #
-        # EventScannerState methods implemented below
-        #
+            super().save()
+            self.sink.flush()
 
-        def get_last_scanned_block(self):
-            """The number of the last block we have stored."""
-            return self.state["last_scanned_block"]
-
-        def delete_data(self, since_block):
-            """Remove potentially reorganised blocks from the scan data."""
-            for block_num in range(since_block, self.get_last_scanned_block()):
-                if block_num in self.state["blocks"]:
-                    del self.state["blocks"][block_num]
-
-        def start_chunk(self, block_number, chunk_size):
-            pass
+        def delete_data(self, since_block: int) -> int:
+            deleted = super().delete_data(since_block)
+            # Blocks a reorg may have replaced leave the output as well, the rescan writes them again
+            self.sink.delete_since(since_block)
+            return deleted
 
         def end_chunk(self, block_number):
-            """Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
-            # Next time the scanner is started we will resume from this block
-            self.state["last_scanned_block"] = block_number
-
-            # Save the database file for every minute
-            if time.time() - self.last_save > 60:
-                self.save()
+            """Commit at the end of each chunk, so we can resume in the case of a crash or CTRL+C"""
+            super().end_chunk(block_number)
+            self.sink.flush()
 
-        def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+        def transform_event(self, block_when: datetime.datetime, event: AttributeDict) -> dict:
             # !!!!!!!!!!!!!!!! 这里只能获得智能合约中有定义的event方法
             """Record a ERC-20 transfer in our database."""
             # Events are keyed by their transaction hash and log index
@@ -535,7 +1327,6 @@ if __name__ == "__main__":
             # and each one of those gets their own log index
 
             event_name = event.event # "Transfer"
-            log_index = event.logIndex  # Log index within the block
             # transaction_index = event.transactionIndex  # Transaction index within the block
             txhash = event.transactionHash.hex()  # Transaction hash
             block_number = event.blockNumber
@@ -550,15 +1341,15 @@ if __name__ == "__main__":
             #     "timestamp": block_when.isoformat(),
             # }
             if event_name == "Transfer":
-                api_url = "https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj"
-                provider = HTTPProvider(api_url)
-                w3 = Web3(provider)
-                transfer_info = w3.eth.get_transaction(txhash)
+                transfer_info = self.tx_cache.get_transaction(txhash)
                 Tx_Fee = transfer_info.value
                 Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                block_date_time = block_when.fromtimestamp(w3.eth.getBlock(block_number).timestamp)
+                # block_when is the UTC block time the scanner already looked up, no need to fetch the block again
+                block_timestamp = calendar.timegm(block_when.utctimetuple())
+                block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
                 datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
-                contract_address = w3.eth.get_transaction_receipt(txhash).contractAddress
+                # The contract that emitted the log, a receipt's contractAddress is only set for deployments
+                contract_address = event.address
 
                 transfer = {
                     "timestamp": block_when.isoformat(),
@@ -567,21 +1358,23 @@ if __name__ == "__main__":
                     "TokenId": args.tokenId,
                     "Tx_Fee": Tx_Fee,
                 }       # !!!!!!!!!!!!!
-                nft_tr_info = pd.DataFrame({
+                self.sink.write({
+                    'Timestamp': block_timestamp,
                     'Datetime': datatimestr,
                     'ContractAddress': contract_address,
                     'TokenId': args.tokenId,
                     'From Address': args["from"],
                     'To Address': args.to,
                     'Value': Tx_Fee,
-                    'BlockHash': transfer_info.blockHash.hex(),
+                    # From the log, a cached transaction may still point to a block that was reorged out
+                    'BlockHash': event.blockHash.hex(),
                     'Blocknumber': block_number,
+                    'LogIndex': event.logIndex,
                     'TransactionHash': txhash,
                     'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
                     'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether')),
                     'Event': event_name,
-                }, index=[w3.eth.getBlock(block_number).timestamp])
-                nft_tr_info.to_csv('../date/df_Transaction_event_history.csv', mode='a', index=True, header=False)
+                })
             # elif event_name == "Approval":
                 # api_url = "https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj"
                 # provider = HTTPProvider(api_url)
@@ -632,22 +1425,10 @@ if __name__ == "__main__":
             #         "Tx_Fee": Tx_Fee,
             #     }
 
-            # Create empty dict as the block that contains all transactions by txhash
-            if block_number not in self.state["blocks"]:
-                self.state["blocks"][block_number] = {}
-
-            block = self.state["blocks"][block_number]
-            if txhash not in block:
-                # We have not yet recorded any transfers in this transaction
-                # (One transaction may contain multiple events if executed by a smart contract).
-                # Create a tx entry that contains all events by a log index
-                self.state["blocks"][block_number][txhash] = {}
-
-            # Record ERC-20 transfer in our database
-            self.state["blocks"][block_number][txhash][log_index] = transfer
+            else:
+                transfer = super().transform_event(block_when, event)
 
-            # Return a pointer that allows us to look up this event later if needed
-            return f"{block_number}-{txhash}-{log_index}"
+            return transfer
 
     def run():
 
@@ -656,20 +1437,18 @@ if __name__ == "__main__":
         #     sys.exit(1)
 
         # api_url = sys.argv[1]
-        api_url = "https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m";
+        api_urls = ["https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m",
+                    "https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj"]
 
         # Enable logs to the stdout.
         # DEBUG is very verbose level
         logging.basicConfig(level=logging.INFO)
 
-        provider = HTTPProvider(api_url)
-
-        # Remove the default JSON-RPC retry middleware
-        # as it correctly cannot handle eth_getLogs block range
-        # throttle down.
-        provider.middlewares.clear()
-
-        web3 = Web3(provider)
+        # Keep-alive connections to all endpoints, rate limited per endpoint, failing over on 429 / 5xx.
+        # The pooled provider has no JSON-RPC retry middleware,
+        # as it correctly cannot handle eth_getLogs block range throttle down.
+        # 节点池：对每个节点保持长连接并限速，遇到 429 / 5xx 时切换节点
+        web3 = get_web3(api_urls)
 
         # Prepare stub ERC-20 contract object
         with open('../abi/ERC_721.json', 'r', encoding='utf-8') as f:
@@ -683,7 +1462,8 @@ if __name__ == "__main__":
         RCC_ADDRESS_4 = web3.toChecksumAddress("0x08abed322775731d7b75dbdfe6151dc39ad83800")
 
         # Restore/create our persistent state
-        state = JSONifiedState()
+        tx_cache = TransactionCache.from_web3(web3, fname="test-tx-cache.sqlite")
+        state = TransferState(tx_cache)
         state.restore()
 
         # chain_id: int, web3: Web3, abi: dict, state: EventScannerState, events: List, filters: {}, max_chunk_scan_size: int=10000
@@ -697,23 +1477,27 @@ if __name__ == "__main__":
             filters={"address": [RCC_ADDRESS_1, RCC_ADDRESS_2, RCC_ADDRESS_3, RCC_ADDRESS_4]},            # !!!!!!!!!!!!!!
             # How many maximum blocks at the time we request from JSON-RPC
             # and we are unlikely to exceed the response size limit of the JSON-RPC server
-            max_chunk_scan_size=10000
+            max_chunk_scan_size=10000,
+            tx_cache=tx_cache,
         )
 
         # Assume we might have scanned the blocks all the way to the last Ethereum block
         # that mined a few seconds before the previous scan run ended.
-        # Because there might have been a minor Etherueum chain reorganisations
-        # since the last scan ended, we need to discard
-        # the last few blocks from the previous scan results.
-        chain_reorg_safety_blocks = 10
-        scanner.delete_potentially_forked_block_data(state.get_last_scanned_block() - chain_reorg_safety_blocks)
+        # Because there might have been Etherueum chain reorganisations
+        # since the last scan ended, the stored block hashes are compared with the chain
+        # and we discard the previous scan results from the fork point on, if there is one.
+        start_block = scanner.get_suggested_scan_start_block()
+        scanner.delete_potentially_forked_block_data(start_block)
 
         # Scan from [last block scanned] - [latest ethereum block]
-        # Note that our chain reorg safety blocks cannot go negative
-        # start_block = max(state.get_last_scanned_block() - chain_reorg_safety_blocks, 0)
-        start_block = max(state.get_last_scanned_block() - chain_reorg_safety_blocks, 15100000)     # !!!!!!!!!!!
+        # start_block = max(start_block, 0)
+        start_block = max(start_block, 15100000)     # !!!!!!!!!!!
         end_block = scanner.get_suggested_scan_end_block()
         blocks_to_scan = end_block - start_block
+        if blocks_to_scan < 0:
+            print(f"No new blocks since block {start_block - 1}")
+            state.sink.close()
+            return
 
         print(f"Scanning events from blocks {start_block} - {end_block}")
 
@@ -728,18 +1512,17 @@ if __name__ == "__main__":
                 progress_bar.set_description(f"Current block: {current} ({formatted_time}), blocks in a scan batch: {chunk_size}, events processed in a batch {events_count}")
                 progress_bar.update(chunk_size)
 
-            # Run the scan
-            result, total_chunks_scanned = scanner.scan(start_block, end_block, progress_callback=_update_progress)
+            # Run the scan, chunk by chunk so a multi-year backfill does not keep every event in memory
+            total_events = total_chunks_scanned = 0
+            for chunk in scanner.scan_iter(start_block, end_block, progress_callback=_update_progress):
+                total_events += len(chunk.events)
+                total_chunks_scanned += 1
 
 
         state.save()
+        state.sink.close()
         duration = time.time() - start
-        print(f"Scanned total {len(result)} Transfer events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed")
-
+        print(f"Scanned total {total_events} Transfer events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed")
 
-    df_Transaction_event_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'TokenId',
-                                                   'From Address', 'To Address', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice', 'Event'])
-    df_Transaction_event_history.to_csv('../date/df_Transaction_event_history.csv')
 
     run()
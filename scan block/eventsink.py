@@ -0,0 +1,736 @@
+"""Buffered columnar output for scanned Transfer rows.
+    扫描得到的 Transfer 记录的缓冲列式输出。
+
+Instead of building a one-row DataFrame and reopening the CSV for every event,
+rows are buffered in typed column arrays and flushed in batches to Parquet,
+Arrow IPC and/or CSV. Each output file has exactly one writer: single-process
+scripts own an `EventSink` directly, Pool workers send batches of rows over a
+queue to one `SinkWriterProcess`.
+不再为每个事件构造一行的 DataFrame 并重新打开 CSV 文件，而是把记录缓存在类型化的列数组中，
+按批写入 Parquet、Arrow IPC 和/或 CSV。每个输出文件只有一个写入者：单进程脚本直接持有 `EventSink`，
+多进程的 Pool 子进程通过队列把批量记录发送给唯一的 `SinkWriterProcess`。
+
+Parquet output is a directory of part files, so a crash only loses the rows
+that were still buffered.
+Parquet 输出是一个由多个分片文件组成的目录，程序崩溃时只会丢失尚在缓冲区中的记录。
+
+With `dedup_key` the output holds one row per (transaction hash, log index) across
+retries, rescans and resumed runs: a `DedupIndex` next to the output remembers the
+keys already written and the block of their row. A key written again from the same
+block is skipped, from another block (re-mined after a reorg) it replaces the old row,
+and `EventSink.delete_since` drops the rows and keys of blocks a reorg may have replaced.
+设置 `dedup_key` 后，输出中每个 (交易哈希, 日志序号) 只有一行，重试、重新扫描和继续扫描都不会产生重复：
+输出旁边的 `DedupIndex` 记录已经写出的键及其记录所在的区块。同一区块再次写出的键被跳过，来自另一区块
+（链重组后被重新打包）的键替换原来的记录，`EventSink.delete_since` 删除可能被重组替换的区块的记录和键。
+"""
+
+import csv
+import glob
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+from array import array
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from contractcache import _ProcessLocalSQLite
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+logger = logging.getLogger(__name__)
+
+# Column dtypes of the Transfer output, every other column is stored as a nullable string.
+# TokenId and balanceOf are uint256 and do not fit in int64.
+TRANSFER_COLUMN_TYPES = {
+    "Timestamp": "int64",
+    "Blocknumber": "int64",
+    "LogIndex": "int64",
+    "Value": "float64",
+    "Gas": "float64",
+    "Gasprice": "float64",
+}
+
+# array.array typecodes for the numeric column buffers
+_TYPECODES = {"int64": "q", "float64": "d"}
+
+
+def transfer_schema(columns: Iterable[str]) -> Dict[str, str]:
+    """Build an ordered column -> dtype schema, with the block timestamp as the first column.
+
+    :param columns: Output column names in order, as the scanners already list them for the CSV header
+    """
+    schema = {"Timestamp": "int64"}
+    for name in columns:
+        schema[name] = TRANSFER_COLUMN_TYPES.get(name, "string")
+    return schema
+
+
+class ColumnBuffer:
+    """Rows buffered column by column in typed arrays.
+        按列缓存在类型化数组中的记录。
+    """
+
+    def __init__(self, schema: Dict[str, str]):
+        self.schema = schema
+        self.columns = {}
+        self.clear()
+
+    def clear(self):
+        self.columns = {name: array(_TYPECODES[dtype]) if dtype in _TYPECODES else []
+                        for name, dtype in self.schema.items()}
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def append(self, row: dict):
+        """Add one row. Numeric columns must be present, missing string columns become null.
+
+        :raise ValueError: A numeric column is missing or not a number, nothing is appended then
+        """
+        values = []
+        for name, dtype in self.schema.items():
+            value = row.get(name)
+            if dtype in _TYPECODES:
+                try:
+                    value = int(value) if dtype == "int64" else float(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Column {name} needs a number, got {value!r}") from None
+            elif value is not None:
+                value = str(value)
+            values.append(value)
+        # Only append once the whole row converted, so the columns always keep the same length
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def to_numpy(self) -> Dict[str, np.ndarray]:
+        return {name: np.frombuffer(column, dtype=self.schema[name]) if isinstance(column, array)
+                else np.array(column, dtype=object)
+                for name, column in self.columns.items()}
+
+    def to_arrow(self, arrays: Optional[Dict[str, np.ndarray]] = None) -> "pa.Table":
+        """:param arrays: Columns to convert instead of the buffer, e.g. a filtered `to_numpy`"""
+        arrays = self.to_numpy() if arrays is None else arrays
+        return pa.table({name: pa.array(values, type=pa.string() if self.schema[name] == "string" else None)
+                         for name, values in arrays.items()})
+
+    def to_frame(self, arrays: Optional[Dict[str, np.ndarray]] = None) -> pd.DataFrame:
+        """DataFrame indexed by block timestamp, the layout the scanners always wrote to CSV."""
+        frame = pd.DataFrame(self.to_numpy() if arrays is None else arrays)
+        return frame.set_index("Timestamp").rename_axis(None)
+
+
+def _event_key(tx_hash, log_index) -> bytes:
+    """32 byte transaction hash followed by the log index, the identity of a log."""
+    tx_hash = tx_hash if isinstance(tx_hash, str) else tx_hash.hex()
+    tx_hash = tx_hash[2:] if tx_hash.startswith("0x") else tx_hash
+    return bytes.fromhex(tx_hash) + int(log_index).to_bytes(4, "big")
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over byte keys, `k` bit positions per key by double hashing.
+        固定大小的 Bloom 过滤器，每个键通过双重哈希设置 `k` 个位。
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01, path: Optional[str] = None):
+        """
+        :param capacity: Keys it is sized for, more keys only raise the false positive rate
+        :param error_rate: False positive rate at `capacity` keys
+        :param path: Keep the bits in this memory-mapped file instead of in memory. A file of the
+            right size is opened as it is, otherwise a new zeroed one is created
+        """
+        self.capacity = capacity
+        self.size, self.hashes = self.dimensions(capacity, error_rate)
+        nbytes = (self.size + 7) // 8
+        if path is None:
+            self.bits = np.zeros(nbytes, dtype=np.uint8)
+        else:
+            mode = "r+" if os.path.exists(path) and os.path.getsize(path) == nbytes else "w+"
+            self.bits = np.memmap(path, dtype=np.uint8, mode=mode, shape=(nbytes,))
+
+    @staticmethod
+    def dimensions(capacity: int, error_rate: float) -> Tuple[int, int]:
+        """(bits, hash functions) for `capacity` keys at `error_rate`."""
+        size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        return size, max(1, round(size / capacity * math.log(2)))
+
+    def _positions(self, keys: Sequence[bytes]) -> np.ndarray:
+        digests = np.frombuffer(b"".join(hashlib.blake2b(key, digest_size=16).digest() for key in keys),
+                                dtype="<u8").reshape(-1, 2)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        # uint64 arithmetic wraps around, which is fine for hashing
+        with np.errstate(over="ignore"):
+            return (digests[:, :1] + steps * digests[:, 1:]) % np.uint64(self.size)
+
+    def add(self, keys: Sequence[bytes]):
+        if len(keys):
+            positions = self._positions(keys).ravel()
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+
+    def might_contain(self, keys: Sequence[bytes]) -> np.ndarray:
+        """Boolean per key, False means the key was certainly never added."""
+        if not len(keys):
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(keys)
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return (bits & 1).astype(bool).all(axis=1)
+
+    def flush(self):
+        """Write the bits of a memory-mapped filter to its file."""
+        if isinstance(self.bits, np.memmap):
+            self.bits.flush()
+
+
+def _hash_bytes(value) -> bytes:
+    value = value if isinstance(value, str) else value.hex()
+    return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+
+
+class DedupIndex(_ProcessLocalSQLite):
+    """(transaction hash, log index) keys already written with the block of their row, in SQLite
+    with a Bloom filter in front.
+        已写出的 (交易哈希, 日志序号) 及其记录所在的区块，存储在 SQLite 中，前面用 Bloom 过滤器加速。
+
+    Most keys of a scan are new, and for those the Bloom filter answers without touching
+    the disk. Only the keys it may have seen, a rescan or about `error_rate` of the new ones,
+    are looked up in SQLite. A key seen again with the same block hash is a duplicate; with
+    another block hash the transaction was re-mined after a reorg, and its row is replaced.
+    扫描中的大多数键都是新的，Bloom 过滤器无需读磁盘即可确定。只有过滤器可能见过的键（重新扫描的键，
+    或者约 `error_rate` 比例的新键）才查询 SQLite。区块哈希相同的键是重复记录；区块哈希不同说明交易在
+    链重组后被重新打包，需要替换原来的记录。
+
+    The filter is a memory-mapped file next to the database, checkpointed after every batch.
+    It is sized for twice the keys stored, grows when they outnumber its capacity and is
+    rebuilt from the database when it is missing or a crash left it behind.
+    过滤器是数据库旁边的内存映射文件，每批写入后落盘。它按已存键数的两倍分配大小，键数超过容量时扩容，
+    文件缺失或因崩溃落后于数据库时从数据库重建。
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS seen_event (
+            tx_hash BLOB NOT NULL,
+            log_index INTEGER NOT NULL,
+            block_hash BLOB,
+            block_number INTEGER,
+            PRIMARY KEY (tx_hash, log_index)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS dedup_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+
+    def __init__(self, fname: str, capacity: int = 1000000, error_rate: float = 0.01, timeout: float = 30.0):
+        """
+        :param fname: SQLite file of the index, the Bloom filter is kept in `<fname>.bloom`
+        :param capacity: Fewest keys the Bloom filter is sized for, about 1.2 bytes per key at 1%
+        :param error_rate: Share of new keys that still need a lookup in SQLite
+        """
+        super().__init__(fname, timeout)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = None
+
+    def connected(self):
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(seen_event)")}
+        if "block_hash" not in columns:
+            # Index of an older version, its keys have no block yet and are never taken for re-mined
+            self._conn.execute("ALTER TABLE seen_event ADD COLUMN block_hash BLOB")
+            self._conn.execute("ALTER TABLE seen_event ADD COLUMN block_number INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS seen_event_block ON seen_event (block_number)")
+        self.bloom = None
+
+    def _meta(self, name: str) -> int:
+        row = self.conn.execute("SELECT value FROM dedup_meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_meta(self, **values: int):
+        self.conn.executemany("INSERT OR REPLACE INTO dedup_meta (name, value) VALUES (?, ?)", values.items())
+
+    def _bloom(self) -> BloomFilter:
+        if self.bloom is None:
+            rows = self._meta("rows")
+            capacity = self._meta("bloom_capacity")
+            path = self.fname + ".bloom"
+            size, _ = BloomFilter.dimensions(max(capacity, 1), self.error_rate)
+            if (capacity >= rows and self._meta("bloom_version") == self._meta("version")
+                    and os.path.exists(path) and os.path.getsize(path) == (size + 7) // 8):
+                self.bloom = BloomFilter(capacity, self.error_rate, path)
+            else:
+                self.bloom = self._rebuild(max(self.capacity, 2 * rows))
+        return self.bloom
+
+    def _rebuild(self, capacity: int) -> BloomFilter:
+        path = self.fname + ".bloom"
+        self.bloom = None
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            # Out of date until rebuilt, a crash in between rebuilds it again next time
+            self._set_meta(bloom_version=-1)
+        if os.path.exists(path):
+            os.remove(path)
+        logger.info("Rebuilding the Bloom filter of %s for %d keys", self.fname, capacity)
+        bloom = BloomFilter(capacity, self.error_rate, path)
+        cursor = self.conn.execute("SELECT tx_hash, log_index FROM seen_event")
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            bloom.add([tx_hash + log_index.to_bytes(4, "big") for tx_hash, log_index in rows])
+        bloom.flush()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._set_meta(bloom_capacity=capacity, bloom_version=self._meta("version"))
+        return bloom
+
+    def reset(self):
+        """Forget all keys, call when the output is written from scratch."""
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM seen_event")
+            self.conn.execute("DELETE FROM dedup_meta")
+        self.bloom = None
+        if os.path.exists(self.fname + ".bloom"):
+            os.remove(self.fname + ".bloom")
+
+    def classify(self, tx_hashes: Sequence, log_indexes: Sequence[int],
+                 block_hashes: Sequence) -> Tuple[np.ndarray, Dict[bytes, int]]:
+        """Which rows to write, and which keys were written from another block.
+
+        :return: (True for the rows to write, the last row of a key repeated in the batch;
+            key -> block number of its stored row, for the keys whose row must be replaced)
+        """
+        keys = [_event_key(tx_hash, log_index) for tx_hash, log_index in zip(tx_hashes, log_indexes)]
+        conn = self.conn
+        maybe = self._bloom().might_contain(keys)
+        stored = {}
+        candidates = [keys[i] for i in np.flatnonzero(maybe)]
+        for offset in range(0, len(candidates), 500):
+            part = candidates[offset:offset + 500]
+            rows = conn.execute("SELECT tx_hash, log_index, block_hash, block_number FROM seen_event "
+                                "WHERE tx_hash IN (%s)" % ",".join("?" * len(part)),
+                                [key[:32] for key in part]).fetchall()
+            stored.update((tx_hash + log_index.to_bytes(4, "big"), (block_hash, block_number))
+                          for tx_hash, log_index, block_hash, block_number in rows)
+
+        mask = np.zeros(len(keys), dtype=bool)
+        stale = {}
+        last = {key: i for i, key in enumerate(keys)}
+        for key, i in last.items():
+            if key not in stored:
+                mask[i] = True
+                continue
+            block_hash, block_number = stored[key]
+            if block_hash is not None and block_hash != _hash_bytes(block_hashes[i]):
+                mask[i] = True
+                stale[key] = block_number
+        return mask, stale
+
+    def put(self, tx_hashes: Sequence, log_indexes: Sequence[int], block_hashes: Sequence,
+            block_numbers: Sequence[int]):
+        """Remember keys once their rows are written, moving the keys seen before to their new block."""
+        keys = [_event_key(tx_hash, log_index) for tx_hash, log_index in zip(tx_hashes, log_indexes)]
+        rows = [(key[:32], int.from_bytes(key[32:], "big"), _hash_bytes(block_hash), int(block_number))
+                for key, block_hash, block_number in zip(keys, block_hashes, block_numbers)]
+        bloom = self._bloom()
+        conn = self.conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO seen_event (tx_hash, log_index, block_hash, block_number) "
+                             "VALUES (?, ?, ?, ?)", rows)
+            added = conn.total_changes - before
+            conn.executemany("UPDATE seen_event SET block_hash = ?, block_number = ? "
+                             "WHERE tx_hash = ? AND log_index = ?",
+                             [(block_hash, block_number, tx_hash, log_index)
+                              for tx_hash, log_index, block_hash, block_number in rows])
+            total = self._meta("rows") + added
+            version = self._meta("version") + 1
+            self._set_meta(rows=total, version=version)
+        bloom.add(keys)
+        # Checkpoint: the file on disk now matches the database
+        bloom.flush()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._set_meta(bloom_version=version)
+        if total > bloom.capacity:
+            self.bloom = self._rebuild(2 * total)
+
+    def delete_since(self, block_number: int) -> int:
+        """Forget the keys of blocks from `block_number` on, so a rescan writes them again.
+
+        :return: Number of keys removed
+        """
+        conn = self.conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            current = self._meta("bloom_version") == self._meta("version")
+            removed = conn.execute("DELETE FROM seen_event WHERE block_number >= ?", (block_number,)).rowcount
+            version = self._meta("version") + 1
+            self._set_meta(rows=self._meta("rows") - removed, version=version)
+            if current:
+                # Removed keys stay set in the filter, a lookup in SQLite then finds them gone
+                self._set_meta(bloom_version=version)
+        return removed
+
+    def close(self):
+        if self.bloom is not None:
+            self.bloom.flush()
+            self.bloom = None
+
+
+class EventSink:
+    """Single writer for one output path, buffering rows and flushing in batches.
+        单个输出路径的唯一写入者，缓存记录并按批写出。
+
+    Output files are `<path>.parquet/part-NNNNN.parquet`, `<path>.arrows/part-NNNNN.arrows`
+    (one Arrow IPC stream per sink, a stream cannot be reopened for appending) and `<path>.csv`,
+    depending on `formats`.
+
+    Replacing or deleting rows rewrites the part files holding them, and the whole CSV file.
+    Rows are written before their keys, so a crash in between can still write new keys twice.
+    替换或删除记录时会重写包含这些记录的分片文件以及整个 CSV 文件。记录先于键写出，
+    因此两者之间的崩溃仍可能使新键重复写出。
+    """
+
+    def __init__(self, path: str, schema: Dict[str, str], formats: Iterable[str] = ("parquet",),
+                 flush_rows: int = 10000, overwrite: bool = True, dedup_key: Optional[Tuple[str, str]] = None,
+                 block_columns: Tuple[str, str] = ("BlockHash", "Blocknumber"), dedup_capacity: int = 1000000):
+        """
+        :param path: Output path without extension, e.g. 'date/df_Transaction_history__multi'
+        :param schema: Ordered column -> dtype, see `transfer_schema`
+        :param formats: Any of 'parquet', 'arrow', 'csv'
+        :param flush_rows: Write out after this many buffered rows
+        :param overwrite: Start new output files, otherwise append to what is already there
+        :param dedup_key: (transaction hash column, log index column): one row per key in this output,
+            the keys are kept in `<path>.dedup.sqlite`
+        :param block_columns: (block hash column, block number column) of a row, to tell a re-mined
+            transaction from a duplicate and to find the rows of `delete_since`
+        :param dedup_capacity: Fewest keys the Bloom filter of the dedup index is sized for, it grows
+            with the keys stored
+        """
+        self.path = path
+        self.schema = schema
+        self.formats = tuple(formats)
+        self.flush_rows = flush_rows
+        self.buffer = ColumnBuffer(schema)
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.rows_replaced = 0
+
+        self.dedup_key = tuple(dedup_key) if dedup_key else None
+        self.block_columns = tuple(block_columns)
+        self.dedup = None
+        if self.dedup_key:
+            missing = (set(self.dedup_key) | set(self.block_columns)) - set(schema)
+            if missing:
+                raise ValueError(f"Dedup key columns not in the schema: {missing}")
+            self.dedup = DedupIndex(self.path + ".dedup.sqlite", dedup_capacity)
+            if overwrite:
+                self.dedup.reset()
+
+        unknown = set(self.formats) - {"parquet", "arrow", "csv"}
+        if unknown:
+            raise ValueError(f"Unknown output formats: {unknown}")
+        if pa is None and {"parquet", "arrow"} & set(self.formats):
+            raise ImportError("pyarrow is needed for Parquet / Arrow IPC output, use formats=('csv',) without it")
+
+        self._arrow_writer = None
+        self._arrow_file = None
+        self._part = 0
+
+        if "parquet" in self.formats:
+            parquet_dir = self.path + ".parquet"
+            if overwrite and os.path.isdir(parquet_dir):
+                shutil.rmtree(parquet_dir)
+            os.makedirs(parquet_dir, exist_ok=True)
+            self._part = len(glob.glob(os.path.join(parquet_dir, "part-*.parquet")))
+
+        if "arrow" in self.formats:
+            arrow_dir = self.path + ".arrows"
+            if overwrite and os.path.isdir(arrow_dir):
+                shutil.rmtree(arrow_dir)
+            os.makedirs(arrow_dir, exist_ok=True)
+
+        if "csv" in self.formats and (overwrite or not os.path.exists(self.path + ".csv")):
+            with open(self.path + ".csv", "w", newline="") as f:
+                # Unnamed first column is the block timestamp index, as pandas wrote it before
+                csv.writer(f).writerow([""] + [name for name in schema if name != "Timestamp"])
+
+    def write(self, row: dict):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def write_many(self, rows: List[dict]):
+        for row in rows:
+            self.buffer.append(row)
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows to every output format."""
+        count = len(self.buffer)
+        if not count:
+            return
+
+        arrays = self.buffer.to_numpy()
+        if self.dedup is not None:
+            tx_column, index_column = self.dedup_key
+            hash_column, number_column = self.block_columns
+            new, stale = self.dedup.classify(arrays[tx_column], arrays[index_column], arrays[hash_column])
+            if stale:
+                # Re-mined in another block after a reorg: the old rows go, the new ones are written below
+                self._delete_rows(
+                    (tx_column, index_column),
+                    lambda columns: np.fromiter((_event_key(tx_hash, log_index) in stale for tx_hash, log_index
+                                                 in zip(columns[tx_column], columns[index_column])),
+                                                dtype=bool, count=len(columns[tx_column])),
+                    min(stale.values()))
+                self.rows_replaced += len(stale)
+                logger.info("Replacing %d rows of %s re-mined in another block", len(stale), self.path)
+            skipped = count - int(new.sum())
+            if skipped:
+                arrays = {name: values[new] for name, values in arrays.items()}
+                count -= skipped
+                self.rows_skipped += skipped
+                logger.debug("Skipped %d rows already written to %s", skipped, self.path)
+            if not count:
+                self.buffer.clear()
+                return
+
+        if "parquet" in self.formats or "arrow" in self.formats:
+            table = self.buffer.to_arrow(arrays)
+            if "parquet" in self.formats:
+                pq.write_table(table, os.path.join(self.path + ".parquet", f"part-{self._part:05d}.parquet"))
+                self._part += 1
+            if "arrow" in self.formats:
+                if self._arrow_writer is None:
+                    # An IPC stream cannot be reopened for appending, each sink writes a new part
+                    arrow_dir = self.path + ".arrows"
+                    part = len(glob.glob(os.path.join(arrow_dir, "part-*.arrows")))
+                    self._arrow_file = pa.OSFile(os.path.join(arrow_dir, f"part-{part:05d}.arrows"), "wb")
+                    self._arrow_writer = pa.ipc.new_stream(self._arrow_file, table.schema)
+                self._arrow_writer.write_table(table)
+
+        if "csv" in self.formats:
+            self.buffer.to_frame(arrays).to_csv(self.path + ".csv", mode="a", index=True, header=False)
+
+        if self.dedup is not None:
+            # Only after the rows are on disk, a crash in between writes them again rather than never
+            self.dedup.put(arrays[tx_column], arrays[index_column], arrays[hash_column], arrays[number_column])
+        self.rows_written += count
+        self.buffer.clear()
+        logger.debug("Flushed %d rows to %s", count, self.path)
+
+    def delete_since(self, block_number: int) -> int:
+        """Remove the rows of blocks from `block_number` on, e.g. of blocks a reorg may have replaced.
+
+        Buffered rows are flushed first. With `dedup_key` their keys are forgotten too, so a rescan
+        of those blocks writes them again.
+
+        :return: Number of rows removed
+        """
+        self.flush()
+        number_column = self.block_columns[1]
+        if number_column not in self.schema:
+            raise ValueError(f"Block number column {number_column} not in the schema")
+        if self.dedup is not None:
+            # Keys first: a crash in between leaves rows a rescan writes twice, never keys without rows
+            self.dedup.delete_since(block_number)
+        removed = self._delete_rows((number_column,), lambda columns: columns[number_column] >= block_number,
+                                    block_number)
+        logger.info("Deleted %d rows of %s from block %d on", removed, self.path, block_number)
+        return removed
+
+    def _delete_rows(self, columns: Sequence[str], drop: Callable[[Dict[str, np.ndarray]], np.ndarray],
+                     min_block: int) -> int:
+        """Rewrite the output files without the rows selected by `drop`.
+
+        :param columns: Columns `drop` looks at, only these are read to find the rows
+        :param drop: True for the rows to remove, given a batch of rows as column arrays
+        :param min_block: No row to remove is in an earlier block, Parquet parts before it are skipped
+        :return: Number of rows removed
+        """
+        removed = 0
+        number_column = self.block_columns[1]
+
+        if "parquet" in self.formats:
+            count = 0
+            for part in sorted(glob.glob(os.path.join(self.path + ".parquet", "part-*.parquet"))):
+                last_block = _parquet_max(part, number_column)
+                if last_block is not None and last_block < min_block:
+                    continue
+                mask = drop(_table_columns(pq.read_table(part, columns=list(columns))))
+                if mask.any():
+                    pq.write_table(pq.read_table(part).filter(pa.array(~mask)), part + ".tmp")
+                    os.replace(part + ".tmp", part)
+                    count += int(mask.sum())
+            removed = max(removed, count)
+
+        if "arrow" in self.formats:
+            if self._arrow_writer is not None:
+                # The open part is rewritten as well, later rows go to a new part
+                self._arrow_writer.close()
+                self._arrow_file.close()
+                self._arrow_writer = self._arrow_file = None
+            count = 0
+            for part in sorted(glob.glob(os.path.join(self.path + ".arrows", "part-*.arrows"))):
+                with pa.OSFile(part, "rb") as f:
+                    table = pa.ipc.open_stream(f).read_all()
+                mask = drop(_table_columns(table.select(list(columns))))
+                if mask.any():
+                    table = table.filter(pa.array(~mask))
+                    with pa.OSFile(part + ".tmp", "wb") as f, pa.ipc.new_stream(f, table.schema) as writer:
+                        writer.write_table(table)
+                    os.replace(part + ".tmp", part)
+                    count += int(mask.sum())
+            removed = max(removed, count)
+
+        if "csv" in self.formats:
+            count = 0
+            path = self.path + ".csv"
+            # The unnamed first column is the block timestamp
+            header = ["Timestamp"] + [name for name in self.schema if name != "Timestamp"]
+            positions = {name: header.index(name) for name in columns}
+            with open(path, newline="") as src, open(path + ".tmp", "w", newline="") as dst:
+                reader, writer = csv.reader(src), csv.writer(dst)
+                writer.writerow(next(reader))
+                while True:
+                    rows = list(islice(reader, 100000))
+                    if not rows:
+                        break
+                    batch = {}
+                    for name, position in positions.items():
+                        values = np.array([row[position] for row in rows], dtype=object)
+                        dtype = self.schema[name]
+                        # pandas writes float columns as '1.0', parse through float for int columns
+                        batch[name] = values if dtype == "string" else values.astype(np.float64).astype(dtype)
+                    mask = drop(batch)
+                    writer.writerows(row for row, dropped in zip(rows, mask) if not dropped)
+                    count += int(mask.sum())
+            if count:
+                os.replace(path + ".tmp", path)
+            else:
+                os.remove(path + ".tmp")
+            removed = max(removed, count)
+
+        return removed
+
+    def close(self):
+        self.flush()
+        if self.dedup is not None:
+            self.dedup.close()
+        if self._arrow_writer is not None:
+            self._arrow_writer.close()
+        if self._arrow_file is not None:
+            self._arrow_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _parquet_max(path: str, column: str) -> Optional[int]:
+    """Largest value of `column` in a Parquet file by its statistics, None if they are missing."""
+    metadata = pq.ParquetFile(path).metadata
+    index = metadata.schema.to_arrow_schema().get_field_index(column)
+    maxima = []
+    for group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(group).column(index).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+        maxima.append(statistics.max)
+    return max(maxima, default=None)
+
+
+def _table_columns(table: "pa.Table") -> Dict[str, np.ndarray]:
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+class QueueSink:
+    """Worker-side sink that forwards batches of rows to a `SinkWriterProcess`.
+        子进程端的输出，把批量记录转发给 `SinkWriterProcess`。
+    """
+
+    def __init__(self, queue, batch_rows: int = 500):
+        self.queue = queue
+        self.batch_rows = batch_rows
+        self.rows = []
+
+    def write(self, row: dict):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Send buffered rows to the writer, call at the end of every Pool task."""
+        if self.rows:
+            self.queue.put(self.rows)
+            self.rows = []
+
+    def discard(self):
+        """Drop the rows not sent yet, e.g. of a failed task that will be retried."""
+        self.rows = []
+
+
+def _sink_writer_main(queue, path, schema, formats, flush_rows, dedup_key, dedup_capacity):
+    sink = EventSink(path, schema, formats, flush_rows, overwrite=False, dedup_key=dedup_key,
+                     dedup_capacity=dedup_capacity)
+    try:
+        while True:
+            rows = queue.get()
+            if rows is None:
+                break
+            sink.write_many(rows)
+    finally:
+        sink.close()
+
+
+class SinkWriterProcess:
+    """Dedicated process that owns the output files of a multiprocess scan.
+        多进程扫描中独占输出文件的写入进程。
+
+    Usage::
+
+        writer = SinkWriterProcess('date/df_Transaction_history__multi', schema)
+        p = Pool(12, initializer=initWorker, initargs=(writer.queue,))
+        ...
+        p.join()
+        writer.close()
+    """
+
+    def __init__(self, path: str, schema: Dict[str, str], formats: Iterable[str] = ("parquet",),
+                 flush_rows: int = 10000, queue_size: int = 1000, overwrite: bool = True,
+                 dedup_key: Optional[Tuple[str, str]] = None, dedup_capacity: int = 1000000):
+        """
+        :param overwrite: Start new output files, False appends to them, e.g. when resuming a backfill
+        :param dedup_key: One row per (transaction hash, log index), see `EventSink`
+        """
+        # Create (truncate) the outputs once here, the writer process then appends
+        EventSink(path, schema, formats, flush_rows, overwrite=overwrite, dedup_key=dedup_key,
+                  dedup_capacity=dedup_capacity).close()
+        self.queue = multiprocessing.Queue(maxsize=queue_size)
+        self.process = multiprocessing.Process(target=_sink_writer_main,
+                                               args=(self.queue, path, schema, tuple(formats), flush_rows,
+                                                     dedup_key, dedup_capacity),
+                                               daemon=True)
+        self.process.start()
+
+    def client(self, batch_rows: int = 500) -> QueueSink:
+        return QueueSink(self.queue, batch_rows)
+
+    def close(self, timeout: Optional[float] = None):
+        """Flush everything to disk and stop the writer process."""
+        self.queue.put(None)
+        self.process.join(timeout)
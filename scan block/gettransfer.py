@@ -7,58 +7,49 @@ import multiprocessing
 import datetime
 from datetime import timedelta
 from tqdm import tqdm
-import pandas as pd
 import numpy as np
 # from tqdm._tqdm import trange
 from multiprocessing import Pool
+from deployblock import DeploymentBlockCache
+from eventsink import EventSink, transfer_schema
+from eventscanner import scan_contract_events
+from rpcpool import get_web3
+from txcache import TransactionCache
 import datetime
+import sys
 import time
+import atexit
 
 
 # import mplfinance as mpf
 
-def get_trans_info(i, j):
-    try:
-        contract_address = token_contract_set[j]
-        event_template = contract_address.events.Transfer
-        if i != iteration_num:
-            filter = event_template.createFilter(fromBlock=hex(int(i * Block_internal)),
-                                                 toBlock=hex(int((i + 1) * Block_internal - 1)))
-        else:
-            filter = event_template.createFilter(fromBlock=hex(int(i * Block_internal)),
-                                                 toBlock='latest')
-        events = filter.get_all_entries()
-        print('events number', len(events))
-        if len(events) == 0:
-            return False
-        else:
-            for event in events:
-                transactionHash = event.transactionHash
-                transfer_info = w3.eth.get_transaction(transactionHash)
-                Tx_Fee = transfer_info.value
-                Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                block_num = event.blockNumber
-                block_timestamp = w3.eth.getBlock(block_num).timestamp
-                block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
-                datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
-                print('交易时间为：', datatimestr)
-
-                nft_tr_info = pd.DataFrame({
-                    'Datetime': datatimestr,
-                    'ContractAddress': contract_address.address,
-                    'TokenId': event.args.tokenId,
-                    'From Address': transfer_info['from'],
-                    'To Address': transfer_info.to,
-                    'Value': Tx_Fee,
-                    'BlockHash': transfer_info.blockHash.hex(),
-                    'Blocknumber': block_num,
-                    'TransactionHash': transactionHash.hex(),
-                    'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
-                    'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))}, index=[block_timestamp])
-                nft_tr_info.to_csv('date/df_Transaction_history.csv', mode='a', index=True, header=False)
-            return True
-    except Exception as e:
-        print(e)
+def write_transfer_events(events):
+    # 把一个合约在一个区块范围内的Transfer事件写入输出
+    for event in events:
+        transactionHash = event.transactionHash
+        transfer_info = txCache.get_transaction(transactionHash)     # main中已经按区块范围批量获取
+        Tx_Fee = transfer_info.value
+        Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
+        block_num = event.blockNumber
+        block_timestamp = w3.eth.getBlock(block_num).timestamp
+        block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
+        datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
+        print('交易时间为：', datatimestr)
+
+        transferSink.write({
+            'Timestamp': block_timestamp,
+            'Datetime': datatimestr,
+            'ContractAddress': event.address,
+            'TokenId': event.args.tokenId,
+            'From Address': transfer_info['from'],
+            'To Address': transfer_info.to,
+            'Value': Tx_Fee,
+            'BlockHash': event.blockHash.hex(),      # 取自日志，缓存的交易在区块重组后可能还是旧的区块哈希
+            'Blocknumber': block_num,
+            'LogIndex': event.logIndex,
+            'TransactionHash': transactionHash.hex(),
+            'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
+            'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))})
 
 
 '''
@@ -73,25 +64,18 @@ def err_call_back(err):
 
 
 def main():
-    nft_collection_number = 0
-    ERC_Standard = '721'
-    # processes=12
-    # pool = multiprocessing.Pool(processes=4)
-    # 想办法使用多个线程，每个alchemy节点都可以开一个单独的线程，然后每个线程负责一个nft合约的扫描
-    for j in range(len(token_contract_set)):
-        print('合约地址为：', token_contract_set[j].address)
-        # contract_totalId_number = contract_address.functions.totalSupply().call()
-        for i in range(iteration_num, -1, -1):
-            print("====================================================")
-            print(i)
-
-            x = get_trans_info(i, j)
-            if not x:
-                print('该交易历史回溯结束，进入下一个合约...')
-                break
-    # pool.close()
-    # pool.join()
-
+    # 只扫描一次区块链：每个区块范围只用一次eth_getLogs同时获取所有合约的Transfer事件，再按合约地址分发
+    # 不再对每个合约单独从最新区块往回扫描，也不会因为某个区块范围没有事件就提前结束
+    event_template = w3.eth.contract(abi=abi_721).events.Transfer
+    for chunk_start, chunk_end, events_by_contract in scan_contract_events(
+            w3, event_template, token_address_set, start_block, now_block_number, chunk_size=int(Block_internal)):
+        print("====================================================")
+        print(chunk_start, chunk_end)
+        # 一个区块范围内的交易只获取一次：同一笔批量转移交易的几百个Transfer事件共用一次查询
+        txCache.prefetch(event.transactionHash for events in events_by_contract.values() for event in events)
+        for contract_address, events in events_by_contract.items():
+            print('合约地址为：', contract_address, 'events number', len(events))
+            write_transfer_events(events)
 
 
 if __name__ == '__main__':
@@ -112,14 +96,13 @@ if __name__ == '__main__':
     ERC721InterfaceId = '0x80ac58cd'
     ERC1155InterfaceId = '0xd9b67a26'
 
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[1]))
+    w3 = get_web3(alchemy_url_set)     # 节点池：长连接、按节点限速，429/5xx时切换节点
+    txCache = TransactionCache.from_web3(w3)    # 交易缓存：内存LRU + 磁盘SQLite，按交易哈希去重
     # w3 = Web3(Web3.WebsocketProvider(alchemy_wss_url))
     print("节点是否可连接：", w3.isConnected())
 
     now_block_number = w3.eth.get_block('latest').number
     Block_internal = 1e4
-    iteration_num = int(now_block_number // Block_internal)
-
     token_address_set = ['0x2438a0eeffa36cb738727953d35047fb89c81417',
                          '0xeb4e856f69158052ac0aaf7dc26f63dcb1ee067f',
                          '0xba627f3d081cc97ac0edc40591eda7053ac63532',
@@ -139,11 +122,23 @@ if __name__ == '__main__':
             token_contract_set.append(contract)
 
     print(token_contract_set)       # token_address_set里面5个地址，token_contract_set里面只有四个，是因为第一个地址"0x2438a0eeffa36cb738727953d35047fb89c81417"是erc1155的协议
-
-    df_Transaction_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'TokenId',
-                                                   'From Address', 'To Address', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice'])
-    df_Transaction_history.to_csv('date/df_Transaction_history.csv')
+    token_address_set = [contract.address for contract in token_contract_set]     # 只扫描ERC721合约
+
+    # 二分查找eth_getCode得到每个合约的部署区块（结果缓存），从最早的部署区块向后扫描到当前区块，而不是从创世区块开始
+    deploymentBlocks = DeploymentBlockCache.from_web3(w3).get_many(token_address_set, now_block_number)
+    print("部署区块", deploymentBlocks)
+    if all(block is None for block in deploymentBlocks.values()):
+        # 没有ERC721合约，或者这些地址在当前区块还没有代码（还没有部署）
+        sys.exit("没有已部署的ERC721合约可以扫描: %s" % token_address_set)
+    start_block = min(block for block in deploymentBlocks.values() if block is not None)
+
+    # 记录先缓存在内存中，按批写入Parquet和CSV
+    transfer_columns = ['Datetime', 'ContractAddress', 'TokenId',
+                        'From Address', 'To Address', 'Value', 'BlockHash',
+                        'Blocknumber', 'LogIndex', 'TransactionHash', 'Gas', 'Gasprice']
+    transferSink = EventSink('date/df_Transaction_history', transfer_schema(transfer_columns),
+                             formats=('parquet', 'csv'), dedup_key=('TransactionHash', 'LogIndex'))
+    atexit.register(transferSink.close)     # 正常结束或Ctrl+C退出时把缓存的记录写出
 
     main()
 
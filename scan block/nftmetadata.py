@@ -0,0 +1,232 @@
+"""Batched, cached ERC-721 metadata: name, symbol, tokenURI and balanceOf.
+    批量获取并缓存 ERC-721 元数据：name、symbol、tokenURI 和 balanceOf。
+
+Every output row used to cost four `eth_call`s, although name and symbol are the same
+for every row of a contract. Here name and symbol are resolved once per contract and
+tokenURI once per (contract, tokenId), both kept in SQLite across processes and runs.
+balanceOf is evaluated at the block of the event instead of `latest`, so the answer
+never changes and can be cached as well. Callers hand over the rows they are about to
+write, and all misses go out as one JSON-RPC batch of `eth_call`s.
+以前每行输出需要四次 `eth_call`，而同一个合约的所有行 name 和 symbol 都相同。现在 name 和 symbol
+每个合约只查询一次，tokenURI 每个 (合约, tokenId) 只查询一次，都保存在 SQLite 中，多进程和多次运行共用。
+balanceOf 按事件所在区块查询而不是 `latest`，结果不会变化，因此也可以缓存。
+调用方先提交即将写出的记录，所有未命中的调用通过一次 JSON-RPC 批量请求发出。
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from eth_abi import decode_abi, encode_single
+
+from contractcache import _ProcessLocalSQLite
+from rpcbatch import BatchRPC, BatchRPCError
+
+
+logger = logging.getLogger(__name__)
+
+NAME_SELECTOR = "0x06fdde03"
+SYMBOL_SELECTOR = "0x95d89b41"
+TOKEN_URI_SELECTOR = "0xc87b56dd"
+BALANCE_OF_SELECTOR = "0x70a08231"
+
+
+def _decode_string(result: str) -> Optional[str]:
+    """ABI string return value, or a bytes32 as some early tokens return for name and symbol."""
+    data = bytes.fromhex(result[2:])
+    if not data:
+        return None
+    try:
+        return decode_abi(["string"], data)[0]
+    except Exception:
+        if len(data) == 32:
+            return data.rstrip(b"\0").decode("utf-8", errors="replace")
+        return None
+
+
+def _decode_uint(result: str) -> Optional[int]:
+    return int(result, 16) if len(result) > 2 else None
+
+
+class NFTMetadata(_ProcessLocalSQLite):
+    """Name / symbol per contract, tokenURI per token and balanceOf per (owner, block), fetched in batches.
+        每个合约的 name / symbol、每个 token 的 tokenURI 以及每个 (持有人, 区块) 的 balanceOf，按批获取。
+
+    Calls that revert or return nothing (e.g. tokenURI of a burned token) are cached as None.
+    Calls that fail for a transient reason (rate limit, timeout) are not cached: the answers
+    of the rest of the batch are kept, then the first such error is raised, so the caller
+    retries instead of writing None.
+
+    Usage::
+
+        metadata = NFTMetadata.from_web3(w3)
+        metadata.prefetch([(contract, token_id, owner, block_number) for ...])
+        metadata.name(contract), metadata.token_uri(contract, token_id)
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS contract_metadata (
+            address TEXT PRIMARY KEY,
+            name TEXT,
+            symbol TEXT
+        );
+        CREATE TABLE IF NOT EXISTS token_uri (
+            address TEXT NOT NULL,
+            token_id TEXT NOT NULL,
+            uri TEXT,
+            PRIMARY KEY (address, token_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, rpc: BatchRPC, fname: str = "date/nft_metadata.sqlite", maxsize: int = 100000,
+                 timeout: float = 30.0):
+        """
+        :param rpc: Batch client the `eth_call`s are sent with
+        :param fname: SQLite file shared by all scanner processes
+        :param maxsize: How many token URIs and balances each we keep in memory
+        """
+        super().__init__(fname, timeout)
+        self.rpc = rpc
+        self.maxsize = maxsize
+        self.contracts = {}
+        self.token_uris = OrderedDict()
+        # Balances only live in memory, they are keyed by block and rarely asked twice across runs
+        self.balances = OrderedDict()
+
+    @classmethod
+    def from_web3(cls, w3, **kwargs) -> "NFTMetadata":
+        """Metadata client on the same endpoint (or endpoint pool) as the Web3 provider."""
+        return cls(BatchRPC.from_web3(w3), **kwargs)
+
+    def connected(self):
+        self.contracts = {}
+        self.token_uris = OrderedDict()
+        self.balances = OrderedDict()
+
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def _load_contracts(self, addresses: List[str]) -> List[str]:
+        """Move contracts found on disk to memory, return the ones still missing."""
+        for offset in range(0, len(addresses), 500):
+            part = addresses[offset:offset + 500]
+            for address, name, symbol in self.conn.execute(
+                    "SELECT address, name, symbol FROM contract_metadata WHERE address IN (%s)"
+                    % ",".join("?" * len(part)), part):
+                self.contracts[address] = (name, symbol)
+        return [address for address in addresses if address not in self.contracts]
+
+    def _load_token_uris(self, tokens: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+        """Move token URIs found on disk to memory, return the tokens still missing."""
+        for offset in range(0, len(tokens), 250):
+            part = tokens[offset:offset + 250]
+            for address, token_id, uri in self.conn.execute(
+                    "SELECT address, token_id, uri FROM token_uri WHERE (address, token_id) IN (VALUES %s)"
+                    % ",".join(["(?, ?)"] * len(part)),
+                    [value for address, token_id in part for value in (address, str(token_id))]):
+                self._remember(self.token_uris, (address, int(token_id)), uri)
+        return [token for token in tokens if token not in self.token_uris]
+
+    def prefetch(self, transfers: Iterable[Tuple[str, int, Optional[str], Optional[int]]]):
+        """Make sure the metadata of the rows about to be written is cached, one batch for all misses.
+
+        :param transfers: (contract, tokenId, owner, block number) per row, owner and block may be None
+            when the row needs no balanceOf
+        :raise BatchRPCError: A call failed for a transient reason
+        """
+        addresses, tokens, balances = {}, {}, {}
+        for contract, token_id, owner, block_number in transfers:
+            contract = contract.lower()
+            addresses[contract] = None
+            tokens[(contract, token_id)] = None
+            if owner is not None and block_number is not None:
+                balances[(contract, owner.lower(), block_number)] = None
+        self._fetch_missing(list(addresses), list(tokens), list(balances))
+
+    def _fetch_missing(self, addresses: List[str], tokens: List[Tuple[str, int]],
+                       balances: List[Tuple[str, str, int]]):
+        missing_contracts = self._load_contracts([a for a in addresses if a not in self.contracts])
+        missing_tokens = self._load_token_uris([t for t in tokens if t not in self.token_uris])
+        missing_balances = [b for b in balances if b not in self.balances]
+
+        calls, targets = [], []
+        for address in missing_contracts:
+            calls += [("eth_call", [{"to": address, "data": NAME_SELECTOR}, "latest"]),
+                      ("eth_call", [{"to": address, "data": SYMBOL_SELECTOR}, "latest"])]
+            targets += [("name", address), ("symbol", address)]
+        for address, token_id in missing_tokens:
+            data = TOKEN_URI_SELECTOR + encode_single("uint256", token_id).hex()
+            calls.append(("eth_call", [{"to": address, "data": data}, "latest"]))
+            targets.append(("token_uri", (address, token_id)))
+        for address, owner, block_number in missing_balances:
+            data = BALANCE_OF_SELECTOR + owner[2:].rjust(64, "0")
+            calls.append(("eth_call", [{"to": address, "data": data}, hex(block_number)]))
+            targets.append(("balance", (address, owner, block_number)))
+        if not calls:
+            return
+
+        logger.debug("Fetching metadata of %d contracts, %d tokens and %d balances in one batch",
+                     len(missing_contracts), len(missing_tokens), len(missing_balances))
+        results = self.rpc.batch(calls, raise_on_error=False)
+
+        names, token_rows, errors = {}, [], []
+        for (kind, key), result in zip(targets, results):
+            if isinstance(result, BatchRPCError):
+                # A revert is an answer, anything else (rate limit, timeout) is raised below and tried again
+                if result.code != 3 and "revert" not in str(result.error).lower():
+                    logger.info("%s of %s failed: %s", kind, key, result.error)
+                    errors.append(result)
+                    continue
+                result = "0x"
+            if kind in ("name", "symbol"):
+                names.setdefault(key, {})[kind] = _decode_string(result)
+            elif kind == "token_uri":
+                uri = _decode_string(result)
+                self._remember(self.token_uris, key, uri)
+                token_rows.append((key[0], str(key[1]), uri))
+            else:
+                self._remember(self.balances, key, _decode_uint(result))
+
+        contract_rows = [(address, value["name"], value["symbol"]) for address, value in names.items()
+                         if "name" in value and "symbol" in value]
+        for address, name, symbol in contract_rows:
+            self.contracts[address] = (name, symbol)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("INSERT OR REPLACE INTO contract_metadata (address, name, symbol) VALUES (?, ?, ?)",
+                                  contract_rows)
+            self.conn.executemany("INSERT OR REPLACE INTO token_uri (address, token_id, uri) VALUES (?, ?, ?)",
+                                  token_rows)
+        if errors:
+            raise errors[0]
+
+    def _contract(self, contract: str) -> Tuple[Optional[str], Optional[str]]:
+        contract = contract.lower()
+        if contract not in self.contracts:
+            self._fetch_missing([contract], [], [])
+        return self.contracts.get(contract, (None, None))
+
+    def name(self, contract: str) -> Optional[str]:
+        """name() of a contract, None if it has none."""
+        return self._contract(contract)[0]
+
+    def symbol(self, contract: str) -> Optional[str]:
+        """symbol() of a contract, None if it has none."""
+        return self._contract(contract)[1]
+
+    def token_uri(self, contract: str, token_id: int) -> Optional[str]:
+        """tokenURI(tokenId), None if the call reverts, e.g. for a burned token."""
+        key = (contract.lower(), token_id)
+        if key not in self.token_uris:
+            self._fetch_missing([], [key], [])
+        return self.token_uris.get(key)
+
+    def balance_of(self, contract: str, owner: str, block_number: int) -> Optional[int]:
+        """balanceOf(owner) right after the block of the event."""
+        key = (contract.lower(), owner.lower(), block_number)
+        if key not in self.balances:
+            self._fetch_missing([], [], [key])
+        return self.balances.get(key)
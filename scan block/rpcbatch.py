@@ -0,0 +1,257 @@
+"""Batched JSON-RPC client for Ethereum nodes.
+    以太坊节点的批量 JSON-RPC 客户端。
+
+Web3.py sends every call as its own HTTP request, so scanning one block costs
+one `eth_getTransactionReceipt` and one `eth_getCode` round trip per transaction.
+This module packs many calls into a single JSON-RPC batch request and uses
+`eth_getBlockReceipts` when the node supports it.
+Web3.py 每次调用都会单独发送一个 HTTP 请求，扫描一个区块时每笔交易都需要一次收据请求和一次 get_code 请求。
+本模块把多个调用打包成一个 JSON-RPC 批量请求，节点支持时直接使用 `eth_getBlockReceipts`。
+
+The client only needs an endpoint URL, so it can be pointed at a local stub server.
+客户端只需要一个节点地址，因此可以直接对本地的 JSON-RPC 桩服务器进行测试。
+"""
+
+import asyncio
+import itertools
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+logger = logging.getLogger(__name__)
+
+# Result placeholder for batch items the node did not answer
+_MISSING = object()
+
+
+class BatchRPCError(Exception):
+    """A JSON-RPC call returned an error object instead of a result."""
+
+    def __init__(self, method: str, params: Any, error: Any):
+        self.method = method
+        self.params = params
+        self.error = error
+        self.code = error.get("code") if isinstance(error, dict) else None
+        super().__init__(f"{method} {params} failed: {error}")
+
+
+def _method_unsupported(error: Any) -> bool:
+    """True if a JSON-RPC error object says the node does not know the method, as opposed to failing this one call."""
+    code = error.get("code") if isinstance(error, dict) else None
+    message = str(error).lower()
+    return code == -32601 or "method not found" in message or "not supported" in message \
+        or "does not exist" in message or "not available" in message
+
+
+def to_block_param(block_identifier: Union[int, str]) -> str:
+    """Convert a block number to the hex quantity JSON-RPC expects, pass tags such as 'latest' through."""
+    if isinstance(block_identifier, int):
+        return hex(block_identifier)
+    return block_identifier
+
+
+class BatchRPC:
+    """Send many JSON-RPC calls in as few HTTP requests as possible.
+        用尽可能少的 HTTP 请求发送大量 JSON-RPC 调用。
+
+    Results are returned as raw JSON values (hex strings and dicts), not Web3 AttributeDicts.
+    返回值是原始 JSON 数据（十六进制字符串和字典），不是 Web3 的 AttributeDict。
+    """
+
+    def __init__(self, endpoint_uri: Optional[str] = None, session: Optional[requests.Session] = None,
+                 max_batch_size: int = 100, timeout: float = 30.0, pool=None):
+        """
+        :param endpoint_uri: HTTP(S) URL of the JSON-RPC node
+        :param session: Reuse an existing keep-alive session, a new one is created if not given
+        :param max_batch_size: How many calls we pack into one HTTP request (Alchemy accepts up to 1000)
+        :param timeout: HTTP timeout in seconds for one batch request
+        :param pool: `rpcpool.EndpointPool` to send through instead of one endpoint,
+            with its rate limits and failover
+        """
+        assert endpoint_uri is not None or pool is not None, "Need either an endpoint URL or an EndpointPool"
+        self.endpoint_uri = endpoint_uri or ",".join(pool.urls)
+        self.pool = pool
+        self.session = session or requests.Session()
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+
+        # None until we have tried eth_getBlockReceipts once against this node.
+        # Not used with a pool: the pool tracks the methods each endpoint lacks, and answers
+        # "method not found" only when no endpoint has the method
+        self.supports_block_receipts = None
+
+    @classmethod
+    def from_web3(cls, w3, **kwargs) -> "BatchRPC":
+        """Create a batch client that talks to the same endpoint (or endpoint pool) as the Web3 provider."""
+        pool = getattr(w3.provider, "pool", None)
+        if pool is not None:
+            return cls(pool=pool, **kwargs)
+        return cls(w3.provider.endpoint_uri, **kwargs)
+
+    def _post(self, payload) -> Any:
+        if self.pool is not None:
+            return self.pool.post(payload)
+        response = self.session.post(self.endpoint_uri, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def call(self, method: str, params: list) -> Any:
+        """Make a single JSON-RPC call."""
+        return self.batch([(method, params)])[0]
+
+    def batch(self, calls: List[Tuple[str, list]], raise_on_error: bool = True) -> List[Any]:
+        """Make many JSON-RPC calls and return their results in the same order.
+
+        :param calls: List of (method, params) tuples
+        :param raise_on_error: Raise BatchRPCError on the first failed call.
+            If False, a failed call puts its BatchRPCError in the result list instead.
+        """
+        results = []
+        for offset in range(0, len(calls), self.max_batch_size):
+            part = calls[offset:offset + self.max_batch_size]
+            payload = [{"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params}
+                       for method, params in part]
+            position = {request["id"]: n for n, request in enumerate(payload)}
+
+            response = self._post(payload)
+            if isinstance(response, dict):
+                # Some nodes answer a rejected batch (e.g. too large) with one error object
+                raise BatchRPCError("batch", f"{len(part)} calls", response.get("error", response))
+
+            ordered = [_MISSING] * len(part)
+            for item in response:
+                n = position.get(item.get("id"))
+                if n is None:
+                    continue
+                if "error" in item:
+                    ordered[n] = BatchRPCError(part[n][0], part[n][1], item["error"])
+                else:
+                    ordered[n] = item.get("result")
+
+            for n, result in enumerate(ordered):
+                if result is _MISSING:
+                    ordered[n] = result = BatchRPCError(part[n][0], part[n][1], "no response in batch")
+                if raise_on_error and isinstance(result, BatchRPCError):
+                    raise result
+            results.extend(ordered)
+        return results
+
+    def get_block(self, block_identifier: Union[int, str], full_transactions: bool = False) -> dict:
+        """eth_getBlockByNumber"""
+        return self.call("eth_getBlockByNumber", [to_block_param(block_identifier), full_transactions])
+
+    def get_block_receipts(self, block_number: int, tx_hashes: Optional[List[str]] = None) -> List[dict]:
+        """Get all transaction receipts of a block.
+
+        Uses `eth_getBlockReceipts` (one call) when the node supports it,
+        otherwise one batch of `eth_getTransactionReceipt` calls.
+        优先使用 `eth_getBlockReceipts` 一次取回整个区块的收据，节点不支持时退回到一次批量的 `eth_getTransactionReceipt`。
+
+        :param tx_hashes: Transaction hashes of the block if the caller already has them,
+            saves one `eth_getBlockByNumber` call on the fallback path
+        :raise BatchRPCError: The node does not know the block (yet), or a call failed
+        """
+        single = self.pool is None
+        if not (single and self.supports_block_receipts is False):
+            try:
+                receipts = self.call("eth_getBlockReceipts", [to_block_param(block_number)])
+            except BatchRPCError as e:
+                # Only a node without the method falls back, rate limits and timeouts are raised
+                if not _method_unsupported(e.error) or (single and self.supports_block_receipts):
+                    raise
+                if single:
+                    logger.info("eth_getBlockReceipts not supported by %s, falling back to batched receipts: %s",
+                                self.endpoint_uri, e.error)
+                    self.supports_block_receipts = False
+            else:
+                if single:
+                    self.supports_block_receipts = True
+                if receipts is None:
+                    raise BatchRPCError("eth_getBlockReceipts", [to_block_param(block_number)], "unknown block")
+                return receipts
+
+        if tx_hashes is None:
+            block = self.get_block(block_number)
+            if block is None:
+                raise BatchRPCError("eth_getBlockByNumber", [to_block_param(block_number)], "unknown block")
+            tx_hashes = block["transactions"]
+        receipts = self.batch([("eth_getTransactionReceipt", [tx_hash]) for tx_hash in tx_hashes])
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            if receipt is None:
+                raise BatchRPCError("eth_getTransactionReceipt", [tx_hash], "unknown transaction")
+        return receipts
+
+    def get_codes(self, addresses: Iterable[str], block_identifier: Union[int, str] = "latest") -> Dict[str, str]:
+        """eth_getCode for many addresses in one batch.
+
+        :return: Map of address -> bytecode hex string ("0x" for externally owned accounts)
+        """
+        addresses = list(dict.fromkeys(addresses))
+        block_param = to_block_param(block_identifier)
+        codes = self.batch([("eth_getCode", [address, block_param]) for address in addresses])
+        return dict(zip(addresses, codes))
+
+
+class AsyncRPC:
+    """Asyncio JSON-RPC client keeping many requests in flight on one event loop.
+        在一个事件循环上同时发出多个请求的 asyncio JSON-RPC 客户端。
+
+    At most `max_concurrency` requests are in flight at a time. Needs aiohttp.
+
+    Usage::
+
+        async with AsyncRPC(url, max_concurrency=16) as rpc:
+            logs = await rpc.call("eth_getLogs", [params])
+    """
+
+    def __init__(self, endpoint_uri: str, max_concurrency: int = 8, timeout: float = 30.0):
+        """
+        :param endpoint_uri: HTTP(S) URL of the JSON-RPC node
+        :param max_concurrency: How many HTTP requests we have in flight at most
+        :param timeout: HTTP timeout in seconds for one request
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is needed for AsyncRPC")
+        self.endpoint_uri = endpoint_uri
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self) -> "AsyncRPC":
+        # One keep-alive connection per concurrent request
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.session = None
+
+    async def _post(self, payload) -> Any:
+        async with self.semaphore:
+            async with self.session.post(self.endpoint_uri, json=payload) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def call(self, method: str, params: list) -> Any:
+        """Make a single JSON-RPC call."""
+        response = await self._post({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params})
+        if "error" in response:
+            raise BatchRPCError(method, params, response["error"])
+        return response.get("result")
+
+    async def gather(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        """Make many JSON-RPC calls concurrently and return their results in the same order."""
+        return await asyncio.gather(*(self.call(method, params) for method, params in calls))
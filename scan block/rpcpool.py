@@ -0,0 +1,328 @@
+"""Shared, rate-limited pool of JSON-RPC endpoints.
+    共享的、带限速的 JSON-RPC 节点池。
+
+One `EndpointPool` per process keeps a keep-alive `requests.Session` per endpoint,
+so consecutive calls reuse the same TLS connection. Every endpoint has a token bucket
+for its request rate. Each request goes to the healthy endpoint with the lowest latency
+and load, and fails over to the next one on a 429, a 5xx or a connection error.
+每个进程一个 `EndpointPool`，每个节点保持一个长连接 `requests.Session`，连续调用复用同一个 TLS 连接。
+每个节点有自己的令牌桶限速。请求发往健康、延迟和负载最低的节点，遇到 429、5xx 或连接错误时切换到下一个节点。
+
+`PooledHTTPProvider` plugs the pool into Web3, and `BatchRPC.from_web3` picks it up,
+so `EventScanner`, its block header cache and the block scanners all share it::
+
+    w3 = get_web3(ALCHEMY_URL_SET)
+
+Consecutive calls may go to different endpoints, so the scanners read logs with
+`eth_getLogs` instead of `eth_newFilter` / `eth_getFilterLogs`: a filter only exists on
+the node that created it.
+连续的调用可能发往不同的节点，因此扫描程序使用 `eth_getLogs` 读取日志，而不是 `eth_newFilter` / `eth_getFilterLogs`：
+过滤器只存在于创建它的节点上。
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.providers.base import JSONBaseProvider
+
+from rpcbatch import _method_unsupported
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, `acquire` blocks until enough tokens are available.
+
+    A request larger than the bucket (a big batch) waits for a full bucket and then takes
+    all its tokens, leaving the bucket in debt, so later requests wait for the refill and
+    the average rate still holds.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        :param rate: Tokens added per second
+        :param capacity: Largest burst, defaults to one second worth of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        # More than the capacity can never be available at once, go into debt for the rest
+        needed = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Endpoint:
+    """One JSON-RPC endpoint with its session, rate limit and health."""
+
+    def __init__(self, url: str, requests_per_second: float, burst: Optional[float], pool_size: int):
+        self.url = url
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.pool_size = pool_size
+        self.session = self._new_session()
+        # Exponentially weighted moving average of the response time in seconds
+        self.latency = 0.0
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        # Methods this endpoint answered "method not found" to, e.g. eth_getBlockReceipts
+        self.unsupported = set()
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def score(self) -> float:
+        """Lower is better: expected wait behind the requests already in flight.
+
+        Endpoints without a measured latency score 0, so each one is tried early on.
+        """
+        return self.latency * (1 + self.in_flight)
+
+    def record_success(self, elapsed: float):
+        self.latency = elapsed if not self.latency else 0.8 * self.latency + 0.2 * elapsed
+        self.failures = 0
+
+    def record_failure(self, cooldown: float):
+        self.failures += 1
+        # Back off longer when the endpoint keeps failing
+        self.cooldown_until = time.monotonic() + cooldown * min(2 ** (self.failures - 1), 32)
+
+
+# JSON-RPC error codes and messages of rate limits answered with HTTP 200
+_RATE_LIMIT_CODES = (429, -32005, -32029, -32090)
+_RATE_LIMIT_MESSAGES = ("rate limit", "too many requests", "exceeded its compute units", "capacity limit",
+                        "request limit", "throughput")
+# -32005 is also Infura's "query returned more than 10000 results" for eth_getLogs, a size error
+_SIZE_MESSAGES = ("more than", "block range", "range is too large", "response size")
+
+
+def _rate_limit_error(response: Any) -> Optional[Any]:
+    """The rate limit error object in a JSON-RPC response or batch response, None if there is none."""
+    items = response if isinstance(response, list) else [response]
+    for item in items:
+        error = item.get("error") if isinstance(item, dict) else None
+        if not error:
+            continue
+        code = error.get("code") if isinstance(error, dict) else None
+        message = str(error.get("message", "") if isinstance(error, dict) else error).lower()
+        if any(pattern in message for pattern in _SIZE_MESSAGES):
+            continue
+        if code in _RATE_LIMIT_CODES or any(pattern in message for pattern in _RATE_LIMIT_MESSAGES):
+            return error
+    return None
+
+
+def _single_method(payload: Any) -> Optional[str]:
+    """Method of a payload with exactly one call, a request object or a batch of one."""
+    if isinstance(payload, list):
+        payload = payload[0] if len(payload) == 1 else None
+    return payload.get("method") if isinstance(payload, dict) else None
+
+
+def _unsupported_error(response: Any) -> Optional[Any]:
+    """The "method not found" error object of a response to one call, None if it has none."""
+    item = response[0] if isinstance(response, list) and len(response) == 1 else response
+    error = item.get("error") if isinstance(item, dict) else None
+    return error if error and _method_unsupported(error) else None
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EndpointPool:
+    """Pick the best endpoint for each request and fail over between them.
+        为每个请求选择最合适的节点，并在节点之间自动切换。
+    """
+
+    def __init__(self, urls: Sequence[str], requests_per_second: float = 25.0, burst: Optional[float] = None,
+                 pool_size: int = 16, timeout: float = 30.0, cooldown_seconds: float = 5.0):
+        """
+        :param urls: HTTP(S) JSON-RPC endpoints, e.g. several Alchemy keys
+        :param requests_per_second: Rate limit per endpoint, a batch counts one token per call
+        :param burst: Token bucket size per endpoint, defaults to one second worth of requests
+        :param pool_size: Keep-alive connections per endpoint, at least the number of threads using the pool
+        :param timeout: HTTP timeout in seconds
+        :param cooldown_seconds: How long an endpoint is skipped after a 429, 5xx or connection error
+        """
+        self.urls = list(dict.fromkeys(urls))
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cooldown_seconds = cooldown_seconds
+        self.lock = threading.Lock()
+        self._pid = None
+        self._endpoints = []
+
+    @property
+    def endpoints(self) -> List[Endpoint]:
+        # Sessions must not be shared across fork(), a pool created before `Pool` forks starts fresh in each worker
+        if self._pid != os.getpid():
+            self._endpoints = [Endpoint(url, self.requests_per_second, self.burst, self.pool_size) for url in self.urls]
+            self._pid = os.getpid()
+        return self._endpoints
+
+    def _pick(self, tried: set, method: Optional[str] = None) -> Optional[Endpoint]:
+        with self.lock:
+            candidates = [e for e in self.endpoints if e.url not in tried and method not in e.unsupported]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.healthy]
+            # When everything is cooling down, use the endpoint that recovers first
+            endpoint = min(healthy, key=Endpoint.score) if healthy else min(candidates, key=lambda e: e.cooldown_until)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def post(self, payload: Any) -> Any:
+        """POST a JSON-RPC request or batch and return the decoded JSON response.
+
+        Fails over to the next endpoint on a 429, a 5xx, a connection error, or a JSON-RPC
+        rate limit error in the body of an HTTP 200 (e.g. -32005), which fails over the whole batch.
+        Other errors, including other JSON-RPC error objects, are returned or raised as they are.
+
+        A single call of a method that an endpoint answered "method not found" to (e.g. -32601 for
+        `eth_getBlockReceipts`) is not sent to that endpoint again. It goes to the endpoints that may
+        have the method, and gets that error back only when none of them does.
+        """
+        method = _single_method(payload)
+        tried = set()
+        last_error = None
+        unsupported = None
+        while len(tried) < len(self.urls):
+            endpoint = self._pick(tried, method)
+            if endpoint is None:
+                break
+            tried.add(endpoint.url)
+            try:
+                wait = endpoint.cooldown_until - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                endpoint.bucket.acquire(len(payload) if isinstance(payload, list) else 1)
+                start = time.monotonic()
+                response = endpoint.session.post(endpoint.url, json=payload, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    endpoint.record_failure(_retry_after(response) or self.cooldown_seconds)
+                    last_error = requests.exceptions.HTTPError(
+                        f"{response.status_code} from {endpoint.url}", response=response)
+                    logger.info("Endpoint %s answered %d, failing over", endpoint.url, response.status_code)
+                    continue
+                response.raise_for_status()
+                result = response.json()
+                error = _rate_limit_error(result)
+                if error is not None:
+                    endpoint.record_failure(_retry_after(response) or self.cooldown_seconds)
+                    # No response attached, its HTTP 200 would read as not transient to the retry loops
+                    last_error = requests.exceptions.HTTPError(f"rate limit from {endpoint.url}: {error}")
+                    logger.info("Endpoint %s is rate limiting (%s), failing over", endpoint.url, error)
+                    continue
+                endpoint.record_success(time.monotonic() - start)
+                if method is not None and _unsupported_error(result) is not None:
+                    # Another endpoint may have the method
+                    endpoint.unsupported.add(method)
+                    unsupported = result
+                    logger.info("Endpoint %s does not support %s, trying the other endpoints", endpoint.url, method)
+                    continue
+                return result
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                endpoint.record_failure(self.cooldown_seconds)
+                last_error = e
+                logger.info("Endpoint %s failed with %s, failing over", endpoint.url, e)
+            finally:
+                with self.lock:
+                    endpoint.in_flight -= 1
+        if last_error is not None:
+            # An endpoint that failed may still have the method, the caller retries
+            raise last_error
+        if unsupported is not None:
+            return unsupported
+        # Every endpoint is known to lack the method, answer as they would without asking them
+        error = {"code": -32601, "message": f"the method {method} is not supported by any endpoint"}
+        if isinstance(payload, list):
+            return [{"jsonrpc": "2.0", "id": payload[0].get("id"), "error": error}]
+        return {"jsonrpc": "2.0", "id": payload.get("id"), "error": error}
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Latency and health of every endpoint, for logging."""
+        return [{"url": e.url, "latency": e.latency, "in_flight": e.in_flight, "failures": e.failures,
+                 "healthy": e.healthy} for e in self.endpoints]
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """Web3 provider that sends every request through an `EndpointPool`."""
+
+    def __init__(self, pool: EndpointPool):
+        super().__init__()
+        self.pool = pool
+        self._ids = itertools.count(1)
+
+    @property
+    def endpoint_uri(self) -> str:
+        """Endpoint most requests currently go to, `BatchRPC.from_web3` uses the whole pool instead."""
+        healthy = [e for e in self.pool.endpoints if e.healthy] or self.pool.endpoints
+        return min(healthy, key=Endpoint.score).url
+
+    def make_request(self, method, params) -> Dict[str, Any]:
+        return self.pool.post({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params})
+
+    def isConnected(self) -> bool:
+        try:
+            return "result" in self.make_request("web3_clientVersion", [])
+        except Exception:
+            return False
+
+
+# One pool and Web3 instance per process and endpoint list
+_pools: Dict[Tuple[int, Tuple[str, ...]], EndpointPool] = {}
+_web3s: Dict[Tuple[int, Tuple[str, ...]], Web3] = {}
+
+
+def get_pool(urls: Sequence[str], **kwargs) -> EndpointPool:
+    """The pool of this process for these endpoints, created on first use."""
+    key = (os.getpid(), tuple(urls))
+    if key not in _pools:
+        _pools[key] = EndpointPool(urls, **kwargs)
+    return _pools[key]
+
+
+def get_web3(urls: Sequence[str], **kwargs) -> Web3:
+    """The Web3 instance of this process on the shared pool, cheap to call in every task.
+
+    Unlike `HTTPProvider`, the pooled provider has no retry middleware: the pool fails over
+    on its own, and `EventScanner` throttles `eth_getLogs` ranges itself.
+    """
+    key = (os.getpid(), tuple(urls))
+    if key not in _web3s:
+        _web3s[key] = Web3(PooledHTTPProvider(get_pool(urls, **kwargs)))
+    return _web3s[key]
@@ -1,9 +1,24 @@
 # 请使用scannerERC721MultiProcessingV2版本
 
+import atexit
 from web3 import Web3
-import json
-import pandas as pd
 import datetime
+from abiregistry import ERC721_ABI, get_registry
+from blockcache import BlockHeaderCache, LogsBloomFilter
+from contractcache import ContractClassCache, classify_contract, EOA, ERC721, TRANSFER_TOPIC
+from rpcbatch import BatchRPC
+from rpcpool import get_web3
+from eventsink import EventSink, transfer_schema
+
+BLOOM_WINDOW = 1000     # 每次按批获取这么多个区块头，用logsBloom筛掉没有关注合约Transfer的区块
+
+
+def screenedBlocks(headerCache, start_block, end_block, bloom_filter):
+    # 从start_block往前到end_block（不含），每BLOOM_WINDOW个区块按批获取一次区块头，只返回logsBloom可能匹配的区块
+    for window_start in range(start_block, end_block, -BLOOM_WINDOW):
+        window = range(window_start, max(window_start - BLOOM_WINDOW, end_block), -1)
+        yield from headerCache.screen(window, bloom_filter)
+
 
 if __name__ == "__main__":
     token_address_set = ['0x2438a0eeffa36cb738727953d35047fb89c81417',
@@ -17,23 +32,28 @@ if __name__ == "__main__":
                        'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
                        'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
 
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[0]))
+    w3 = get_web3(alchemy_url_set)     # 节点池：长连接、按节点限速，429/5xx时切换节点
     now_block_number = w3.eth.get_block('latest').number        # 当前区块高度
     Block_internal = 1e4
     iteration_num = int(now_block_number // Block_internal)
 
-    with open('abi/ERC_721.json', 'r', encoding='utf-8') as f:
-        abi_721 = json.load(f)
+    registry = get_registry()   # ABI只解析一次，合约对象按地址缓存，不再每笔交易新建
     ERC721InterfaceId = '0x80ac58cd'
-    with open('abi/ERC_1155.json', 'r', encoding='utf-8') as f:
-        abi_1155 = json.load(f)
+    contractClassCache = ContractClassCache()   # 地址分类缓存，已经分类过的地址不再请求节点
 
-    df_Transaction_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'TokenId',
-                                                   'From Address', 'To Address', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice'])
-    df_Transaction_history.to_csv('date/df_Transaction_history__one.csv')
+    # 记录先缓存在内存中，按批写入Parquet和CSV
+    transfer_columns = ['Datetime', 'ContractAddress', 'TokenId',
+                        'From Address', 'To Address', 'Value', 'BlockHash',
+                        'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice']
+    transferSink = EventSink('date/df_Transaction_history__one', transfer_schema(transfer_columns),
+                             formats=('parquet', 'csv'))
+    atexit.register(transferSink.close)     # 正常结束或Ctrl+C退出时把缓存的记录写出
 
-    for i in range(w3.eth.get_block('latest')['number'], 13916166, -1):
+    # 先按批获取区块头，只扫描logsBloom中可能有token_address_set中合约的Transfer日志的区块，其他区块不再获取交易和收据
+    # 只按Transfer topic筛选没有意义：ERC20使用同一个topic，几乎每个区块都能通过
+    headerCache = BlockHeaderCache(BatchRPC.from_web3(w3))
+    transferBloom = LogsBloomFilter([TRANSFER_TOPIC], token_address_set)
+    for i in screenedBlocks(headerCache, w3.eth.get_block('latest')['number'], 13916166, transferBloom):
         try:
             print("===================================  ", i)
             # 首先 扫描区块的交易哈希
@@ -42,14 +62,15 @@ if __name__ == "__main__":
             # 然后 根据交易哈希得到contract address
             for tx in block.transactions:
                 transactionReceipt = w3.eth.get_transaction_receipt(tx.hex())
-                # 判断to地址是否为合约地址，普通地址get code结果是0x，合约地址不是0x
-                if w3.eth.get_code(w3.toChecksumAddress(transactionReceipt['to'])).hex() != "0x":
+                # 判断to地址是否为合约地址以及是否属于ERC721，已经分类过的地址直接从缓存读取，不再调用get_code和supportsInterface
+                toAddressClass = classify_contract(w3, transactionReceipt['to'], contractClassCache) if transactionReceipt['to'] else EOA
+                if toAddressClass != EOA:
                     # print("是合约地址, contract address: ", transactionReceipt['to'])
 
                     # 然后 检查contract address是否属于ERC721
                     try:
-                        contract = w3.eth.contract(address=w3.toChecksumAddress(transactionReceipt['to']), abi=abi_721)
-                        if (contract.functions.supportsInterface(ERC721InterfaceId).call()) and (transactionReceipt['to'] not in haveCheckTransferEventsContractAddressSet):
+                        contract = registry.contract(w3, ERC721_ABI, transactionReceipt['to'])
+                        if (toAddressClass == ERC721) and (transactionReceipt['to'] not in haveCheckTransferEventsContractAddressSet):
                             contractAddressErc721 = w3.toChecksumAddress(transactionReceipt['to'])
                             print("是 ERC721 合约，合约地址为 ", transactionReceipt['to'])
 
@@ -57,8 +78,7 @@ if __name__ == "__main__":
                             event_template = contract.events.Transfer
                             # !!!! 这里会导致出现重复的，因为现在的逻辑是，确定是Transfer交易就会扫描整个区块的该合约所有的Transfer交易，
                             # 所以增加了haveCheckTransferEventsContractAddressSet防止出现重复
-                            filter = event_template.createFilter(fromBlock=hex(block['number']), toBlock=hex(block['number']))
-                            events = filter.get_all_entries()
+                            events = event_template.getLogs(fromBlock=block['number'], toBlock=block['number'])
 
                             if len(events) > 0:
                                 haveCheckTransferEventsContractAddressSet.append(transactionReceipt['to'])
@@ -72,7 +92,8 @@ if __name__ == "__main__":
                                     transfer_info = w3.eth.get_transaction(transactionHash)
                                     Tx_Fee = transfer_info.value
                                     Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                                    nft_tr_info = pd.DataFrame({
+                                    transferSink.write({
+                                        'Timestamp': block_timestamp,
                                         'Datetime': datatimestr,
                                         'ContractAddress': transactionReceipt['to'],
                                         'TokenId': event['args']['tokenId'],
@@ -83,8 +104,7 @@ if __name__ == "__main__":
                                         'Blocknumber': event['blockNumber'],
                                         'TransactionHash': tx.hex(),
                                         'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
-                                        'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))}, index=[block_timestamp])
-                                    nft_tr_info.to_csv('date/df_Transaction_history__one.csv', mode='a', index=True, header=False)
+                                        'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))})
 
                     except:
                         continue
@@ -1,29 +1,46 @@
 # 请使用scannerERC721MultiProcessingV2版本
 
 from web3 import Web3
-import json
-import pandas as pd
 import datetime
+import os
+from abiregistry import ERC721_ABI, get_registry, init_registry
+from blockcache import BlockHeaderCache, LogsBloomFilter
+from contractcache import ContractClassCache, classify_contract, EOA, ERC721, TRANSFER_TOPIC
+from rpcbatch import BatchRPC
+from rpcpool import get_web3
+from eventsink import QueueSink, SinkWriterProcess, transfer_schema
+from workqueue import WorkScheduler, WorkUnit
 from multiprocessing import Pool
 
-def getEvent(num, i):
-    # num 区块号
-    # i alchemy节点号
+ALCHEMY_URL_SET = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
+                   'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
+                   'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
+                   'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
+contractClassCache = ContractClassCache()   # 地址分类缓存（EOA/合约/ERC721/ERC1155），所有进程共用同一个SQLite文件
+transferSink = None     # 子进程的输出，由Pool的initializer设置
+BLOOM_WINDOW = 1000     # 主进程每次按批获取这么多个区块头，用logsBloom筛掉没有Transfer的区块
+# 扫描所有合约，没有可以按地址筛选的合约列表；只按Transfer topic筛选几乎没有作用（ERC20使用同一个topic，
+# 几乎每个区块都能通过），反而每个区块多一次区块头请求，所以默认关闭
+USE_BLOOM_SCREEN = False
+
+
+def initWorker(queue):
+    # Pool子进程初始化：记录通过队列按批发送给唯一的写入进程
+    # ABI在每个子进程中只解析一次，合约对象按地址缓存
+    global transferSink
+    transferSink = QueueSink(queue)
+    init_registry()
 
-    alchemy_url_set = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
-                       'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
-                       'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
-                       'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
 
-    # i = num % 4
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[i]))
+def getEvent(num):
+    # num 区块号
+    # 同一个进程的所有任务共用一个Web3实例和节点池，缓存的合约对象可以在任务之间复用，请求在4个alchemy节点之间分配
+    i = os.getpid()     # 日志中标记是哪个进程
+    w3 = get_web3(ALCHEMY_URL_SET)
 
     try:
-        with open('abi/ERC_721.json', 'r', encoding='utf-8') as f:
-            abi_721 = json.load(f)
+        registry = get_registry()   # 进程启动时已经解析好的ABI，不再每个区块读取文件
         ERC721InterfaceId = '0x80ac58cd'
-        with open('abi/ERC_1155.json', 'r', encoding='utf-8') as f:
-            abi_1155 = json.load(f)
 
         print("===================================  ", num)
         print("进程 ", i)
@@ -33,14 +50,15 @@ def getEvent(num, i):
         # 然后 根据交易哈希得到contract address
         for tx in block.transactions:
             transactionReceipt = w3.eth.get_transaction_receipt(tx.hex())
-            # 判断to地址是否为合约地址，普通地址get code结果是0x，合约地址不是0x
-            if w3.eth.get_code(w3.toChecksumAddress(transactionReceipt['to'])).hex() != "0x":
+            # 判断to地址是否为合约地址以及是否属于ERC721，已经分类过的地址直接从缓存读取，不再调用get_code和supportsInterface
+            toAddressClass = classify_contract(w3, transactionReceipt['to'], contractClassCache) if transactionReceipt['to'] else EOA
+            if toAddressClass != EOA:
                 # print("是合约地址, contract address: ", transactionReceipt['to'])
 
                 # 然后 检查contract address是否属于ERC721
                 try:
-                    contract = w3.eth.contract(address=w3.toChecksumAddress(transactionReceipt['to']), abi=abi_721)
-                    if (contract.functions.supportsInterface(ERC721InterfaceId).call()) and (
+                    contract = registry.contract(w3, ERC721_ABI, transactionReceipt['to'])
+                    if (toAddressClass == ERC721) and (
                             transactionReceipt['to'] not in haveCheckTransferEventsContractAddressSet):
                         contractAddressErc721 = w3.toChecksumAddress(transactionReceipt['to'])
                         print("是 ERC721 合约，合约地址为 ", transactionReceipt['to'])
@@ -49,9 +67,7 @@ def getEvent(num, i):
                         event_template = contract.events.Transfer
                         # !!!! 这里会导致出现重复的，因为现在的逻辑是，确定是Transfer交易就会扫描整个区块的该合约所有的Transfer交易，
                         # 所以增加了haveCheckTransferEventsContractAddressSet防止出现重复
-                        filter = event_template.createFilter(fromBlock=hex(block['number']),
-                                                             toBlock=hex(block['number']))
-                        events = filter.get_all_entries()
+                        events = event_template.getLogs(fromBlock=block['number'], toBlock=block['number'])
 
                         if len(events) > 0:
                             haveCheckTransferEventsContractAddressSet.append(transactionReceipt['to'])
@@ -65,7 +81,8 @@ def getEvent(num, i):
                                 transfer_info = w3.eth.get_transaction(transactionHash)
                                 Tx_Fee = transfer_info.value
                                 Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                                nft_tr_info = pd.DataFrame({
+                                transferSink.write({
+                                    'Timestamp': block_timestamp,
                                     'Datetime': datatimestr,
                                     'ContractAddress': transactionReceipt['to'],
                                     'TokenId': event['args']['tokenId'],
@@ -76,35 +93,51 @@ def getEvent(num, i):
                                     'Blocknumber': event['blockNumber'],
                                     'TransactionHash': tx.hex(),
                                     'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
-                                    'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))},
-                                    index=[block_timestamp])
-                                nft_tr_info.to_csv('date/df_Transaction_history__multi.csv', mode='a', index=True,
-                                                   header=False)
+                                    'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))})
 
                 except:
                     continue
 
     except:
         print("except")
+    finally:
+        transferSink.flush()    # 每个区块任务结束时把缓存的记录发送给写入进程
+
+
+def scanUnit(unit):
+    # WorkScheduler的任务函数：一个单元就是一个区块
+    for num in range(unit.start_block, unit.end_block + 1):
+        getEvent(num)
 
 
 if __name__ == "__main__":
-    alchemy_url_set = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
-                       'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
-                       'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
-                       'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[0]))
-
-    df_Transaction_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'TokenId',
-                                                   'From Address', 'To Address', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice'])
-    df_Transaction_history.to_csv('date/df_Transaction_history__multi.csv')
-
-    p = Pool(4)
-    for num in range(w3.eth.get_block('latest')['number'], 13916166, -4):
-        for i in range(4):
-            p.apply_async(getEvent, args=(num - i, i))
-    p.close()
-    p.join()
+    w3 = get_web3(ALCHEMY_URL_SET)
+
+    # 所有子进程的记录都发送给同一个写入进程，按批写入Parquet和CSV，避免多个进程同时追加同一个文件
+    transfer_columns = ['Datetime', 'ContractAddress', 'TokenId',
+                        'From Address', 'To Address', 'Value', 'BlockHash',
+                        'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice']
+    sinkWriter = SinkWriterProcess('date/df_Transaction_history__multi', transfer_schema(transfer_columns),
+                                   formats=('parquet', 'csv'))
+
+    latest = w3.eth.get_block('latest')['number']
+    if USE_BLOOM_SCREEN:
+        # logsBloom中没有Transfer topic的区块一定没有NFT转移，不交给子进程
+        headerCache = BlockHeaderCache(BatchRPC.from_web3(w3))
+        transferBloom = LogsBloomFilter([TRANSFER_TOPIC])
+        blocks = (num for window_start in range(latest, 13916166 - 3, -BLOOM_WINDOW)
+                  for num in headerCache.screen(range(window_start, max(window_start - BLOOM_WINDOW, 13916166 - 3), -1),
+                                                transferBloom))
+    else:
+        blocks = range(latest, 13916166 - 3, -1)
+    # 按需生成：调度器里最多只有2倍进程数的区块在排队，不再一次性为整个区块范围提交apply_async
+    units = (WorkUnit((), num, num) for num in blocks)
+    with Pool(4, initializer=initWorker, initargs=(sinkWriter.queue,)) as p:
+        scheduler = WorkScheduler(p, scanUnit)
+        for unit, _ in scheduler.run(units):
+            pass
+    for unit, error in scheduler.failed:
+        print("区块 %d 扫描失败：%s" % (unit.start_block, error))
+    sinkWriter.close()
 
 
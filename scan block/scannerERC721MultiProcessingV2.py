@@ -1,181 +1,329 @@
 from web3 import Web3
-import json
-import pandas as pd
 import datetime
+import os
+import sys
 from multiprocessing import Pool
+from abiregistry import ERC721_ABI, get_registry, init_registry
+from blockcache import BlockHeaderCache, LogsBloomFilter
+from blockprogress import BlockRangeProgress, BlocksFailed
+from rpcbatch import BatchRPC
+from rpcpool import get_web3
+from txcache import TransactionCache
+from nftmetadata import NFTMetadata
+from enscache import ENSReverseCache
+from workqueue import WorkScheduler, WorkUnit, block_range_units
+from contractcache import (ContractClassCache, ScannedContractRegistry, classify_contracts, discover_nft_contracts,
+                           ERC721, TRANSFER_TOPIC, TRANSFER_SINGLE_TOPIC, TRANSFER_BATCH_TOPIC)
+from eventsink import QueueSink, SinkWriterProcess, transfer_schema
 
-haveCheckTransferEventsContractAddressSet = []  # 存储该区块中已经扫描过的ERC721合约的地址
+# 存储已经扫描过全部Transfer历史的ERC721合约地址，所有进程共享，每个新合约只会被一个进程认领并回溯
+scannedContractRegistry = ScannedContractRegistry()
+USE_BATCH_RPC = True    # 把一个区块的收据和get_code请求打包成JSON-RPC批量请求，节点支持时使用eth_getBlockReceipts
+# 从Transfer/TransferSingle/TransferBatch日志中发现NFT合约：每个任务单元只需一次eth_getLogs，
+# 也能找到通过交易市场路由合约转移的NFT；False时退回到逐个区块获取收据、检查to地址
+USE_LOG_DISCOVERY = True
+# 先按批获取单元内的区块头，logsBloom中没有任何NFT转移topic的区块不再请求收据或eth_getLogs
+# 扫描所有合约，没有可以按地址筛选的合约列表；ERC20的Transfer和ERC721使用同一个topic，几乎每个区块都能通过，
+# 筛选反而每个区块多一次区块头请求，所以默认关闭
+USE_BLOOM_SCREEN = False
+NFT_TRANSFER_BLOOM = LogsBloomFilter([TRANSFER_TOPIC, TRANSFER_SINGLE_TOPIC, TRANSFER_BATCH_TOPIC])
+contractClassCache = ContractClassCache()   # 地址分类缓存（EOA/合约/ERC721/ERC1155），所有进程共用同一个SQLite文件
+SINK_FORMATS = ('parquet', 'csv')   # 输出格式，不需要兼容旧的CSV文件时可以去掉'csv'
+transferSink = None     # 子进程的输出，由Pool的initializer设置
+txCache = None          # 子进程的交易缓存（内存LRU + 所有进程共用的SQLite），第一次使用时创建
+nftMetadata = None      # 子进程的name/symbol/tokenURI/balanceOf缓存，写出前按批获取，第一次使用时创建
+ensNames = None         # 子进程的ENS反向解析缓存，有名字和没有名字的结果都缓存到过期，第一次使用时创建
+headerCache = None      # 子进程的区块头缓存，用于logsBloom筛选和事件的时间戳，第一次使用时创建
+BLOCKS_PER_UNIT = 10    # 每个任务单元包含的区块数
+START_BLOCK = 15053227  # 扫描到这个区块为止（2022.07.01）
+PROGRESS_FILE = 'date/v2_block_progress.sqlite'   # 已完成的区块区间和失败的区块，重启后只扫描没有完成的区间
+# 所有alchemy节点组成一个节点池：每个进程对每个节点保持长连接，按节点限速，请求发往延迟最低的健康节点，429/5xx时自动切换
+ALCHEMY_URL_SET = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
+                   'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
+                   'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
+                   'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
 
-def getEvent(num, i):
-    # num 区块号
-    # i alchemy节点号
 
-    alchemy_url_set = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
-                       'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
-                       'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
-                       'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
+def initWorker(queue):
+    # Pool子进程初始化：记录通过队列按批发送给唯一的写入进程
+    # ABI在每个子进程中只解析一次，合约对象按地址缓存
+    global transferSink
+    transferSink = QueueSink(queue)
+    init_registry()
 
-    # i = num % 4
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[i]))
 
+def getHeaderCache():
+    # 子进程的区块头缓存：logsBloom筛选时已经取回的区块头，写出记录时直接用来取时间戳
+    global headerCache
+    if headerCache is None:
+        headerCache = BlockHeaderCache(BatchRPC.from_web3(get_web3(ALCHEMY_URL_SET)))
+    return headerCache
+
+
+def getToAddressesInBlock(w3, num, rpc=None):
+    # 返回区块num中所有交易的to地址（checksum格式，去重并保持交易顺序），创建合约的交易to为空，直接跳过
+    # rpc 为 BatchRPC 时整个区块的收据通过一次批量请求获取，否则每笔交易单独请求
+    if rpc is not None:
+        receipts = rpc.get_block_receipts(num)
+        return list(dict.fromkeys(w3.toChecksumAddress(r['to']) for r in receipts if r['to']))
+
+    block = w3.eth.get_block(num)
+    to_address_set = []
+    for tx in block.transactions:
+        transactionReceipt = w3.eth.get_transaction_receipt(tx.hex())
+        if transactionReceipt['to'] and transactionReceipt['to'] not in to_address_set:
+            to_address_set.append(transactionReceipt['to'])
+    return to_address_set
+
+
+def getEvent(num, end_block=None):
+    # num 区块号，日志发现模式下扫描 num 到 end_block 的区块范围
+    # 同一个进程的所有任务共用一个Web3实例和节点池，不再为每个区块新建连接，也不再固定使用某一个节点
+    global txCache, nftMetadata, ensNames
+    i = os.getpid()     # 日志中标记是哪个进程
+    w3 = get_web3(ALCHEMY_URL_SET)
+    if txCache is None:
+        txCache = TransactionCache.from_web3(w3)
+    if nftMetadata is None:
+        nftMetadata = NFTMetadata.from_web3(w3)
+    if ensNames is None:
+        ensNames = ENSReverseCache.from_web3(w3)
+
+    failures = []   # 本区块中处理失败的合约，区块结束时一起报告，不再悄悄跳过
     try:
-        with open('abi/ERC_721.json', 'r', encoding='utf-8') as f:
-            abi_721 = json.load(f)
+        registry = get_registry()   # 进程启动时已经解析好的ABI，不再每个区块读取文件
         ERC721InterfaceId = '0x80ac58cd'
-        with open('abi/ERC_1155.json', 'r', encoding='utf-8') as f:
-            abi_1155 = json.load(f)
-        ERC1155InterfaceId = '0xd9b67a26'
 
         print("=================================================")
-        print("目前扫描过的合约数量", len(haveCheckTransferEventsContractAddressSet))
-        # 首先 扫描区块的交易哈希
-        block = w3.eth.get_block(num)
-        # 然后 根据交易哈希得到contract address
-        for tx in block.transactions:
-            transactionReceipt = w3.eth.get_transaction_receipt(tx.hex())
-            # 判断to地址是否为合约地址，普通地址get code结果是0x，合约地址不是0x
-            if w3.eth.get_code(w3.toChecksumAddress(transactionReceipt['to'])).hex() != "0x":
-                # print("是合约地址, contract address: ", transactionReceipt['to'])
-
-                # 然后 检查contract address是否属于ERC721
-                # 如果是ERC721地址，还需要检查是否已经对该合约地址扫描过对应的Transfer事件，如果扫描过就不要对该合约进行扫描
-                try:
-                    contract_721 = w3.eth.contract(address=w3.toChecksumAddress(transactionReceipt['to']), abi=abi_721)
-                    # contract_1155 = w3.eth.contract(address=w3.toChecksumAddress(transactionReceipt['to']), abi=abi_1155)
-                    if (contract_721.functions.supportsInterface(ERC721InterfaceId).call()) and (transactionReceipt['to'] not in haveCheckTransferEventsContractAddressSet):
-                        contractAddressErc721 = w3.toChecksumAddress(transactionReceipt['to'])
-                        print("是新的 ERC721 合约，合约地址为 ", transactionReceipt['to'])
-
-                        # 然后 如果属于就把Transfer event记录下来，否则就检查下一个
-                        event_template = contract_721.events.Transfer
-                        # 直接扫描该合约地址从2022.01.01到最新区块中的全部Transfer事件
-                        filter = event_template.createFilter(fromBlock=hex(15053226),
-                                                             toBlock=hex(w3.eth.get_block('latest')['number']))
-                        events = filter.get_all_entries()
-
-                        if len(events) > 0:
-                            event_i = 0     # 记录扫描到第i个event
-                            print("第" + repr(i) + "个进程, 区块号" + repr(num) + ", num events: " + repr(len(events)))
-                            # 扫描过的合约地址要加入haveCheckTransferEventsContractAddressSet列表中，后续即使在其他区块中遇到也不需要重新扫描
-                            haveCheckTransferEventsContractAddressSet.append(transactionReceipt['to'])
-                            for event in events:
-                                if event_i == 5:
-                                    break
-                                transactionHash = event.transactionHash
-                                transfer_info = w3.eth.get_transaction(transactionHash)
-                                Tx_Fee = transfer_info.value
-                                Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                                if Tx_Fee > 0:
-                                    block_num = event.blockNumber
-                                    block_timestamp = w3.eth.getBlock(block_num).timestamp
-                                    block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
-                                    datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
-                                    print("区块号 " + repr(num) + " 第" + repr(i) + "个进程, event Transfer 交易时间为：" + repr(
-                                        datatimestr) + " " + repr(event_i) + "/" + repr(len(events)) + " 已检查" + repr(
-                                        len(haveCheckTransferEventsContractAddressSet)))
-                                    # # 调用合约的函数获取返回值的方法
-                                    # print("&&&&&&  ", contract_721.functions.balanceOf(event['args']['to']).call())
-                                    nft_tr_info = pd.DataFrame({
-                                        'Datetime': datatimestr,
-                                        'ContractAddress': transactionReceipt['to'],
-                                        'Name': contract_721.functions.name().call(),
-                                        'Symbol': contract_721.functions.symbol().call(),
-                                        'TokenId': event['args']['tokenId'],
-                                        'TokenURI': contract_721.functions.tokenURI(event['args']['tokenId']).call(),
-                                        'From Address': event['args']['from'],
-                                        'From ens': w3.ens.name(event['args']['from']),
-                                        'To Address': event['args']['to'],
-                                        'To ens': w3.ens.name(event['args']['to']),
-                                        'To Address balanceOf': contract_721.functions.balanceOf(event['args']['to']).call(),
-                                        'Value': Tx_Fee,
-                                        'BlockHash': event['blockHash'].hex(),
-                                        'Blocknumber': event['blockNumber'],
-                                        'TransactionHash': transactionHash.hex(),
-                                        'Gas': float(Web3.fromWei(transfer_info.gas, 'gwei')),
-                                        'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'gwei')),
-                                        'Protocol': "ERC 721"},
-                                        index=[block_timestamp])
-                                    nft_tr_info.to_csv('date/df_Transaction_history__multi.csv', mode='a', index=True,
-                                                       header=False)
-                                    event_i = event_i + 1
-                                # else:
-                                #     event_i = event_i + 1
-
-                    # elif (contract_1155.functions.supportsInterface(ERC1155InterfaceId).call()) and (transactionReceipt['to'] not in haveCheckTransferEventsContractAddressSet):
-                    #     print("是新的 ERC1155 合约，合约地址为 ", transactionReceipt['to'])
-                    #
-                    #     # 然后 如果属于就把TransferSingle event记录下来，否则就检查下一个
-                    #     event_template = contract_1155.events.TransferSingle
-                    #     # 直接扫描该合约地址从2022.01.01到最新区块中的全部Transfer事件
-                    #     filter = event_template.createFilter(fromBlock=hex(13916166),
-                    #                                          toBlock=hex(w3.eth.get_block('latest')['number']))
-                    #     events = filter.get_all_entries()
-                    #
-                    #     if len(events) > 0:
-                    #         event_i = 0  # 记录扫描到第i个event
-                    #         print("第" + repr(i) + "个进程, 区块号" + repr(num) + ", num events: " + repr(len(events)))
-                    #         # 扫描过的合约地址要加入haveCheckTransferEventsContractAddressSet列表中，后续即使在其他区块中遇到也不需要重新扫描
-                    #         haveCheckTransferEventsContractAddressSet.append(transactionReceipt['to'])
-                    #         for event in events:
-                    #             block_num = event.blockNumber
-                    #             block_timestamp = w3.eth.getBlock(block_num).timestamp
-                    #             block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
-                    #             datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
-                    #             print("区块号 " + repr(num) + " 第" + repr(i) + "个进程, event TransferSingle 交易时间为：" + repr(datatimestr) + " "  + repr(event_i) + "/" + repr(len(events)) + " 已检查" + repr(len(haveCheckTransferEventsContractAddressSet)))
-                    #             transactionHash = event.transactionHash
-                    #             transfer_info = w3.eth.get_transaction(transactionHash)
-                    #             Tx_Fee = transfer_info.value
-                    #             Tx_Fee = float(Web3.fromWei(Tx_Fee, 'gwei'))
-                    #             nft_tr_info = pd.DataFrame({
-                    #                 'Datetime': datatimestr,
-                    #                 'ContractAddress': transactionReceipt['to'],
-                    #                 'Name': ' ',
-                    #                 'Symbol': ' ',
-                    #                 'TokenId': event['args']['id'],
-                    #                 'From Address': event['args']['from'],
-                    #                 'To Address': event['args']['to'],
-                    #                 'Value': Tx_Fee,
-                    #                 'BlockHash': event['blockHash'].hex(),
-                    #                 'Blocknumber': event['blockNumber'],
-                    #                 'TransactionHash': tx.hex(),
-                    #                 'Gas': float(Web3.fromWei(transfer_info.gas, 'gwei')),
-                    #                 'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'gwei')),
-                    #                 'Protocol': "ERC 1155"},
-                    #                 index=[block_timestamp])
-                    #             nft_tr_info.to_csv('date/df_Transaction_history__multi.csv', mode='a', index=True,
-                    #                                header=False)
-                    #             event_i = event_i + 1
-
-                except:
-                    continue
+        print("目前扫描过的合约数量", len(scannedContractRegistry))
+        rpc = BatchRPC.from_web3(w3) if USE_BATCH_RPC else None
+        if USE_LOG_DISCOVERY:
+            # 首先 一次eth_getLogs取回区块范围内所有NFT转移日志，发出日志的合约就是NFT合约
+            # 只有第一次见到的地址才调用supportsInterface确认，已经分类过的地址直接从缓存读取
+            address_class = discover_nft_contracts(w3, num, end_block or num, contractClassCache, rpc)
+            to_address_set = list(address_class)
+        else:
+            # 首先 得到区块中所有交易的to地址（批量模式下整个区块只需要一两次HTTP请求）
+            to_address_set = getToAddressesInBlock(w3, num, rpc)
+            # 然后 判断to地址是否为合约地址以及是否属于ERC721，已经分类过的地址直接从缓存读取，不再调用get_code和supportsInterface
+            address_class = classify_contracts(w3, to_address_set, contractClassCache, rpc)
+        for contractAddress in to_address_set:
+            # 如果是ERC721地址，还需要检查是否已经对该合约地址扫描过对应的Transfer事件，如果扫描过就不要对该合约进行扫描
+            claimed = False
+            try:
+                # 只有确认是ERC721的合约才创建合约对象
+                # contract_1155 = registry.contract(w3, ERC1155_ABI, contractAddress)
+                claimed = (address_class[contractAddress] == ERC721) and scannedContractRegistry.claim(contractAddress)
+                if claimed:
+                    contract_721 = registry.contract(w3, ERC721_ABI, contractAddress)
+                    print("是新的 ERC721 合约，合约地址为 ", contractAddress)
+
+                    # 然后 如果属于就把Transfer event记录下来，否则就检查下一个
+                    event_template = contract_721.events.Transfer
+                    # 直接扫描该合约地址从2022.01.01到最新区块中的全部Transfer事件
+                    # 认领成功后其他进程即使在其他区块中遇到该合约也不会重新扫描；处理失败或没有事件时归还认领，之后可以重试
+                    events = event_template.getLogs(fromBlock=15053226,
+                                                    toBlock=w3.eth.get_block('latest')['number'])
+                    if len(events) == 0:
+                        claimed = False
+                        scannedContractRegistry.release(contractAddress)
+
+                    if len(events) > 0:
+                        print("第" + repr(i) + "个进程, 区块号" + repr(num) + ", num events: " + repr(len(events)))
+                        # 先选出要写出的前5个有转账金额的事件，再把它们的name/symbol/tokenURI/balanceOf一次批量取回
+                        selected = []
+                        for event in events:
+                            if len(selected) == 5:
+                                break
+                            transfer_info = txCache.get_transaction(event.transactionHash)  # 同一笔交易只请求一次
+                            Tx_Fee = float(Web3.fromWei(transfer_info.value, 'ether'))
+                            if Tx_Fee > 0:
+                                selected.append((event, transfer_info, Tx_Fee))
+                        # balanceOf按事件所在区块查询，结果固定，可以缓存
+                        nftMetadata.prefetch([(contractAddress, event['args']['tokenId'], event['args']['to'],
+                                               event['blockNumber']) for event, _, _ in selected])
+                        # from和to的ENS名字去重后批量解析，交易市场和活跃钱包地址大多已经在缓存中
+                        ensNames.prefetch([event['args'][key] for event, _, _ in selected for key in ('from', 'to')])
+                        # 时间戳取自区块头缓存，缺少的区块头一次批量获取，不再每条记录调用一次getBlock
+                        headers = getHeaderCache()
+                        headers.prefetch([event.blockNumber for event, _, _ in selected])
+                        for event_i, (event, transfer_info, Tx_Fee) in enumerate(selected):
+                            transactionHash = event.transactionHash
+                            block_num = event.blockNumber
+                            block_timestamp = headers.get_timestamp(block_num)
+                            block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
+                            datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
+                            print("区块号 " + repr(num) + " 第" + repr(i) + "个进程, event Transfer 交易时间为：" + repr(
+                                datatimestr) + " " + repr(event_i) + "/" + repr(len(events)) + " 已检查" + repr(
+                                len(scannedContractRegistry)))
+                            transferSink.write({
+                                'Timestamp': block_timestamp,
+                                'Datetime': datatimestr,
+                                'ContractAddress': contractAddress,
+                                'Name': nftMetadata.name(contractAddress),
+                                'Symbol': nftMetadata.symbol(contractAddress),
+                                'TokenId': event['args']['tokenId'],
+                                'TokenURI': nftMetadata.token_uri(contractAddress, event['args']['tokenId']),
+                                'From Address': event['args']['from'],
+                                'From ens': ensNames.name(event['args']['from']),
+                                'To Address': event['args']['to'],
+                                'To ens': ensNames.name(event['args']['to']),
+                                'To Address balanceOf': nftMetadata.balance_of(contractAddress, event['args']['to'],
+                                                                               event['blockNumber']),
+                                'Value': Tx_Fee,
+                                'BlockHash': event['blockHash'].hex(),
+                                'Blocknumber': event['blockNumber'],
+                                'LogIndex': event['logIndex'],
+                                'TransactionHash': transactionHash.hex(),
+                                'Gas': float(Web3.fromWei(transfer_info.gas, 'gwei')),
+                                'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'gwei')),
+                                'Protocol': "ERC 721"})
+                        # 合约的记录全部生成后才发送给写入进程，出错时不会留下只写了一部分的合约
+                        transferSink.flush()
+                        # 记录已经交给写入进程，认领才算完成；没有完成的认领在下次继续运行时归还
+                        scannedContractRegistry.complete(contractAddress)
+
+                # elif (contract_1155.functions.supportsInterface(ERC1155InterfaceId).call()) and scannedContractRegistry.claim(contractAddress):
+                #     print("是新的 ERC1155 合约，合约地址为 ", contractAddress)
+                #
+                #     # 然后 如果属于就把TransferSingle event记录下来，否则就检查下一个
+                #     event_template = contract_1155.events.TransferSingle
+                #     # 直接扫描该合约地址从2022.01.01到最新区块中的全部Transfer事件
+                #     filter = event_template.createFilter(fromBlock=hex(13916166),
+                #                                          toBlock=hex(w3.eth.get_block('latest')['number']))
+                #     events = filter.get_all_entries()
+                #
+                #     if len(events) > 0:
+                #         event_i = 0  # 记录扫描到第i个event
+                #         print("第" + repr(i) + "个进程, 区块号" + repr(num) + ", num events: " + repr(len(events)))
+                #         for event in events:
+                #             block_num = event.blockNumber
+                #             block_timestamp = w3.eth.getBlock(block_num).timestamp
+                #             block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
+                #             datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
+                #             print("区块号 " + repr(num) + " 第" + repr(i) + "个进程, event TransferSingle 交易时间为：" + repr(datatimestr) + " "  + repr(event_i) + "/" + repr(len(events)) + " 已检查" + repr(len(scannedContractRegistry)))
+                #             transactionHash = event.transactionHash
+                #             transfer_info = w3.eth.get_transaction(transactionHash)
+                #             Tx_Fee = transfer_info.value
+                #             Tx_Fee = float(Web3.fromWei(Tx_Fee, 'gwei'))
+                #             nft_tr_info = pd.DataFrame({
+                #                 'Datetime': datatimestr,
+                #                 'ContractAddress': contractAddress,
+                #                 'Name': ' ',
+                #                 'Symbol': ' ',
+                #                 'TokenId': event['args']['id'],
+                #                 'From Address': event['args']['from'],
+                #                 'To Address': event['args']['to'],
+                #                 'Value': Tx_Fee,
+                #                 'BlockHash': event['blockHash'].hex(),
+                #                 'Blocknumber': event['blockNumber'],
+                #                 'TransactionHash': tx.hex(),
+                #                 'Gas': float(Web3.fromWei(transfer_info.gas, 'gwei')),
+                #                 'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'gwei')),
+                #                 'Protocol': "ERC 1155"},
+                #                 index=[block_timestamp])
+                #             nft_tr_info.to_csv('date/df_Transaction_history__multi.csv', mode='a', index=True,
+                #                                header=False)
+                #             event_i = event_i + 1
+
+            except Exception as e:
+                # 丢弃该合约还没有发送的记录并归还认领，单元重试时重新回溯这个合约
+                transferSink.discard()
+                if claimed:
+                    scannedContractRegistry.release(contractAddress)
+                failures.append((contractAddress, e))
+                continue
         print("第" + repr(i) + "个进程结束 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        if failures:
+            raise RuntimeError("%d contracts failed, first %s: %r" % (len(failures), failures[0][0], failures[0][1]))
 
     except:
         print("except")
+        raise       # 由scanBlocks记录为失败的区块
+
+
+def scanBlocks(unit):
+    # 扫描一个任务单元中的全部区块，从新到旧，与原来的扫描顺序一致
+    # 有区块失败时抛出BlocksFailed，由WorkScheduler把单元放回队列重试；重试次数用完后主进程把失败的区块
+    # 记录到进度文件中，之后用 --retry-failed 单独重试
+    failed = {}
+    blocks = list(range(unit.end_block, unit.start_block - 1, -1))
+    if USE_BLOOM_SCREEN:
+        try:
+            blocks = getHeaderCache().screen(blocks, NFT_TRANSFER_BLOOM)
+        except Exception as e:
+            # 获取区块头失败时不筛选，扫描单元内的全部区块，而不是把它们都记为失败
+            print("区块 %d - %d 的logsBloom筛选失败，扫描全部区块：%r" % (unit.start_block, unit.end_block, e))
+        if not blocks:
+            return failed
+    if USE_LOG_DISCOVERY:
+        # 一次eth_getLogs覆盖可能有NFT转移的区块，出错时这些区块都记为失败
+        ranges = [(min(blocks), max(blocks))]
+    else:
+        ranges = [(num, num) for num in blocks]
+    for start_block, end_block in ranges:
+        try:
+            getEvent(start_block, end_block)
+        except Exception as e:
+            failed.update({num: repr(e) for num in range(start_block, end_block + 1)})
+    if failed:
+        raise BlocksFailed(failed)
+    return failed
 
 
 if __name__ == "__main__":
-    alchemy_url_set = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
-                       'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
-                       'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
-                       'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[0]))
+    # python scannerERC721MultiProcessingV2.py                 从上次中断的地方继续，只扫描还没有完成的区间
+    # python scannerERC721MultiProcessingV2.py --retry-failed  只重试之前失败的区块
+    # python scannerERC721MultiProcessingV2.py --restart       清空进度和输出，从头开始
+    w3 = get_web3(ALCHEMY_URL_SET)
+    latest = w3.eth.get_block('latest')['number']
+    progress = BlockRangeProgress(PROGRESS_FILE)
+    if '--restart' in sys.argv:
+        progress.reset()
+    resume = progress.done_count(START_BLOCK, latest) > 0 or bool(progress.failed_blocks())
 
-    df_Transaction_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'Name', 'Symbol', 'TokenId', 'TokenURI',
-                                                   'From Address', 'From ens', 'To Address', 'To ens', 'To Address balanceOf', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice', 'Protocol'])
-    df_Transaction_history.to_csv('date/df_Transaction_history__multi.csv')
+    # 所有子进程的记录都发送给同一个写入进程，按批写入Parquet（和CSV），避免多个进程同时追加同一个文件
+    transfer_columns = ['Datetime', 'ContractAddress', 'Name', 'Symbol', 'TokenId', 'TokenURI',
+                        'From Address', 'From ens', 'To Address', 'To ens', 'To Address balanceOf', 'Value', 'BlockHash',
+                        'Blocknumber', 'LogIndex', 'TransactionHash', 'Gas', 'Gasprice', 'Protocol']
+    # 继续扫描时追加到已有的输出，并保留已扫描合约的登记；从头开始时输出文件重新生成，登记也要清空
+    # 每个 (交易哈希, 日志序号) 只保留一行：重试的单元、重新扫描的区块不会产生重复记录，扫描结束后不需要再去重
+    sinkWriter = SinkWriterProcess('date/df_Transaction_history__multi', transfer_schema(transfer_columns),
+                                   formats=SINK_FORMATS, overwrite=not resume,
+                                   dedup_key=('TransactionHash', 'LogIndex'))
+    if not resume:
+        scannedContractRegistry.reset()
+    else:
+        # 上次运行崩溃或中断时正在回溯的合约没有完成，归还认领后重新回溯
+        scannedContractRegistry.release_incomplete()
+    print("已完成 %d / %d 个区块，失败 %d 个区块" % (progress.done_count(START_BLOCK, latest),
+                                           latest - START_BLOCK + 1, len(progress.failed_blocks())))
 
     # 多进程扫描从2022.01.01到当前区块的ERC721合约对应的Transfer事件
-    # 4个alchemy节点对应4个进程，每次对4个区块进行扫描
+    # 每BLOCKS_PER_UNIT个区块一个任务单元，按需生成，不再一次性为几百万个区块提交apply_async
+    # 空闲的进程领取下一个单元，失败的单元放回队列重试；请求由节点池在4个alchemy节点之间分配
     # 2022.01.01 13916166        2022.09.01 15449618      2022.07.01 15053226
 
-    p = Pool(12)
-    for num in range(w3.eth.get_block('latest')['number'], 15053226, -4):
-        for i in range(4):
-            p.apply_async(getEvent, args=(num - i, i))
-    p.close()
-    p.join()        # 主进程会卡在这里，等所有进程结束再继续执行
+    if '--retry-failed' in sys.argv:
+        units = (WorkUnit((), num, num) for num in progress.failed_blocks())
+    else:
+        # 只扫描没有完成的区间（包括上次运行之后新出的区块），从新到旧
+        units = (unit for gap_start, gap_end in reversed(progress.gaps(START_BLOCK, latest))
+                 for unit in block_range_units(gap_start, gap_end, BLOCKS_PER_UNIT, descending=True))
+
+    with Pool(12, initializer=initWorker, initargs=(sinkWriter.queue,)) as p:
+        scheduler = WorkScheduler(p, scanBlocks, max_attempts=3)
+        for unit, failed in scheduler.run(units):     # 主进程在这里等待所有单元完成
+            # 每完成一个单元就写入进度文件，崩溃或中断后最多重新扫描正在执行的单元
+            progress.mark_done(unit.start_block, unit.end_block, failed)
+            print("区块 %d - %d 扫描完成，失败 %d 个区块" % (unit.start_block, unit.end_block, len(failed)))
+    for unit, error in scheduler.failed:
+        if isinstance(error, BlocksFailed):
+            # 重试后仍然失败的区块记录到进度文件中，之后用 --retry-failed 单独重试
+            progress.mark_done(unit.start_block, unit.end_block, error.failed)
+        # 其他错误的区间没有记录为完成，下次运行时会重新扫描
+        print("区块 %d - %d 扫描失败：%s" % (unit.start_block, unit.end_block, error))
+    sinkWriter.close()
 
     # for num in range(w3.eth.get_block('latest')['number'], 13916166, -4):
     #     p = Pool(12)
@@ -0,0 +1,154 @@
+"""SQLite-backed EventScannerState.
+    基于 SQLite 的 EventScannerState。
+
+`last_scanned_block` and the scanned events live in one SQLite file. Every chunk is
+one transaction, opened in `start_chunk` and committed in `end_chunk` together with
+the new `last_scanned_block`, so a crash never leaves events without the matching
+resume point. Restoring only reads one row, and dropping reorganised blocks is one
+indexed DELETE instead of rewriting a whole JSON file.
+`last_scanned_block` 和扫描到的事件保存在同一个 SQLite 文件中。每个区块范围是一个事务，
+在 `start_chunk` 中开始，在 `end_chunk` 中连同新的 `last_scanned_block` 一起提交。
+恢复状态只需读取一行，删除被重组的区块只需一条走索引的 DELETE，而不必重写整个 JSON 文件。
+"""
+
+import datetime
+import json
+import logging
+from typing import Dict
+
+from web3.datastructures import AttributeDict
+
+from contractcache import _ProcessLocalSQLite
+from eventscanner import EventScannerState
+
+
+logger = logging.getLogger(__name__)
+
+
+def _to_json(value):
+    """json.dumps fallback for the bytes and HexBytes values of decoded events."""
+    if hasattr(value, "hex"):
+        return value.hex()
+    return str(value)
+
+
+class SQLiteEventScannerState(_ProcessLocalSQLite, EventScannerState):
+    """Store the state of scanned blocks and all events in SQLite.
+        把扫描区块的状态和所有事件存储在 SQLite 中。
+
+    Events are keyed by (block number, transaction hash, log index), so rescanning a block
+    replaces its rows instead of duplicating them. Override `transform_event` to choose what is stored.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS scanner_state (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            last_scanned_block INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO scanner_state (id, last_scanned_block) VALUES (0, 0);
+        CREATE TABLE IF NOT EXISTS scanned_event (
+            block_number INTEGER NOT NULL,
+            transaction_hash TEXT NOT NULL,
+            log_index INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (block_number, transaction_hash, log_index)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS scanned_block (
+            block_number INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, fname: str = "date/scanner_state.sqlite", timeout: float = 30.0,
+                 block_hash_window: int = 10000):
+        """
+        :param fname: SQLite file of the state
+        :param block_hash_window: Keep block hashes for this many blocks below the newest scanned block,
+            the deepest reorg we can locate exactly
+        """
+        super().__init__(fname, timeout)
+        self.block_hash_window = block_hash_window
+
+    def reset(self):
+        """Create initial state of nothing scanned."""
+        with self.conn:
+            self.conn.execute("DELETE FROM scanned_event")
+            self.conn.execute("DELETE FROM scanned_block")
+            self.conn.execute("UPDATE scanner_state SET last_scanned_block = 0")
+
+    def restore(self):
+        """Open the state file, only reads the resume point."""
+        last_scanned_block = self.get_last_scanned_block()
+        if last_scanned_block:
+            print(f"Restored the state, previously {last_scanned_block} blocks have been scanned")
+        else:
+            print("State starting from scratch")
+
+    def save(self):
+        """Commit a chunk left open, e.g. when a `scan_iter` consumer stopped early."""
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    def transform_event(self, block_when: datetime.datetime, event: AttributeDict) -> dict:
+        """Convert an event to the JSON-serialisable record we store, override for your own format."""
+        return {
+            "timestamp": block_when.isoformat() if block_when else None,
+            "address": event.address,
+            "args": dict(event.args),
+        }
+
+    #
+    # EventScannerState methods implemented below
+    #
+
+    def get_last_scanned_block(self) -> int:
+        """The number of the last block we have stored."""
+        return self.conn.execute("SELECT last_scanned_block FROM scanner_state").fetchone()[0]
+
+    def start_chunk(self, block_number: int, chunk_size: int = None):
+        """All events of the chunk are written in one transaction."""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+
+    def end_chunk(self, block_number: int):
+        """Commit the chunk together with the block we resume from next time."""
+        self.conn.execute("UPDATE scanner_state SET last_scanned_block = ?", (block_number,))
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+        """Record an event in our database."""
+        txhash = event.transactionHash.hex()
+        record = self.transform_event(block_when, event)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO scanned_event (block_number, transaction_hash, log_index, event, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (event.blockNumber, txhash, event.logIndex, event.event, json.dumps(record, default=_to_json)))
+
+        # Return a pointer that allows us to look up this event later if needed
+        return f"{event.blockNumber}-{txhash}-{event.logIndex}"
+
+    def delete_data(self, since_block: int) -> int:
+        """Remove potentially reorganised blocks from the scan data, in one range delete on the primary key."""
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM scanned_event WHERE block_number >= ?", (since_block,))
+            self.conn.execute("DELETE FROM scanned_block WHERE block_number >= ?", (since_block,))
+        if cursor.rowcount:
+            logger.info("Deleted %d events since block %d", cursor.rowcount, since_block)
+        return cursor.rowcount
+
+    def store_block_hashes(self, block_hashes: Dict[int, str]):
+        """Store hashes in the open chunk transaction, forgetting those that fell out of the window."""
+        if not block_hashes:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO scanned_block (block_number, hash) VALUES (?, ?)",
+                              block_hashes.items())
+        self.conn.execute("DELETE FROM scanned_block WHERE block_number < ?",
+                          (max(block_hashes) - self.block_hash_window,))
+
+    def get_block_hashes(self, before_block: int, limit: int) -> Dict[int, str]:
+        rows = self.conn.execute(
+            "SELECT block_number, hash FROM scanned_block WHERE block_number < ? ORDER BY block_number DESC LIMIT ?",
+            (before_block, limit)).fetchall()
+        return dict(rows)
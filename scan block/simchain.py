@@ -0,0 +1,383 @@
+"""A simulated chain behind a local JSON-RPC endpoint, to run the scanners without a node.
+    本地 JSON-RPC 端点后面的模拟区块链，无需真实节点即可运行扫描程序。
+
+`SimulatedChain` mines blocks with ERC-721 Transfer logs on request and can replace
+the newest blocks to simulate a chain reorganisation. It answers the calls the
+scanners make (`eth_blockNumber`, `eth_getBlockByNumber`, `eth_getLogs`, transactions and receipts,
+`eth_getCode`, `eth_call` of the ERC-721 views, batches)
+over HTTP, so `Web3(HTTPProvider(chain.endpoint_uri))` and `BatchRPC` work unchanged.
+`SimulatedChain` 按需挖出带有 ERC-721 Transfer 日志的区块，并可以替换最新的区块来模拟链重组。
+
+`follow_reorgs` follows a simulated chain with `EventScanner.follow` through
+reorgs deeper than the confirmation depth. `test_simchain.py` checks that the scanned
+state ends up equal to the canonical chain, as does running this file::
+
+    python simchain.py
+"""
+
+import itertools
+import json
+import logging
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+from web3 import Web3
+
+from blockcache import logs_bloom
+
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_TOPIC = Web3.keccak(text="Transfer(address,address,uint256)").hex()
+
+
+def _word(value: int) -> str:
+    return "0x" + format(value, "064x")
+
+
+def _address_word(address: str) -> str:
+    return "0x" + address[2:].lower().rjust(64, "0")
+
+
+class SimulatedChain:
+    """Scripted chain of blocks with Transfer logs, served over JSON-RPC.
+        带有 Transfer 日志的脚本化区块链，通过 JSON-RPC 提供服务。
+    """
+
+    def __init__(self, genesis_timestamp: int = 1600000000, block_time: int = 12, block_receipts: bool = False):
+        """
+        :param block_receipts: Answer `eth_getBlockReceipts`, like nodes that have it, otherwise it is an unknown method
+        """
+        self.block_time = block_time
+        self.block_receipts = block_receipts
+        self.blocks = []
+        self.lock = threading.RLock()
+        self._salt = itertools.count(1)
+        self._server = None
+        self._append_block(genesis_timestamp, [])
+
+    @property
+    def head(self) -> int:
+        with self.lock:
+            return len(self.blocks) - 1
+
+    def _append_block(self, timestamp: int, transfers: List[Tuple[str, str, str, int]]):
+        number = len(self.blocks)
+        parent_hash = self.blocks[-1]["hash"] if self.blocks else _word(0)
+        # A new salt for every mined block, so a replaced block gets a new hash
+        block_hash = Web3.keccak(text=f"{parent_hash}-{number}-{next(self._salt)}").hex()
+        logs = []
+        for log_index, (contract, sender, receiver, token_id) in enumerate(transfers):
+            logs.append({
+                "address": Web3.toChecksumAddress(contract),
+                "topics": [TRANSFER_TOPIC, _address_word(sender), _address_word(receiver), _word(token_id)],
+                "data": "0x",
+                "blockNumber": hex(number),
+                "blockHash": block_hash,
+                "transactionHash": Web3.keccak(text=f"{block_hash}-{log_index}").hex(),
+                "transactionIndex": hex(log_index),
+                "logIndex": hex(log_index),
+                "removed": False,
+            })
+        self.blocks.append({
+            "number": hex(number),
+            "hash": block_hash,
+            "parentHash": parent_hash,
+            "timestamp": hex(timestamp),
+            "logsBloom": logs_bloom(logs),
+            "transactions": [log["transactionHash"] for log in logs],
+            "logs": logs,
+        })
+
+    def mine(self, transfers: Optional[List[Tuple[str, str, str, int]]] = None) -> int:
+        """Mine one block.
+
+        :param transfers: (contract, from, to, tokenId) of the Transfer logs in the block
+        :return: The new block number
+        """
+        with self.lock:
+            timestamp = int(self.blocks[-1]["timestamp"], 16) + self.block_time
+            self._append_block(timestamp, transfers or [])
+            return self.head
+
+    def reorg(self, depth: int, new_blocks: List[List[Tuple[str, str, str, int]]]):
+        """Replace the newest `depth` blocks with `new_blocks`, which may be longer or shorter."""
+        with self.lock:
+            assert 0 < depth < len(self.blocks)
+            del self.blocks[-depth:]
+            for transfers in new_blocks:
+                self.mine(transfers)
+            logger.info("Reorganised the last %d blocks, new head %d", depth, self.head)
+
+    def logs(self, from_block: int = 0, to_block: Optional[int] = None) -> List[dict]:
+        """All logs of the canonical chain in a block range."""
+        with self.lock:
+            to_block = self.head if to_block is None else min(to_block, self.head)
+            return [log for block in self.blocks[from_block:to_block + 1] for log in block["logs"]]
+
+    def _find_transaction(self, tx_hash: str) -> Optional[Tuple[dict, dict]]:
+        """(block, log) of a transaction of the canonical chain, every simulated transaction emits one log."""
+        for block in reversed(self.blocks):
+            for log in block["logs"]:
+                if log["transactionHash"] == tx_hash.lower():
+                    return block, log
+        return None
+
+    def _transaction(self, tx_hash: str) -> Optional[dict]:
+        found = self._find_transaction(tx_hash)
+        if found is None:
+            return None
+        block, log = found
+        return {
+            "hash": log["transactionHash"], "blockHash": block["hash"], "blockNumber": block["number"],
+            "transactionIndex": log["transactionIndex"], "from": "0x" + log["topics"][1][26:],
+            "to": log["address"], "value": hex(0), "gas": hex(100000), "gasPrice": hex(10 ** 9),
+            "nonce": hex(0), "input": "0x", "type": "0x0", "v": "0x1b", "r": "0x1", "s": "0x1",
+        }
+
+    def _receipt(self, tx_hash: str) -> Optional[dict]:
+        found = self._find_transaction(tx_hash)
+        if found is None:
+            return None
+        block, log = found
+        return {
+            "transactionHash": log["transactionHash"], "blockHash": block["hash"], "blockNumber": block["number"],
+            "transactionIndex": log["transactionIndex"], "from": "0x" + log["topics"][1][26:], "to": log["address"],
+            "contractAddress": None, "gasUsed": hex(50000), "cumulativeGasUsed": hex(50000),
+            "effectiveGasPrice": hex(10 ** 9), "status": "0x1", "type": "0x0",
+            "logsBloom": block["logsBloom"], "logs": [log],
+        }
+
+    def _abi_string(self, text: str) -> str:
+        data = text.encode()
+        padded = data.ljust((len(data) + 31) // 32 * 32, b"\0")
+        return "0x" + format(32, "064x") + format(len(data), "064x") + padded.hex()
+
+    def _call(self, params: dict, block_number: int) -> str:
+        """Every contract that emitted a Transfer is an ERC-721 with a simulated name, symbol and tokenURI."""
+        contract = params["to"].lower()
+        data = params.get("data") or params.get("input") or "0x"
+        selector, argument = data[:10], data[10:74]
+        logs = [log for log in self.logs(0, block_number) if log["address"].lower() == contract]
+        if not logs:
+            return "0x"
+        if selector == "0x01ffc9a7":        # supportsInterface(bytes4)
+            return _word(int(argument[:8] in ("80ac58cd", "01ffc9a7")))
+        if selector == "0x06fdde03":        # name()
+            return self._abi_string(f"Simulated {contract[-4:]}")
+        if selector == "0x95d89b41":        # symbol()
+            return self._abi_string(f"SIM{contract[-4:]}")
+        if selector == "0xc87b56dd":        # tokenURI(uint256)
+            return self._abi_string(f"ipfs://simulated/{contract[-4:]}/{int(argument, 16)}")
+        if selector == "0x70a08231":        # balanceOf(address)
+            owner = "0x" + argument[24:]
+            balance = sum((log["topics"][2] == _address_word(owner)) - (log["topics"][1] == _address_word(owner))
+                          for log in logs)
+            return _word(max(balance, 0))
+        raise ValueError("execution reverted")
+
+    #
+    # JSON-RPC
+    #
+
+    def _block_param(self, value) -> int:
+        if value in ("latest", "pending", "safe", "finalized"):
+            return self.head
+        if value == "earliest":
+            return 0
+        return int(value, 16)
+
+    def _get_logs(self, params: dict) -> List[dict]:
+        from_block = self._block_param(params.get("fromBlock", "latest"))
+        to_block = self._block_param(params.get("toBlock", "latest"))
+        addresses = params.get("address")
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = {address.lower() for address in addresses} if addresses else None
+        topics = params.get("topics") or []
+
+        found = []
+        for log in self.logs(from_block, to_block):
+            if addresses is not None and log["address"].lower() not in addresses:
+                continue
+            if any(wanted is not None and log["topics"][n] not in (wanted if isinstance(wanted, list) else [wanted])
+                   for n, wanted in enumerate(topics)):
+                continue
+            found.append(log)
+        return found
+
+    def handle(self, request: dict) -> dict:
+        """Answer one JSON-RPC request object."""
+        method, params = request.get("method"), request.get("params") or []
+        with self.lock:
+            if method == "eth_blockNumber":
+                result = hex(self.head)
+            elif method == "eth_chainId":
+                result = hex(1337)
+            elif method == "net_version":
+                result = "1337"
+            elif method == "eth_getBlockByNumber":
+                number = self._block_param(params[0])
+                block = self.blocks[number] if number <= self.head else None
+                result = None if block is None else {key: value for key, value in block.items() if key != "logs"}
+            elif method == "eth_getLogs":
+                result = self._get_logs(params[0])
+            elif method == "eth_getTransactionByHash":
+                result = self._transaction(params[0])
+            elif method == "eth_getTransactionReceipt":
+                result = self._receipt(params[0])
+            elif method == "eth_getBlockReceipts" and self.block_receipts:
+                number = self._block_param(params[0])
+                result = None if number > self.head else [self._receipt(tx_hash)
+                                                           for tx_hash in self.blocks[number]["transactions"]]
+            elif method == "eth_getCode":
+                # A contract has code from the block of its first Transfer on
+                deployed = any(log["address"].lower() == params[0].lower()
+                               for log in self.logs(0, self._block_param(params[1])))
+                result = "0x6080604052" if deployed else "0x"
+            elif method == "eth_call":
+                try:
+                    result = self._call(params[0], self._block_param(params[1] if len(params) > 1 else "latest"))
+                except ValueError as e:
+                    return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": 3, "message": str(e)}}
+            else:
+                return {"jsonrpc": "2.0", "id": request.get("id"),
+                        "error": {"code": -32601, "message": f"the method {method} does not exist"}}
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+    def handle_batch(self, requests: List[dict]) -> List[dict]:
+        """Answer a JSON-RPC batch, one response per request in the same order."""
+        return [self.handle(request) for request in requests]
+
+    def start(self) -> str:
+        """Serve JSON-RPC on a free local port in a background thread.
+
+        :return: The endpoint URL
+        """
+        chain = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if isinstance(payload, list):
+                    response = chain.handle_batch(payload)
+                else:
+                    response = chain.handle(payload)
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.endpoint_uri
+
+    @property
+    def endpoint_uri(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def random_transfers(rng: random.Random, contracts: List[str], max_transfers: int = 3) -> List[Tuple[str, str, str, int]]:
+    """A few Transfer logs of random tokens for one block."""
+    def address():
+        return "0x" + format(rng.randrange(1, 2 ** 160), "040x")
+
+    return [(rng.choice(contracts), address(), address(), rng.randrange(10000))
+            for _ in range(rng.randrange(max_transfers + 1))]
+
+
+def follow_reorgs(confirmations: int = 3, last_block: int = 200, seed: int = 1) -> Tuple[set, set, int]:
+    """Follow a simulated chain with `EventScanner.follow` while it is mined, through reorgs
+    shallower and deeper than `confirmations`, then rescan what the last reorg may have replaced.
+
+    :return: (scanned events, events of the canonical chain, last scanned block),
+        events as (block number, transaction hash, log index) up to the last scanned block
+    """
+    import os
+    import tempfile
+    import time
+
+    from web3.providers.rpc import HTTPProvider
+
+    from abiregistry import ERC721_ABI, get_registry
+    from chainhead import HeadTimeout, PollingHeadSource
+    from eventscanner import EventScanner
+    from scannerstate import SQLiteEventScannerState
+
+    rng = random.Random(seed)
+    contracts = [Web3.toChecksumAddress("0x" + format(n, "040x")) for n in (0x721, 0x722)]
+
+    chain = SimulatedChain()
+    chain.start()
+    for _ in range(50):
+        chain.mine(random_transfers(rng, contracts))
+
+    def mine_blocks():
+        # Mine the rest of the chain while the scanner follows it,
+        # with reorgs shallower and deeper than the confirmation depth
+        reorgs = {80: 2, 120: 6, 160: 10}
+        while chain.head < last_block:
+            time.sleep(0.01)
+            depth = reorgs.pop(chain.head, None)
+            if depth:
+                chain.reorg(depth, [random_transfers(rng, contracts) for _ in range(depth + 1)])
+            else:
+                chain.mine(random_transfers(rng, contracts))
+
+    provider = HTTPProvider(chain.endpoint_uri)
+    provider.middlewares.clear()
+    web3 = Web3(provider)
+    ERC721 = web3.eth.contract(abi=get_registry().abi(ERC721_ABI))
+
+    state = SQLiteEventScannerState(os.path.join(tempfile.mkdtemp(), "simchain-state.sqlite"))
+    scanner = EventScanner(web3=web3, contract=ERC721, state=state, events=[ERC721.events.Transfer],
+                           filters={"address": contracts}, max_chunk_scan_size=20)
+
+    miner = threading.Thread(target=mine_blocks)
+    miner.start()
+    try:
+        try:
+            # Follow until the miner stopped and no new block arrives any more
+            for chunk in scanner.follow(start_block=1, confirmations=confirmations, idle_timeout=1.0,
+                                        head_source=PollingHeadSource(web3, poll_interval=0.01)):
+                pass
+        except HeadTimeout:
+            pass
+        miner.join()
+        state.save()
+
+        # One more pass picks up a reorg that happened after the last cycle
+        start_block = scanner.get_suggested_scan_start_block()
+        scanner.delete_potentially_forked_block_data(start_block)
+        if start_block <= chain.head - confirmations:
+            scanner.scan(start_block, chain.head - confirmations)
+
+        last_scanned_block = state.get_last_scanned_block()
+        expected = {(int(log["blockNumber"], 16), log["transactionHash"], int(log["logIndex"], 16))
+                    for log in chain.logs(1, last_scanned_block)}
+        scanned = set(state.conn.execute("SELECT block_number, transaction_hash, log_index FROM scanned_event "
+                                         "WHERE block_number <= ?", (last_scanned_block,)).fetchall())
+    finally:
+        miner.join()
+        chain.stop()
+    return scanned, expected, last_scanned_block
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    scanned, expected, last_scanned_block = follow_reorgs()
+    assert scanned == expected, f"{len(scanned - expected)} stale and {len(expected - scanned)} missing events"
+    print(f"OK: {len(scanned)} events up to block {last_scanned_block} match the canonical chain")
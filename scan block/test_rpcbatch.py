@@ -0,0 +1,150 @@
+"""Tests of `rpcbatch.BatchRPC` against a `simchain.SimulatedChain` JSON-RPC server."""
+
+import random
+
+import pytest
+
+from rpcbatch import BatchRPC, BatchRPCError
+from rpcpool import EndpointPool
+from simchain import SimulatedChain, random_transfers
+
+CONTRACTS = ["0x" + format(n, "040x") for n in (0x721, 0x722)]
+
+
+class RecordingChain(SimulatedChain):
+    """Answers batches in reverse order, records batch sizes and methods, and fails the methods in `errors`."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batch_sizes = []
+        self.errors = {}
+        self.methods = []
+
+    def handle(self, request: dict) -> dict:
+        self.methods.append(request.get("method"))
+        error = self.errors.get(request.get("method"))
+        if error is not None:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": error}
+        return super().handle(request)
+
+    def handle_batch(self, requests):
+        self.batch_sizes.append(len(requests))
+        return list(reversed(super().handle_batch(requests)))
+
+
+def start_chain(**kwargs) -> RecordingChain:
+    rng = random.Random(1)
+    chain = RecordingChain(**kwargs)
+    for _ in range(20):
+        chain.mine(random_transfers(rng, CONTRACTS, max_transfers=5))
+    chain.start()
+    return chain
+
+
+@pytest.fixture
+def chain():
+    chain = start_chain()
+    yield chain
+    chain.stop()
+
+
+@pytest.fixture
+def receipts_chain():
+    chain = start_chain(block_receipts=True)
+    yield chain
+    chain.stop()
+
+
+def busy_block(chain) -> int:
+    return max(range(1, chain.head + 1), key=lambda n: len(chain.blocks[n]["transactions"]))
+
+
+def test_batch_is_split_by_max_batch_size(chain):
+    rpc = BatchRPC(chain.endpoint_uri, max_batch_size=4)
+    results = rpc.batch([("eth_getBlockByNumber", [hex(n), False]) for n in range(10)])
+    assert chain.batch_sizes == [4, 4, 2]
+    assert [int(block["number"], 16) for block in results] == list(range(10))
+
+
+def test_responses_are_ordered_by_id(chain):
+    rpc = BatchRPC(chain.endpoint_uri)
+    calls = [("eth_getBlockByNumber", [hex(n), False]) for n in range(chain.head + 1)]
+    calls.insert(5, ("eth_blockNumber", []))
+    results = rpc.batch(calls)
+    assert results[5] == hex(chain.head)
+    assert [int(block["number"], 16) for block in results[:5] + results[6:]] == list(range(chain.head + 1))
+
+
+def test_item_errors_are_returned_in_place(chain):
+    rpc = BatchRPC(chain.endpoint_uri)
+    results = rpc.batch([("eth_blockNumber", []), ("eth_noSuchMethod", []), ("eth_chainId", [])],
+                        raise_on_error=False)
+    assert results[0] == hex(chain.head)
+    assert isinstance(results[1], BatchRPCError) and results[1].code == -32601
+    assert results[2] == hex(1337)
+    with pytest.raises(BatchRPCError):
+        rpc.batch([("eth_blockNumber", []), ("eth_noSuchMethod", [])])
+
+
+def test_block_receipts_fall_back_when_unsupported(chain):
+    rpc = BatchRPC(chain.endpoint_uri)
+    number = busy_block(chain)
+    receipts = rpc.get_block_receipts(number)
+    assert [receipt["transactionHash"] for receipt in receipts] == chain.blocks[number]["transactions"]
+    assert rpc.supports_block_receipts is False
+
+
+def test_block_receipts_used_when_supported(receipts_chain):
+    rpc = BatchRPC(receipts_chain.endpoint_uri)
+    number = busy_block(receipts_chain)
+    receipts = rpc.get_block_receipts(number)
+    assert [receipt["transactionHash"] for receipt in receipts] == receipts_chain.blocks[number]["transactions"]
+    assert rpc.supports_block_receipts is True
+    assert receipts_chain.batch_sizes == [1]
+
+
+def test_block_receipts_other_errors_are_raised(receipts_chain):
+    receipts_chain.errors["eth_getBlockReceipts"] = {"code": -32005, "message": "rate limit exceeded"}
+    rpc = BatchRPC(receipts_chain.endpoint_uri)
+    with pytest.raises(BatchRPCError) as raised:
+        rpc.get_block_receipts(busy_block(receipts_chain))
+    assert raised.value.code == -32005
+    # Still unknown, the next call tries eth_getBlockReceipts again
+    assert rpc.supports_block_receipts is None
+
+
+def test_block_receipts_of_unknown_block_raise(receipts_chain):
+    rpc = BatchRPC(receipts_chain.endpoint_uri)
+    with pytest.raises(BatchRPCError, match="unknown block"):
+        rpc.get_block_receipts(receipts_chain.head + 10)
+
+
+def test_pool_tracks_block_receipts_per_endpoint():
+    without, with_receipts = start_chain(), start_chain(block_receipts=True)
+    try:
+        # Untried endpoints score the same, the one without the method is asked first
+        rpc = BatchRPC(pool=EndpointPool([without.endpoint_uri, with_receipts.endpoint_uri],
+                                         requests_per_second=1000))
+        for number in range(1, 11):
+            receipts = rpc.get_block_receipts(number)
+            assert [receipt["transactionHash"] for receipt in receipts] == with_receipts.blocks[number]["transactions"]
+        assert without.methods.count("eth_getBlockReceipts") == 1
+        assert with_receipts.methods.count("eth_getBlockReceipts") == 10
+        assert "eth_getTransactionReceipt" not in without.methods + with_receipts.methods
+    finally:
+        without.stop()
+        with_receipts.stop()
+
+
+def test_pool_falls_back_when_no_endpoint_has_block_receipts():
+    chains = [start_chain(), start_chain()]
+    try:
+        rpc = BatchRPC(pool=EndpointPool([chain.endpoint_uri for chain in chains], requests_per_second=1000))
+        for number in range(1, 6):
+            receipts = rpc.get_block_receipts(number)
+            assert [receipt["transactionHash"] for receipt in receipts] == chains[0].blocks[number]["transactions"]
+        # Each endpoint is asked once, later calls fall back without asking
+        assert [chain.methods.count("eth_getBlockReceipts") for chain in chains] == [1, 1]
+    finally:
+        for chain in chains:
+            chain.stop()
@@ -0,0 +1,9 @@
+"""Follow mode through reorgs on a `simchain.SimulatedChain`, guards `EventScanner.follow` and `find_fork_point`."""
+
+from simchain import follow_reorgs
+
+
+def test_follow_ends_on_the_canonical_chain():
+    scanned, expected, last_scanned_block = follow_reorgs(confirmations=3, last_block=200)
+    assert last_scanned_block >= 190
+    assert scanned == expected, f"{len(scanned - expected)} stale and {len(expected - scanned)} missing events"
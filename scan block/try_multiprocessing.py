@@ -7,10 +7,17 @@ import multiprocessing
 import datetime
 from datetime import timedelta
 from tqdm import tqdm
-import pandas as pd
 import numpy as np
 # from tqdm._tqdm import trange
 from multiprocessing import Pool
+from abiregistry import ERC721_ABI, get_registry, init_registry
+from deployblock import DeploymentBlockCache
+from eventsink import QueueSink, SinkWriterProcess, transfer_schema
+from eventscanner import scan_transfer_columns
+from fastdecode import column_rows
+from rpcpool import get_web3
+from txcache import TransactionCache
+from workqueue import WorkScheduler, deployed_contract_units
 import os, time, random
 import datetime
 import time
@@ -18,81 +25,102 @@ import time
 
 # import mplfinance as mpf
 
-# 子进程-----使用不同的alchemy节点扫描不同的nft合约
-# 多进程 https://www.liaoxuefeng.com/wiki/1016959663602400/1017628290184064
-def childProcessScan(name, alchemy_url_set, token_address_set, iteration_num, Block_internal):
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[name]))     # 不同进程使用不同的alchemy节点
-    print(name)
-    print("节点是否可连接：", w3.isConnected())
-
-    token_address_set = [w3.toChecksumAddress(i) for i in token_address_set]
-    with open('abi/ERC_721.json', 'r', encoding='utf-8') as f:
-        abi_721 = json.load(f)
-    with open('abi/ERC_1155.json', 'r', encoding='utf-8') as f:
-        abi_1155 = json.load(f)
-    token_contract_set = []
-    # 检查合约是否属于ERC721
-    ERC721InterfaceId = '0x80ac58cd'
-    ERC1155InterfaceId = '0xd9b67a26'
-    for token_address in token_address_set:
-        contract = w3.eth.contract(address=token_address, abi=abi_721)
-        if contract.functions.supportsInterface(ERC721InterfaceId).call():
-            token_contract_set.append(contract)
+transferSink = None     # 子进程的输出，由Pool的initializer设置
+txCache = None          # 子进程的交易缓存，第一次使用时创建，同一进程的所有任务单元共用
+
+
+def initWorker(queue):
+    # Pool子进程初始化：记录通过队列按批发送给唯一的写入进程
+    # ABI在每个子进程中只解析一次
+    global transferSink
+    transferSink = QueueSink(queue)
+    init_registry()
 
-    for i in range(iteration_num, -1, -1):
-        print("====================================================")
-        print("第 %d 个进程--------第 %d 个区块", name, i*Block_internal)
 
-        # 每次开的新的线程，选择一个新的alchemy节点和一个新的nft721合约。
-        x = get_trans_info(i, w3, token_contract_set[name], iteration_num, Block_internal)
-        if not x:
-            print('该交易历史回溯结束，进入下一个合约...')
-            break
+ALCHEMY_URL_SET = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
+                   'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
+                   'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
+                   'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
 
-    print("!!!!!!!!!!!!!!!!!!   第 %d 个进程结束", name)
 
-def get_trans_info(i, w3, token_contract, iteration_num, Block_internal):
+# 子进程-----扫描一个任务单元：一组合约在一段区块范围内的Transfer事件
+# 空闲的进程从调度器领取下一个单元，不再固定分配区块范围，慢的范围不会拖住其他进程
+# 多进程 https://www.liaoxuefeng.com/wiki/1016959663602400/1017628290184064
+def scanUnit(unit):
+    # 进程内共用一个节点池：所有alchemy节点保持长连接并按节点限速，某个节点返回429/5xx时自动切换到其他节点
+    w3 = get_web3(ALCHEMY_URL_SET)
+
+    # 每个区块范围只用一次eth_getLogs获取单元内所有合约的Transfer事件
+    # Transfer日志直接按列切分（区块号、交易哈希、合约、from、to、tokenId），不再逐条用ABI解码、构造AttributeDict
+    # 出错时直接抛出异常，由调度器把这个单元放回队列重试
+    event_template = get_registry().event(w3, ERC721_ABI, 'Transfer')
+    event_count = 0
     try:
-        contract_address = token_contract
-        event_template = contract_address.events.Transfer       #
-        if i != iteration_num:
-            filter = event_template.createFilter(fromBlock=hex(int(i * Block_internal)),
-                                                 toBlock=hex(int((i + 1) * Block_internal - 1)))
-        else:
-            filter = event_template.createFilter(fromBlock=hex(int(i * Block_internal)),
-                                                 toBlock='latest')
-        events = filter.get_all_entries()
-        print('events number', len(events))
-        if len(events) == 0:
-            return False
-        else:
-            for event in events:
-                transactionHash = event.transactionHash
-                transfer_info = w3.eth.get_transaction(transactionHash)
-                Tx_Fee = transfer_info.value
-                Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
-                block_num = event.blockNumber
-                block_timestamp = w3.eth.getBlock(block_num).timestamp
-                block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
-                datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
-                print('交易时间为：', datatimestr)
-
-                nft_tr_info = pd.DataFrame({
-                    'Datetime': datatimestr,
-                    'ContractAddress': contract_address.address,
-                    'TokenId': event.args.tokenId,
-                    'From Address': transfer_info['from'],
-                    'To Address': transfer_info.to,
-                    'Value': Tx_Fee,
-                    'BlockHash': transfer_info.blockHash.hex(),
-                    'Blocknumber': block_num,
-                    'TransactionHash': transactionHash.hex(),
-                    'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
-                    'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))}, index=[block_timestamp])
-                nft_tr_info.to_csv('date/df_Transaction_history.csv', mode='a', index=True, header=False)
-            return True
-    except Exception as e:
-        print(e)
+        for chunk_start, chunk_end, columns, others in scan_transfer_columns(
+                w3, event_template, list(unit.contracts), unit.start_block, unit.end_block,
+                chunk_size=unit.end_block - unit.start_block + 1):
+            print("进程 %d--------第 %d - %d 个区块" % (os.getpid(), chunk_start, chunk_end))
+            for contract_address, count in zip(*np.unique(columns['contract'], return_counts=True)):
+                print(contract_address, 'events number', count)
+            write_transfer_events(w3, column_rows(columns))
+            event_count += len(columns['block_number'])
+    except Exception:
+        # 还没发送的记录丢弃，重试时重新写入（超过batch_rows已经发送的记录由写入进程按键跳过）
+        transferSink.discard()
+        raise
+    transferSink.flush()
+    return event_count
+
+
+def erc721Contracts(w3, token_address_set):
+    # 检查合约是否属于ERC721，只在主进程中检查一次
+    registry = get_registry()
+    ERC721InterfaceId = '0x80ac58cd'
+    ERC1155InterfaceId = '0xd9b67a26'
+    token_contract_set = []
+    for token_address in token_address_set:
+        contract = registry.contract(w3, ERC721_ABI, token_address)
+        if contract.functions.supportsInterface(ERC721InterfaceId).call():
+            token_contract_set.append(contract.address)
+    return token_contract_set
+
+def getTxCache(w3):
+    global txCache
+    if txCache is None:
+        txCache = TransactionCache.from_web3(w3)
+    return txCache
+
+
+def write_transfer_events(w3, transfers):
+    # 把一个区块范围内的Transfer记录写入输出，transfers是fastdecode.column_rows得到的字典
+    # 先把不重复的交易哈希一次批量获取（内存和磁盘缓存中已有的不再请求），同一笔交易的多个Transfer共用一次查询
+    cache = getTxCache(w3)
+    cache.prefetch(transfer['transaction_hash'] for transfer in transfers)
+    for transfer in transfers:
+        transactionHash = transfer['transaction_hash']
+        transfer_info = cache.get_transaction(transactionHash)
+        Tx_Fee = transfer_info.value
+        Tx_Fee = float(Web3.fromWei(Tx_Fee, 'ether'))
+        block_num = transfer['block_number']
+        block_timestamp = w3.eth.getBlock(block_num).timestamp
+        block_date_time = datetime.datetime.fromtimestamp(block_timestamp)
+        datatimestr = datetime.datetime.strftime(block_date_time, '%Y-%m-%d %H:%M:%S')
+        print('交易时间为：', datatimestr)
+
+        transferSink.write({
+            'Timestamp': block_timestamp,
+            'Datetime': datatimestr,
+            'ContractAddress': transfer['contract'],
+            'TokenId': transfer['token_id'],
+            'From Address': transfer_info['from'],
+            'To Address': transfer_info.to,
+            'Value': Tx_Fee,
+            'BlockHash': transfer['block_hash'],     # 取自日志，缓存的交易在区块重组后可能还是旧的区块哈希
+            'Blocknumber': block_num,
+            'LogIndex': transfer['log_index'],
+            'TransactionHash': transactionHash,
+            'Gas': float(Web3.fromWei(transfer_info.gas, 'ether')),
+            'Gasprice': float(Web3.fromWei(transfer_info.gasPrice, 'ether'))})
 
 '''
 def func_call_back(res):
@@ -111,28 +139,34 @@ if __name__ == '__main__':
                          '0xbd5fb504d4482ef4366dfa0c0edfb85ed50a9bbb',
                          '0x08abed322775731d7b75dbdfe6151dc39ad83800']  # 对应的一些NFT合约地址
 
-    alchemy_url_set = ['https://eth-mainnet.g.alchemy.com/v2/BtKriOSkJwXY4JjVExxW8dar28ZBeY1m',
-                       'https://eth-mainnet.g.alchemy.com/v2/gw3OcPT1SboUT2dOKauzxrIOjC6DzJkj',
-                       'https://eth-mainnet.g.alchemy.com/v2/hPu-tophIgLWV-UFgJlZife49rmePmtS',
-                       'https://eth-mainnet.g.alchemy.com/v2/NMRxu6oBULkj1QBjHYM6rQRDD1sZwx1E']
-
-    w3 = Web3(Web3.HTTPProvider(alchemy_url_set[0]))
+    w3 = get_web3(ALCHEMY_URL_SET)
     now_block_number = w3.eth.get_block('latest').number        # 当前区块高度
     Block_internal = 1e4
-    iteration_num = int(now_block_number // Block_internal)
-
-    df_Transaction_history = pd.DataFrame(columns=['Datetime', 'ContractAddress', 'TokenId',
-                                                   'From Address', 'To Address', 'Value', 'BlockHash',
-                                                   'Blocknumber', 'TransactionHash', 'Gas', 'Gasprice'])
-    df_Transaction_history.to_csv('date/df_Transaction_history.csv')
 
-    p = Pool(10)
-    for i in range(4):
-        # 无法直接传入w3 = Web3(Web3.HTTPProvider('https://<your-provider-url>'))，这个很麻烦
-        p.apply_async(childProcessScan, args=(i, alchemy_url_set, token_address_set, iteration_num, Block_internal))
+    # 所有子进程的记录都发送给同一个写入进程，按批写入Parquet和CSV，避免多个进程同时追加同一个文件
+    transfer_columns = ['Datetime', 'ContractAddress', 'TokenId',
+                        'From Address', 'To Address', 'Value', 'BlockHash',
+                        'Blocknumber', 'LogIndex', 'TransactionHash', 'Gas', 'Gasprice']
+    # 重试的单元已经发送过的记录按 (交易哈希, 日志序号) 跳过，不会重复写出
+    sinkWriter = SinkWriterProcess('date/df_Transaction_history', transfer_schema(transfer_columns),
+                                   formats=('parquet', 'csv'), dedup_key=('TransactionHash', 'LogIndex'))
+
+    # 从最早的部署区块到当前区块切成每段Block_internal个区块的任务单元，按需生成，调度器里最多只有2倍进程数的单元在排队
+    # 每个单元只包含已经部署的合约；空闲的进程领取下一个单元，失败的单元放回队列重试，最多3次
+    token_address_set = erc721Contracts(w3, token_address_set)
+    # 二分查找eth_getCode得到每个合约的部署区块，结果缓存，下次运行不再查找
+    deploymentBlocks = DeploymentBlockCache.from_web3(w3).get_many(token_address_set, now_block_number)
+    deploymentBlocks = {address: block for address, block in deploymentBlocks.items() if block is not None}
+    print("部署区块", deploymentBlocks)
     print('Waiting for all subprocesses done...')
-    p.close()
-    p.join()
+    with Pool(10, initializer=initWorker, initargs=(sinkWriter.queue,)) as p:
+        scheduler = WorkScheduler(p, scanUnit, max_attempts=3)
+        units = deployed_contract_units(deploymentBlocks, now_block_number, Block_internal)
+        for unit, event_count in scheduler.run(units):
+            print("第 %d - %d 个区块完成, %d 个事件" % (unit.start_block, unit.end_block, event_count))
+    for unit, error in scheduler.failed:
+        print("第 %d - %d 个区块扫描失败：%s" % (unit.start_block, unit.end_block, error))
+    sinkWriter.close()
     print('All subprocesses done.')
     # 使用两个线程一起确实比之前更快，但需要查看是否正确
     # 现在还有一个问题是，当某个进程完成后，即这个alchemy节点扫描完对应的nft合约地址后，就直接退出了。并不会扫描接下来还未被扫描的地址
@@ -144,6 +178,8 @@ if __name__ == '__main__':
     # 不知道这个出现是不是就说明该合约的交易已经全部扫描完成
 
     # 有没有可能不需要每个合约单独扫描链，只需要扫描一次区块链，然后从中找对应的nft合约对应的事件  w3.eth.filter
+    # 已改为只扫描一次区块链：eventscanner.scan_contract_events 每个区块范围用一次eth_getLogs获取所有合约的事件
+    # 已改为由workqueue.WorkScheduler动态分配任务单元：进程完成一个单元后继续领取下一个，不会提前退出
 
 
 
@@ -0,0 +1,184 @@
+"""Deduplicating transaction and receipt cache keyed by transaction hash.
+    以交易哈希为键、去重的交易和收据缓存。
+
+A sweep, bundle or batch mint emits hundreds of Transfers from one transaction, and
+the scanners used to call `get_transaction` (and `get_transaction_receipt`) once per
+event. Callers now hand over the transaction hashes of a whole chunk: each unique hash
+is looked up in memory, then on disk, and only the rest is fetched in one JSON-RPC batch.
+一笔批量转移或批量铸造交易会产生几百个 Transfer 事件，扫描程序以前每个事件都调用一次
+`get_transaction`（和 `get_transaction_receipt`）。现在调用方提交整个区块范围的交易哈希，
+每个哈希先查内存、再查磁盘，剩下的通过一次 JSON-RPC 批量请求获取。
+
+The in-memory LRU holds Web3-formatted AttributeDicts, the SQLite file holds the raw
+JSON and is shared by all processes and runs, bounded to the most recent `max_disk_rows`.
+Only transactions `confirmations` blocks below the head go to disk: a reorg can move a
+recent transaction to another block, and its blockHash would be stale forever. Callers
+should take the block hash of an event from the log itself.
+内存中的 LRU 保存 Web3 格式的 AttributeDict，SQLite 文件保存原始 JSON，所有进程和多次运行共用，
+只保留最近的 `max_disk_rows` 条。只有低于最新区块 `confirmations` 个区块的交易才写入磁盘：
+区块重组可能把最近的交易移到另一个区块，磁盘上的 blockHash 就会一直是旧的。事件的区块哈希应取自日志本身。
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from web3._utils.method_formatters import receipt_formatter, transaction_result_formatter
+from web3.datastructures import AttributeDict
+from web3.exceptions import TransactionNotFound
+
+from contractcache import _ProcessLocalSQLite
+from rpcbatch import BatchRPC
+
+
+logger = logging.getLogger(__name__)
+
+# Table and JSON-RPC method of each kind of cached object
+_KINDS = {
+    "transaction": ("cached_transaction", "eth_getTransactionByHash", transaction_result_formatter),
+    "receipt": ("cached_receipt", "eth_getTransactionReceipt", receipt_formatter),
+}
+
+
+def _tx_hash(value) -> str:
+    """Transaction hashes are HexBytes in Web3 events and hex strings in raw logs."""
+    value = value if isinstance(value, str) else value.hex()
+    return value.lower() if value.startswith("0x") else "0x" + value.lower()
+
+
+class TransactionCache(_ProcessLocalSQLite):
+    """Transactions and receipts by hash, an LRU in memory in front of a bounded SQLite file.
+        按哈希缓存交易和收据：内存 LRU 加上有界的 SQLite 文件。
+
+    Pending transactions are never cached, a later lookup asks the node again.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS cached_transaction (hash TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS cached_receipt (hash TEXT PRIMARY KEY, data TEXT NOT NULL);
+    """
+
+    def __init__(self, rpc: BatchRPC, fname: str = "date/tx_cache.sqlite", receipts: bool = False,
+                 maxsize: int = 50000, max_disk_rows: int = 1000000, confirmations: int = 12, timeout: float = 30.0):
+        """
+        :param rpc: Batch client the misses are fetched with
+        :param fname: SQLite file shared by all scanner processes
+        :param receipts: `prefetch` also fetches the receipts, for callers that use `get_receipt`
+        :param maxsize: How many transactions and receipts each we keep in memory
+        :param max_disk_rows: How many transactions and receipts each we keep on disk, the oldest are dropped first
+        :param confirmations: Blocks a transaction must be below the head before it is written to disk
+        """
+        super().__init__(fname, timeout)
+        self.rpc = rpc
+        self.receipts = receipts
+        self.maxsize = maxsize
+        self.max_disk_rows = max_disk_rows
+        self.confirmations = confirmations
+        self.memory = {kind: OrderedDict() for kind in _KINDS}
+        self._inserted = 0
+
+    @classmethod
+    def from_web3(cls, w3, **kwargs) -> "TransactionCache":
+        """Cache that fetches from the same endpoint (or endpoint pool) as the Web3 provider."""
+        return cls(BatchRPC.from_web3(w3), **kwargs)
+
+    def connected(self):
+        self.memory = {kind: OrderedDict() for kind in _KINDS}
+
+    def _remember(self, kind: str, tx_hash: str, value: AttributeDict):
+        memory = self.memory[kind]
+        memory[tx_hash] = value
+        memory.move_to_end(tx_hash)
+        while len(memory) > self.maxsize:
+            memory.popitem(last=False)
+
+    def _load(self, kind: str, tx_hashes: List[str]) -> List[str]:
+        """Move the hashes found on disk to memory, return the ones still missing."""
+        table, _, formatter = _KINDS[kind]
+        found = {}
+        # SQLite limits the number of bound parameters per statement
+        for offset in range(0, len(tx_hashes), 500):
+            part = tx_hashes[offset:offset + 500]
+            found.update(self.conn.execute(
+                "SELECT hash, data FROM %s WHERE hash IN (%s)" % (table, ",".join("?" * len(part))), part).fetchall())
+        for tx_hash, data in found.items():
+            self._remember(kind, tx_hash, AttributeDict(formatter(json.loads(data))))
+        return [tx_hash for tx_hash in tx_hashes if tx_hash not in found]
+
+    def _fetch(self, kind: str, tx_hashes: List[str]):
+        table, method, formatter = _KINDS[kind]
+        # The head comes in the same batch, to tell which transactions are confirmed
+        head, *results = self.rpc.batch([("eth_blockNumber", [])] + [(method, [tx_hash]) for tx_hash in tx_hashes])
+        confirmed = int(head, 16) - self.confirmations
+        rows = []
+        for tx_hash, result in zip(tx_hashes, results):
+            if result is None or result.get("blockHash") is None:
+                # Unknown or still pending
+                continue
+            if int(result["blockNumber"], 16) <= confirmed:
+                rows.append((tx_hash, json.dumps(result)))
+            self._remember(kind, tx_hash, AttributeDict(formatter(result)))
+        if rows:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO %s (hash, data) VALUES (?, ?)" % table, rows)
+            self._inserted += len(rows)
+            if self._inserted >= 10000:
+                self._prune()
+
+    def _prune(self):
+        """Keep only the most recently inserted `max_disk_rows` rows per table."""
+        self._inserted = 0
+        with self.conn:
+            for table, _, _ in _KINDS.values():
+                self.conn.execute("DELETE FROM %s WHERE rowid <= (SELECT MAX(rowid) FROM %s) - ?" % (table, table),
+                                  (self.max_disk_rows,))
+
+    def _prefetch(self, kind: str, tx_hashes: Iterable):
+        memory = self.memory[kind]
+        missing = [tx_hash for tx_hash in dict.fromkeys(_tx_hash(h) for h in tx_hashes) if tx_hash not in memory]
+        if missing:
+            missing = self._load(kind, missing)
+        if missing:
+            logger.debug("Fetching %d %ss", len(missing), kind)
+            self._fetch(kind, missing)
+
+    def prefetch(self, tx_hashes: Iterable):
+        """Make sure the transactions (and receipts, see `receipts`) are cached, fetching all misses in one batch."""
+        tx_hashes = list(tx_hashes)
+        self._prefetch("transaction", tx_hashes)
+        if self.receipts:
+            self._prefetch("receipt", tx_hashes)
+
+    def _get(self, kind: str, tx_hash) -> AttributeDict:
+        tx_hash = _tx_hash(tx_hash)
+        value = self.memory[kind].get(tx_hash)
+        if value is None:
+            self._prefetch(kind, [tx_hash])
+            value = self.memory[kind].get(tx_hash)
+            if value is None:
+                raise TransactionNotFound(f"No {kind} of {tx_hash}: unknown to the node, or not mined yet")
+        else:
+            self.memory[kind].move_to_end(tx_hash)
+        return value
+
+    def get_transaction(self, tx_hash) -> AttributeDict:
+        """Same as `w3.eth.get_transaction`.
+
+        :raise TransactionNotFound: The node does not know the transaction, or it is still pending
+        """
+        return self._get("transaction", tx_hash)
+
+    def get_receipt(self, tx_hash) -> AttributeDict:
+        """Same as `w3.eth.get_transaction_receipt`.
+
+        :raise TransactionNotFound: The node does not know the transaction, or it is not mined yet
+        """
+        return self._get("receipt", tx_hash)
+
+    def get_transactions(self, tx_hashes: Iterable) -> Dict[str, AttributeDict]:
+        """Transactions of many hashes, keyed by lowercase hex hash, unknown ones left out."""
+        tx_hashes = [_tx_hash(h) for h in tx_hashes]
+        self._prefetch("transaction", tx_hashes)
+        memory = self.memory["transaction"]
+        return {tx_hash: memory[tx_hash] for tx_hash in tx_hashes if tx_hash in memory}
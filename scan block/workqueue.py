@@ -0,0 +1,140 @@
+"""Bounded, dynamically balanced queue of (contracts, block range) work units for a process pool.
+    用于进程池的有界、动态均衡的（合约，区块范围）任务队列。
+
+Instead of giving each worker a fixed share of the work up front, the backfill is cut
+into small units that are generated lazily. At most `max_pending` units are submitted
+to the pool at a time, and a worker that becomes idle takes the next one, so a slow
+contract or a dense block range no longer holds up the rest. A unit whose function
+raises is put back at the front of the queue until it has failed `max_attempts` times.
+回填任务被切成许多小单元并按需生成，任何时候最多只有 `max_pending` 个单元提交给进程池，
+空闲的进程立即领取下一个单元，因此慢的合约或密集的区块范围不会拖慢其他任务。
+执行失败的单元会放回队列最前面重试，直到失败 `max_attempts` 次。
+
+Usage::
+
+    with Pool(8) as pool:
+        scheduler = WorkScheduler(pool, scan_unit)
+        for unit, result in scheduler.run(block_range_units(0, head, 10000, [contracts])):
+            ...
+        print(scheduler.failed)
+"""
+
+import collections
+import logging
+import os
+import queue
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkUnit(NamedTuple):
+    """Scan `contracts` (all contracts if empty) from `start_block` to `end_block`, both inclusive."""
+
+    contracts: Tuple[str, ...]
+    start_block: int
+    end_block: int
+    attempts: int = 0
+
+
+def block_range_units(start_block: int, end_block: int, chunk_size: int,
+                      contract_groups: Sequence[Sequence[str]] = ((),), descending: bool = False) -> Iterator[WorkUnit]:
+    """Lazily cut a block range into units of at most `chunk_size` blocks, one per contract group.
+
+    :param contract_groups: Contracts scanned together in one unit, e.g. all of them for one `eth_getLogs` per range,
+        or one contract per group to spread a single busy collection over all workers
+    :param descending: Start with the newest blocks
+    """
+    chunk_size = max(1, int(chunk_size))
+    starts = range(start_block, end_block + 1, chunk_size)
+    if descending:
+        starts = reversed(starts)
+    for chunk_start in starts:
+        chunk_end = min(chunk_start + chunk_size - 1, end_block)
+        for contracts in contract_groups:
+            yield WorkUnit(tuple(contracts), chunk_start, chunk_end)
+
+
+def deployed_contract_units(deployment_blocks: Dict[str, int], end_block: int, chunk_size: int) -> Iterator[WorkUnit]:
+    """Lazily cut the history of some contracts into units, from the first deployment block on.
+
+    Each unit only lists the contracts already deployed by its last block, so no unit asks
+    for the logs of a contract that did not exist yet.
+
+    :param deployment_blocks: Contract -> deployment block, e.g. from `deployblock.DeploymentBlockCache`
+    """
+    if not deployment_blocks:
+        return
+    chunk_size = max(1, int(chunk_size))
+    by_block = sorted(deployment_blocks.items(), key=lambda item: item[1])
+    for chunk_start in range(by_block[0][1], end_block + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, end_block)
+        yield WorkUnit(tuple(contract for contract, block in by_block if block <= chunk_end), chunk_start, chunk_end)
+
+
+class WorkScheduler:
+    """Feed work units to a `multiprocessing.Pool`, keeping at most `max_pending` in flight.
+        向 `multiprocessing.Pool` 提交任务单元，同时在执行中的单元不超过 `max_pending` 个。
+    """
+
+    def __init__(self, pool, func: Callable[[WorkUnit], Any], max_pending: Optional[int] = None,
+                 max_attempts: int = 3):
+        """
+        :param pool: `multiprocessing.Pool` the units run in
+        :param func: Picklable top level function run in the worker for each unit, raises to have the unit retried
+        :param max_pending: Units submitted to the pool at a time, defaults to twice the number of workers,
+            so a worker never waits for the parent to hand out the next unit
+        :param max_attempts: Give up on a unit after it failed this many times
+        """
+        self.pool = pool
+        self.func = func
+        self.max_pending = max_pending or 2 * (getattr(pool, "_processes", None) or os.cpu_count())
+        self.max_attempts = max_attempts
+        # Units that failed `max_attempts` times, with their last error
+        self.failed: List[Tuple[WorkUnit, BaseException]] = []
+
+    def run(self, units: Iterable[WorkUnit]) -> Iterator[Tuple[WorkUnit, Any]]:
+        """Run all units and yield (unit, result) in completion order.
+
+        Units are pulled from `units` only when there is room in the pool,
+        so it can be a generator over millions of blocks.
+        """
+        units = iter(units)
+        retries = collections.deque()
+        done = queue.Queue()
+        pending = 0
+        exhausted = False
+
+        while True:
+            # Top up the pool, retried units first
+            while pending < self.max_pending and (retries or not exhausted):
+                if retries:
+                    unit = retries.popleft()
+                else:
+                    unit = next(units, None)
+                    if unit is None:
+                        exhausted = True
+                        break
+                self.pool.apply_async(self.func, (unit,),
+                                      callback=lambda result, unit=unit: done.put((unit, result, None)),
+                                      error_callback=lambda error, unit=unit: done.put((unit, None, error)))
+                pending += 1
+
+            if not pending:
+                return
+
+            unit, result, error = done.get()
+            pending -= 1
+            if error is None:
+                yield unit, result
+                continue
+
+            unit = unit._replace(attempts=unit.attempts + 1)
+            if unit.attempts < self.max_attempts:
+                logger.warning("Work unit %s failed with %r, requeued (attempt %d/%d)",
+                               unit, error, unit.attempts, self.max_attempts)
+                retries.append(unit)
+            else:
+                logger.error("Work unit %s failed %d times, giving up: %r", unit, unit.attempts, error)
+                self.failed.append((unit, error))